@@ -2,6 +2,7 @@
 Script to train the DPSOM model.
 """
 
+import timeit
 import uuid
 from datetime import date
 
@@ -16,9 +17,9 @@ import sacred
 from sacred.stflow import LogFileWriter
 from sklearn.model_selection import train_test_split
 import numpy as np
-from sklearn import metrics
 from DPSOM_model import DPSOM
-from utils import cluster_purity
+from cluster_metrics import cluster_scores
+from utils import prefetch_generator, epoch_permutation, TargetDistribution, session_config
 import os
 from os import path
 
@@ -55,11 +56,27 @@ def ex_config():
         val_epochs (bool): If "True" clustering results are saved every 10 epochs on default output files.
         more_runs (bool): Indicator whether to run the job once (False) or multiple times (True) outputting mean and
                           variance.
+        shuffle (bool): If "True" the training batches are drawn in a new random order every epoch.
+        prefetch (int): Number of batches prepared in a background thread during the training steps, 0 prepares them
+                        synchronously.
+        q_chunk_size (int): Number of data points for which the soft assignments are computed at a time, when refreshing
+                            the target distribution.
+        target_refresh_steps (int): Number of training steps after which the target distribution is refreshed, 0
+                                    refreshes it at the start of every epoch.
+        toroidal (bool): If "True" the SOM grid wraps around at its borders, otherwise nodes at the border have
+                         fewer neighbours.
+        intra_op_threads (int): Number of threads used within an operation, 0 lets TensorFlow choose.
+        inter_op_threads (int): Number of operations run in parallel, 0 lets TensorFlow choose.
+        xla_jit (bool): If "True" clusters of operations are compiled with XLA.
+        compute_dtype (str): Type of the computations of the hidden layers of the encoder and the decoder, in
+                             ['float32', 'bfloat16', 'float16'], the variables stay in float32.
+                             float16 is slow on CPUs, which should use bfloat16.
     """
     num_epochs = 300
     batch_size = 300
     latent_dim = 100
     som_dim = [8, 8]
+    toroidal = True
     learning_rate = 0.001
     alpha = 10.0
     beta = 0.25
@@ -83,9 +100,17 @@ def ex_config():
     more_runs = False
     use_saved_pretrain = False
     save_pretrain = False
+    shuffle = False
+    prefetch = 0
+    q_chunk_size = 5000
+    target_refresh_steps = 0
+    intra_op_threads = 0
+    inter_op_threads = 0
+    xla_jit = False
+    compute_dtype = "float32"
 
 @ex.capture
-def get_data_generator(data_train, data_val, labels_train, labels_val, data_test, labels_test):
+def get_data_generator(data_train, data_val, labels_train, labels_val, data_test, labels_test, shuffle, seed):
     """Creates a data generator for the training.
     Args:
         data_train: training set.
@@ -94,6 +119,8 @@ def get_data_generator(data_train, data_val, labels_train, labels_val, data_test
         labels_val: labels of the validation set.
         data_test: test set.
         labels_test: labels of the test set.
+        shuffle (bool): If "True" the training batches are drawn in a new random order every epoch.
+        seed (int): Seed for the shuffling.
 
     Returns:
         generator: Data generator for the batches."""
@@ -110,7 +137,7 @@ def get_data_generator(data_train, data_val, labels_train, labels_val, data_test
         Yields:
             np.array: Data batch.
             np.array: Labels batch.
-            int: Offset of the batch in dataset.
+            np.array: Positions of the batch in dataset.
         """
         assert mode in ["train", "val", "test"], "The mode should be in {train, val, test}."
         if mode == "train":
@@ -123,16 +150,20 @@ def get_data_generator(data_train, data_val, labels_train, labels_val, data_test
             images = data_test.copy()
             labels = labels_test.copy()
 
+        rnd = np.random.RandomState(seed)
         while True:
+            order = epoch_permutation(len(images), shuffle and mode == "train", rnd)
             for i in range(len(images) // batch_size):
-                yield images[i * batch_size:(i + 1) * batch_size], labels[i * batch_size:(i + 1) * batch_size], i
+                positions = order[i * batch_size:(i + 1) * batch_size]
+                yield images[positions], labels[positions], positions
 
     return batch_generator
 
 
 @ex.capture
 def train_model(model, data_train, data_val, generator, lr_val, num_epochs, batch_size, logdir, ex_name, validation,
-                val_epochs, modelpath, learning_rate, epochs_pretrain, som_dim, latent_dim, use_saved_pretrain, save_pretrain):
+                val_epochs, modelpath, learning_rate, epochs_pretrain, som_dim, latent_dim, use_saved_pretrain, save_pretrain,
+                prefetch, q_chunk_size, target_refresh_steps, intra_op_threads, inter_op_threads, xla_jit):
 
     """Trains the DPSOM model.
     Args:
@@ -151,14 +182,21 @@ def train_model(model, data_train, data_val, generator, lr_val, num_epochs, batc
         epochs_pretrain (int): Number of VAE pretraining epochs.
         som_dim (list): Dimensionality of the self-organizing map.
         latent_dim (int): Dimensionality of the DPSOM's latent space.
+        prefetch (int): Number of batches prepared in a background thread during the training steps.
+        q_chunk_size (int): Number of data points for which the soft assignments are computed at a time.
+        target_refresh_steps (int): Number of training steps after which the target distribution is refreshed, 0
+                                    refreshes it at the start of every epoch.
+        intra_op_threads (int): Number of threads used within an operation.
+        inter_op_threads (int): Number of operations run in parallel.
+        xla_jit (bool): If "True" clusters of operations are compiled with XLA.
     """
     epochs = 0
     iterations = 0
-    train_gen = generator("train", batch_size)
+    train_gen = prefetch_generator(generator("train", batch_size), prefetch)
     if validation:
-        val_gen = generator("val", batch_size)
+        val_gen = prefetch_generator(generator("val", batch_size), prefetch)
     else:
-        val_gen = generator("test", batch_size)
+        val_gen = prefetch_generator(generator("test", batch_size), prefetch)
     len_data_train = len(data_train)
     len_data_val = len(data_val)
     num_batches = len_data_train // batch_size
@@ -166,7 +204,7 @@ def train_model(model, data_train, data_val, generator, lr_val, num_epochs, batc
     saver = tf.train.Saver(max_to_keep=5)
     summaries = tf.summary.merge_all()
 
-    with tf.Session() as sess:
+    with tf.Session(config=session_config(intra_op_threads, inter_op_threads, xla_jit)) as sess:
         sess.run(tf.global_variables_initializer())
         test_losses = []
         test_losses_mean = []
@@ -287,32 +325,31 @@ def train_model(model, data_train, data_val, generator, lr_val, num_epochs, batc
                 saver.save(sess, pretrainpath)
 
         print("\n\nTraining...\n")
+        q_fn = lambda data_chunk: sess.run(model.q, feed_dict={x: data_chunk, is_training: True,
+                                                               z: np.zeros((len(data_chunk), latent_dim))})
+        ppt = TargetDistribution(q_fn, data_train, som_dim[0] * som_dim[1], chunk_size=q_chunk_size)
+        ppv = TargetDistribution(q_fn, data_val, som_dim[0] * som_dim[1], chunk_size=q_chunk_size)
+        refresh_steps = target_refresh_steps if target_refresh_steps > 0 else num_batches
+        ttime_per_epoch = []
         for epoch in range(num_epochs):
             epochs += 1
-            #Compute initial soft probabilities between data points and centroids
-            q = []
-            for t in range(9):
-                q.extend(sess.run(model.q, feed_dict={
-                        x: data_train[int(len(data_train) / 10) * t: int(len(data_train) / 10) * (t + 1)],
-                        is_training: True, z: np.zeros((int(len(data_train) / 10), latent_dim))}))
-            q.extend(sess.run(model.q, feed_dict={x: data_train[int(len(data_train) / 10) * 9:], is_training: True,
-                                                      z: np.zeros((int(len(data_train) / 10), latent_dim))}))
-            q = np.array(q)
-            ppt = model.target_distribution(q)
-            q = sess.run(model.q, feed_dict={x: data_val, is_training: True, z: np.zeros((len(data_val), latent_dim))})
-            ppv = model.target_distribution(q)
+            t_begin = timeit.default_timer()
 
             #Train
             for i in range(num_batches):
+                #Compute the soft probabilities between data points and centroids
+                if iterations % refresh_steps == 0:
+                    ppt.refresh()
+                    ppv.refresh()
                 iterations += 1
                 batch_data, _, ii = next(train_gen)
-                ftrain = {p: ppt[ii * batch_size: (ii + 1) * batch_size], is_training: True,
+                ftrain = {p: ppt[ii], is_training: True,
                               z: np.zeros((batch_size, latent_dim))}
                 f_dic = {x: batch_data, lr_val: learning_rate}
                 f_dic.update(ftrain)
                 train_step_VARPSOM.run(feed_dict=f_dic)
                 batch_val, _, ii = next(val_gen)
-                fval = {p: ppv[ii * batch_size: (ii + 1) * batch_size], is_training: True,
+                fval = {p: ppv[ii], is_training: True,
                             z: np.zeros((batch_size, latent_dim))}
                 f_dic = {x: batch_val}
                 f_dic.update(fval)
@@ -336,6 +373,7 @@ def train_model(model, data_train, data_val, generator, lr_val, num_epochs, batc
 
                 pbar.set_postfix(epoch=epoch, train_loss=train_loss, test_loss=test_s, refresh=False)
                 pbar.update(1)
+            ttime_per_epoch.append(timeit.default_timer() - t_begin)
             saver.save(sess, modelpath)
 
             if val_epochs == True and epochs % 10 == 0:
@@ -344,6 +382,8 @@ def train_model(model, data_train, data_val, generator, lr_val, num_epochs, batc
                 if results is None:
                     return None
 
+        if ttime_per_epoch:
+            print("\nTraining steps/sec: {:.2f}".format(num_batches / np.mean(ttime_per_epoch)))
         saver.save(sess, modelpath)
         results = evaluate_model(model, generator, len_data_val, x, modelpath, epochs)
     return results
@@ -352,7 +392,7 @@ def train_model(model, data_train, data_val, generator, lr_val, num_epochs, batc
 @ex.capture
 def evaluate_model(model, generator, len_data_val, x, modelpath, epochs, batch_size, latent_dim, som_dim,
                    learning_rate, alpha, gamma, beta, theta, epochs_pretrain, decay_factor, ex_name, data_set,
-                   validation, dropout, prior_var, prior, convolution):
+                   validation, dropout, prior_var, prior, convolution, intra_op_threads, inter_op_threads, xla_jit):
 
     """Evaluates the performance of the trained model in terms of normalized
     mutual information adjusted mutual information score and purity.
@@ -381,6 +421,9 @@ def evaluate_model(model, generator, len_data_val, x, modelpath, epochs, batch_s
         prior_var (float): Multiplier of the diagonal variance of the VAE multivariate gaussian prior.
         prior (float): Weight of the regularization term of the ELBO.
         convolution (bool): Indicator if the model use convolutional layers (True) or feed-forward layers (False).
+        intra_op_threads (int): Number of threads used within an operation.
+        inter_op_threads (int): Number of operations run in parallel.
+        xla_jit (bool): If "True" clusters of operations are compiled with XLA.
 
     Returns:
         dict: Dictionary of evaluation results (NMI, AMI, Purity).
@@ -388,7 +431,7 @@ def evaluate_model(model, generator, len_data_val, x, modelpath, epochs, batch_s
     saver = tf.train.Saver()
     num_batches = len_data_val // batch_size
 
-    with tf.Session() as sess:
+    with tf.Session(config=session_config(intra_op_threads, inter_op_threads, xla_jit)) as sess:
         sess.run(tf.global_variables_initializer())
         saver.restore(sess, modelpath)
         graph = tf.get_default_graph()
@@ -411,9 +454,10 @@ def evaluate_model(model, generator, len_data_val, x, modelpath, epochs, batch_s
 
             test_k_all.extend(test_k)
 
-        test_nmi = metrics.normalized_mutual_info_score(np.array(labels_val_all), test_k_all)
-        test_purity = cluster_purity(np.array(test_k_all), np.array(labels_val_all))
-        test_ami = metrics.adjusted_mutual_info_score(test_k_all, labels_val_all)
+        scores = cluster_scores(np.array(test_k_all), np.array(labels_val_all))
+        test_nmi = scores["NMI"]
+        test_purity = scores["Purity"]
+        test_ami = scores["AMI"]
 
     results = {}
     results["NMI"] = test_nmi
@@ -447,7 +491,8 @@ def evaluate_model(model, generator, len_data_val, x, modelpath, epochs, batch_s
 
 @ex.automain
 def main(latent_dim, som_dim, learning_rate, decay_factor, alpha, beta, gamma, theta, ex_name, more_runs, data_set,
-         dropout, prior_var, convolution, prior, validation, epochs_pretrain, num_epochs, batch_size):
+         dropout, prior_var, convolution, prior, validation, epochs_pretrain, num_epochs, batch_size, toroidal,
+         compute_dtype):
     """Main method to build a model, train it and evaluate it.
     Returns:
         dict: Results of the evaluation (NMI, Purity).
@@ -464,7 +509,7 @@ def main(latent_dim, som_dim, learning_rate, decay_factor, alpha, beta, gamma, t
     model = DPSOM(latent_dim=latent_dim, som_dim=som_dim, learning_rate=lr_val, alpha=alpha,
                     decay_factor=decay_factor, input_length=input_length, input_channels=input_channels, beta=beta,
                     theta=theta, gamma=gamma, convolution=convolution, dropout=dropout, prior_var=prior_var,
-                    prior=prior)
+                    prior=prior, toroidal=toroidal, compute_dtype=compute_dtype)
 
     if data_set == "MNIST":
         mnist = tf.keras.datasets.mnist.load_data(path='mnist.npz')
@@ -3,6 +3,7 @@ Model architecture of the DPSOM model.
 """
 
 import functools
+import numpy as np
 
 try:
     import tensorflow.compat.v1 as tf 
@@ -14,6 +15,10 @@ import tensorflow_probability as tfp
 from tensorflow.keras.layers import Input,Dense,Flatten,Dropout,Reshape,Conv2D,MaxPooling2D,UpSampling2D,Conv2DTranspose
 from tensorflow.keras.layers import BatchNormalization
 
+from som_distance import squared_distances
+from som_topology import SOMTopology
+
+
 def lazy_scope(function):
     """Creates a decorator for methods that makes their return values load lazily.
     
@@ -43,7 +48,7 @@ class DPSOM:
 
     def __init__(self, latent_dim=100, som_dim=[8,8], learning_rate=1e-4, decay_factor=0.99, decay_steps=1000,
                  input_length=28, input_channels=28, alpha=10., beta=20., gamma=20., theta=1., dropout=0.5, prior_var=1,
-                 prior=0.5, convolution=False):
+                 prior=0.5, convolution=False, toroidal=True, compute_dtype="float32"):
         """Initialization method for the DPSOM model object.
         Args:
             latent_dim (int): The dimensionality of the latent embeddings (default: 100).
@@ -63,9 +68,15 @@ class DPSOM:
             prior (float): Weight of the regularization term of the ELBO (default: 0.5).
             convolution (bool): Indicator if the model use convolutional layers (True) or feed-forward layers (False)
                                 (default: False).
+            toroidal (bool): Indicator if the SOM grid wraps around at its borders (default: True).
+            compute_dtype (str): Type of the computations of the hidden layers of the encoder and the decoder,
+                "bfloat16" or "float16" run them in mixed precision with float32 variables, while the
+                distributions and the SOM embeddings stay in float32 (default: "float32").
         """
+        assert compute_dtype in ["float32", "bfloat16", "float16"], "Unknown compute_dtype {}".format(compute_dtype)
         self.latent_dim = latent_dim
         self.som_dim = som_dim
+        self.topology = SOMTopology(som_dim, toroidal=toroidal)
         self.learning_rate = learning_rate
         self.decay_factor = decay_factor
         self.decay_steps = decay_steps
@@ -79,6 +90,8 @@ class DPSOM:
         self.prior_var = prior_var
         self.prior = prior
         self.convolution = convolution
+        self.compute_dtype = compute_dtype
+        self.hidden_dtype = None if compute_dtype == "float32" else "mixed_{}".format(compute_dtype)
         self.is_training
         self.input_dim
         self.inputs
@@ -144,32 +157,37 @@ class DPSOM:
         with tf.variable_scope("encoder"):
             if not self.convolution:
                 inputs = tf.reshape(self.inputs, (-1, self.input_dim))
-                dense1 = tf.keras.layers.Dense(500, activation=tf.nn.leaky_relu)(inputs)
-                dense1 = tf.keras.layers.Dropout(rate=self.dropout)(dense1)
-                dense1 = BatchNormalization()(dense1)
-                dense2 = tf.keras.layers.Dense(500, activation=tf.nn.leaky_relu)(dense1)
-                dense2 = tf.keras.layers.Dropout(rate=self.dropout)(dense2)
-                dense2 = BatchNormalization()(dense2)
-                dense3 = tf.keras.layers.Dense(2000, activation=tf.nn.leaky_relu)(dense2)
-                dense3 = tf.keras.layers.Dropout(rate=self.dropout)(dense3)
-                flattened = BatchNormalization()(dense3)
+                dense1 = tf.keras.layers.Dense(500, activation=tf.nn.leaky_relu, dtype=self.hidden_dtype)(inputs)
+                dense1 = tf.keras.layers.Dropout(rate=self.dropout, dtype=self.hidden_dtype)(dense1)
+                dense1 = BatchNormalization(dtype=self.hidden_dtype)(dense1)
+                dense2 = tf.keras.layers.Dense(500, activation=tf.nn.leaky_relu, dtype=self.hidden_dtype)(dense1)
+                dense2 = tf.keras.layers.Dropout(rate=self.dropout, dtype=self.hidden_dtype)(dense2)
+                dense2 = BatchNormalization(dtype=self.hidden_dtype)(dense2)
+                dense3 = tf.keras.layers.Dense(2000, activation=tf.nn.leaky_relu, dtype=self.hidden_dtype)(dense2)
+                dense3 = tf.keras.layers.Dropout(rate=self.dropout, dtype=self.hidden_dtype)(dense3)
+                flattened = BatchNormalization(dtype=self.hidden_dtype)(dense3)
             else:
-                inputs = tf.cast(self.inputs, tf.float32) - 0.5
-                conv1 = Conv2D(32, (3, 3), activation=tf.nn.leaky_relu, padding='same')(inputs)  # 28 x 28 x 32
-                conv1 = BatchNormalization()(conv1)
-                pool1 = MaxPooling2D(pool_size=(2, 2))(conv1)
-                conv2 = Conv2D(64, (3, 3), activation=tf.nn.leaky_relu, padding='same')(pool1)  # 14 x 14 x 64
-                conv2 = BatchNormalization()(conv2)
-                pool2 = MaxPooling2D(pool_size=(2, 2))(conv2)
-                conv3 = Conv2D(128, (3, 3), activation=tf.nn.leaky_relu, padding='same')(
+                # The convolutions do not cast their inputs to the type of their computations
+                inputs = tf.cast(self.inputs, self.compute_dtype) - 0.5
+                conv1 = Conv2D(32, (3, 3), activation=tf.nn.leaky_relu, padding='same',
+                               dtype=self.hidden_dtype)(inputs)  # 28 x 28 x 32
+                conv1 = BatchNormalization(dtype=self.hidden_dtype)(conv1)
+                pool1 = MaxPooling2D(pool_size=(2, 2), dtype=self.hidden_dtype)(conv1)
+                conv2 = Conv2D(64, (3, 3), activation=tf.nn.leaky_relu, padding='same',
+                               dtype=self.hidden_dtype)(pool1)  # 14 x 14 x 64
+                conv2 = BatchNormalization(dtype=self.hidden_dtype)(conv2)
+                pool2 = MaxPooling2D(pool_size=(2, 2), dtype=self.hidden_dtype)(conv2)
+                conv3 = Conv2D(128, (3, 3), activation=tf.nn.leaky_relu, padding='same', dtype=self.hidden_dtype)(
                     pool2)
-                conv3 = BatchNormalization()(conv3)
-                conv4 = Conv2D(256, (3, 3), activation=tf.nn.leaky_relu, padding='same')(
+                conv3 = BatchNormalization(dtype=self.hidden_dtype)(conv3)
+                conv4 = Conv2D(256, (3, 3), activation=tf.nn.leaky_relu, padding='same', dtype=self.hidden_dtype)(
                     conv3)
-                conv4 = BatchNormalization()(conv4)
+                conv4 = BatchNormalization(dtype=self.hidden_dtype)(conv4)
                 flattened = tf.reshape(conv4, [-1, 7 * 7 * 256])
 
-            z_e = Dense(tfp.layers.MultivariateNormalTriL.params_size(self.latent_dim), activation=None)(flattened)
+            # The parameters of the distribution are computed in float32
+            z_e = Dense(tfp.layers.MultivariateNormalTriL.params_size(self.latent_dim), activation=None,
+                        dtype="float32")(flattened)
             z_e = tfp.layers.MultivariateNormalTriL(self.latent_dim)(z_e)
         return z_e
 
@@ -182,19 +200,14 @@ class DPSOM:
     @lazy_scope
     def z_dist_flat(self):
         """Computes the distances between the centroids and the embeddings."""
-        z_dist = tf.squared_difference(tf.expand_dims(tf.expand_dims(self.sample_z_e, 1), 1), tf.expand_dims(self.embeddings, 0))
-        z_dist_red = tf.reduce_sum(z_dist, axis=-1)
-        z_dist_flat = tf.reshape(z_dist_red, [-1, self.som_dim[0] * self.som_dim[1]])
+        z_dist_flat = squared_distances(self.sample_z_e, self.embeddings)
         return z_dist_flat
 
     @lazy_scope
     def z_dist_flat_ng(self):
         """Computes the distances between the centroids and the embeddings stopping the gradient of the latent
         embeddings."""
-        z_dist = tf.squared_difference(tf.expand_dims(tf.expand_dims(tf.stop_gradient(self.sample_z_e), 1), 1),
-                                       tf.expand_dims(self.embeddings, 0))
-        z_dist_red = tf.reduce_sum(z_dist, axis=-1)  # 1,32,8,8
-        z_dist_flat = tf.reshape(z_dist_red, [-1, self.som_dim[0] * self.som_dim[1]])  # 1,32,64
+        z_dist_flat = squared_distances(tf.stop_gradient(self.sample_z_e), self.embeddings)
         return z_dist_flat
 
     @lazy_scope
@@ -215,30 +228,21 @@ class DPSOM:
     @lazy_scope
     def z_q_neighbors(self):
         """Aggregates the respective neighbors in the SOM grid for every z_q."""
-        k_1 = self.k // self.som_dim[0]
-        k_2 = self.k % self.som_dim[1]
-        k_stacked = tf.stack([k_1, k_2], axis=1)
-
-        k1_not_top = tf.less(k_1, tf.constant(self.som_dim[0]-1, dtype=tf.int64))
-        k1_not_bottom = tf.greater(k_1, tf.constant(0, dtype=tf.int64))
-        k2_not_right = tf.less(k_2, tf.constant(self.som_dim[1]-1, dtype=tf.int64))
-        k2_not_left = tf.greater(k_2, tf.constant(0, dtype=tf.int64))
-
-        k1_up = tf.where(k1_not_top, tf.add(k_1, 1), tf.zeros(tf.shape(k_1), dtype=tf.dtypes.int64))
-        k1_down = tf.where(k1_not_bottom, tf.subtract(k_1, 1),
-                           tf.ones(tf.shape(k_1), dtype=tf.dtypes.int64) * (self.som_dim[0] - 1))
-        k2_right = tf.where(k2_not_right, tf.add(k_2, 1), tf.zeros(tf.shape(k_2), dtype=tf.dtypes.int64))
-        k2_left = tf.where(k2_not_left, tf.subtract(k_2, 1),
-                           tf.ones(tf.shape(k_2), dtype=tf.dtypes.int64) * (self.som_dim[0] - 1))
-
-        z_q_up = tf.gather_nd(self.embeddings, tf.stack([k1_up, k_2], axis=1))
-        z_q_down = tf.gather_nd(self.embeddings, tf.stack([k1_down, k_2], axis=1))
-        z_q_right = tf.gather_nd(self.embeddings, tf.stack([k_1, k2_right], axis=1))
-        z_q_left = tf.gather_nd(self.embeddings, tf.stack([k_1, k2_left], axis=1))
-        z_q_neighbors = tf.stack([self.z_q, z_q_up, z_q_down, z_q_right, z_q_left], axis=1)
-
+        neighbours = tf.gather(tf.constant(self.topology.neighbours, dtype=tf.int64), self.k)
+        embeddings = tf.reshape(self.embeddings, [self.som_dim[0] * self.som_dim[1], self.latent_dim])
+        z_q_neighbors = tf.concat([tf.expand_dims(self.z_q, 1), tf.gather(embeddings, neighbours)], axis=1)
         return z_q_neighbors
 
+    def neighbours_mean(self, sq_diff):
+        """Mean of the squared differences [batch_size, 1 + n_neighbours, latent_dim] between the embeddings and
+        z_q_neighbors, over the neighbours that exist on the grid. Without wrap-around the missing neighbours of the
+        border nodes point to the node itself and are left out, instead of counting its centroid several times."""
+        if self.topology.complete:
+            return tf.reduce_mean(sq_diff)
+        mask = tf.gather(tf.constant(self.topology.mask), self.k)
+        mask = tf.concat([tf.ones_like(mask[:, :1]), mask], axis=1)
+        return tf.reduce_sum(sq_diff * tf.expand_dims(mask, -1)) / (tf.reduce_sum(mask) * self.latent_dim)
+
     @lazy_scope
     def reconstruction_e(self):
         """Reconstructs the input from the encodings by learning a Bernoulli distribution."""
@@ -247,27 +251,31 @@ class DPSOM:
             z_e = tf.cond(self.is_training, lambda: self.z_e, lambda: z_p)
             if not self.convolution:
                 flat_size = 2000
-                dense4 = tf.keras.layers.Dense(flat_size, activation=tf.nn.leaky_relu)(z_e)
-                dense4 = BatchNormalization()(dense4)
-                dense3 = tf.keras.layers.Dense(500, activation=tf.nn.leaky_relu)(dense4)
-                dense3 = BatchNormalization()(dense3)
-                dense2 = tf.keras.layers.Dense(500, activation=tf.nn.leaky_relu)(dense3)
-                dense1 = BatchNormalization()(dense2)
-                x_hat = tf.keras.layers.Dense(self.input_dim, activation=tf.nn.leaky_relu)(dense1)
+                dense4 = tf.keras.layers.Dense(flat_size, activation=tf.nn.leaky_relu, dtype=self.hidden_dtype)(z_e)
+                dense4 = BatchNormalization(dtype=self.hidden_dtype)(dense4)
+                dense3 = tf.keras.layers.Dense(500, activation=tf.nn.leaky_relu, dtype=self.hidden_dtype)(dense4)
+                dense3 = BatchNormalization(dtype=self.hidden_dtype)(dense3)
+                dense2 = tf.keras.layers.Dense(500, activation=tf.nn.leaky_relu, dtype=self.hidden_dtype)(dense3)
+                dense1 = BatchNormalization(dtype=self.hidden_dtype)(dense2)
+                x_hat = tf.keras.layers.Dense(self.input_dim, activation=tf.nn.leaky_relu, dtype="float32")(dense1)
             else:
                 flat_size = 7 * 7 * 256
-                dense3 = tf.keras.layers.Dense(flat_size, activation=tf.nn.leaky_relu)(z_e)
+                dense3 = tf.keras.layers.Dense(flat_size, activation=tf.nn.leaky_relu, dtype=self.hidden_dtype)(z_e)
                 h_reshaped = tf.reshape(dense3, [-1, 7, 7, 256])
-                conv5 = Conv2DTranspose(128, (3, 3), activation=tf.nn.leaky_relu, padding='same')(
+                conv5 = Conv2DTranspose(128, (3, 3), activation=tf.nn.leaky_relu, padding='same',
+                                        dtype=self.hidden_dtype)(
                     h_reshaped)  # 7 x 7 x 128
-                conv5 = BatchNormalization()(conv5)
-                conv6 = Conv2DTranspose(64, (3, 3), activation=tf.nn.leaky_relu, padding='same')(conv5)  # 7 x 7 x 64
-                conv6 = BatchNormalization()(conv6)
-                up1 = UpSampling2D((2, 2))(conv6)  # 14 x 14 x 64
-                conv7 = Conv2DTranspose(32, (3, 3), activation=tf.nn.leaky_relu, padding='same')(up1)  # 14 x 14 x 32
-                conv7 = BatchNormalization()(conv7)
-                up2 = UpSampling2D((2, 2))(conv7)  # 28 x 28 x 32
-                x_hat = Conv2D(1, (3, 3), activation=None, padding='same')(up2)  # 28 x 28 x 1
+                conv5 = BatchNormalization(dtype=self.hidden_dtype)(conv5)
+                conv6 = Conv2DTranspose(64, (3, 3), activation=tf.nn.leaky_relu, padding='same',
+                                        dtype=self.hidden_dtype)(conv5)  # 7 x 7 x 64
+                conv6 = BatchNormalization(dtype=self.hidden_dtype)(conv6)
+                up1 = UpSampling2D((2, 2), dtype=self.hidden_dtype)(conv6)  # 14 x 14 x 64
+                conv7 = Conv2DTranspose(32, (3, 3), activation=tf.nn.leaky_relu, padding='same',
+                                        dtype=self.hidden_dtype)(up1)  # 14 x 14 x 32
+                conv7 = BatchNormalization(dtype=self.hidden_dtype)(conv7)
+                up2 = UpSampling2D((2, 2), dtype=self.hidden_dtype)(conv7)  # 28 x 28 x 32
+                x_hat = Conv2D(1, (3, 3), activation=None, padding='same',
+                               dtype="float32")(tf.cast(up2, tf.float32))  # 28 x 28 x 1
                 x_hat = tf.reshape(x_hat, [-1, 28 * 28])
             x_hat = tfp.layers.IndependentBernoulli([28, 28, 1], tfp.distributions.Bernoulli.logits)(x_hat)
             x_hat_sampled = tf.identity(x_hat, name="x_hat")
@@ -325,34 +333,11 @@ class DPSOM:
     @lazy_scope
     def loss_som(self):
         """Computes the SOM loss."""
-        k = tf.range(self.som_dim[0] * self.som_dim[1])
-        k_1 = k // self.som_dim[0]
-        k_2 = k % self.som_dim[1]
-
-        k1_not_top = tf.less(k_1, tf.constant(self.som_dim[0] - 1, dtype=tf.int32))
-        k1_not_bottom = tf.greater(k_1, tf.constant(0, dtype=tf.int32))
-        k2_not_right = tf.less(k_2, tf.constant(self.som_dim[1] - 1, dtype=tf.int32))
-        k2_not_left = tf.greater(k_2, tf.constant(0, dtype=tf.int32))
-
-        k1_up = tf.where(k1_not_top, tf.add(k_1, 1), tf.zeros(tf.shape(k_1), dtype=tf.dtypes.int32))
-        k1_down = tf.where(k1_not_bottom, tf.subtract(k_1, 1),
-                           tf.ones(tf.shape(k_1), dtype=tf.dtypes.int32) * (self.som_dim[0] - 1))
-        k2_right = tf.where(k2_not_right, tf.add(k_2, 1), tf.zeros(tf.shape(k_2), dtype=tf.dtypes.int32))
-        k2_left = tf.where(k2_not_left, tf.subtract(k_2, 1),
-                           tf.ones(tf.shape(k_2), dtype=tf.dtypes.int32) * (self.som_dim[0] - 1))
-
-        k_up = k1_up * self.som_dim[0] + k_2
-        k_down = k1_down * self.som_dim[0] + k_2
-        k_right = k_1 * self.som_dim[0] + k2_right
-        k_left = k_1 * self.som_dim[0] + k2_left
-
-        q_t = tf.transpose(self.q_ng)
-        q_up = tf.transpose(tf.gather_nd(q_t, tf.reshape(k_up, [self.som_dim[0] * self.som_dim[1], 1])))
-        q_down = tf.transpose(tf.gather_nd(q_t, tf.reshape(k_down, [self.som_dim[0] * self.som_dim[1], 1])))
-        q_right = tf.transpose(tf.gather_nd(q_t, tf.reshape(k_right, [self.som_dim[0] * self.som_dim[1], 1])))
-        q_left = tf.transpose(tf.gather_nd(q_t, tf.reshape(k_left, [self.som_dim[0] * self.som_dim[1], 1])))
-        q_neighbours = tf.stack([q_up, q_down, q_right, q_left], axis=2)
-        q_neighbours = tf.reduce_sum(tf.math.log(q_neighbours), axis=-1)
+        log_q_neighbours = tf.gather(tf.math.log(self.q_ng), np.reshape(self.topology.neighbours, [-1]), axis=1)
+        log_q_neighbours = tf.reshape(log_q_neighbours, [-1, self.topology.n_nodes, self.topology.n_neighbours])
+        if not self.topology.complete:
+            log_q_neighbours = log_q_neighbours * self.topology.mask
+        q_neighbours = tf.reduce_sum(log_q_neighbours, axis=-1)
         maxx = 0.1
         mask = tf.greater_equal(self.q, maxx * tf.ones_like(self.q))
         new_q = tf.multiply(self.q, tf.cast(mask, tf.float32))
@@ -381,7 +366,8 @@ class DPSOM:
     @lazy_scope
     def loss_som_s(self):
         """Computes the SOM loss of standard SOM for initialization."""
-        loss_som = tf.reduce_mean(tf.squared_difference(tf.expand_dims(tf.stop_gradient(self.sample_z_e), axis=1), self.z_q_neighbors))
+        sq_diff = tf.squared_difference(tf.expand_dims(tf.stop_gradient(self.sample_z_e), axis=1), self.z_q_neighbors)
+        loss_som = self.neighbours_mean(sq_diff)
         tf.summary.scalar("loss_som_s", loss_som)
         return loss_som
 
@@ -396,6 +382,9 @@ class DPSOM:
         """Optimizes the model's loss using Adam with exponential learning rate decay."""
         lr_decay = tf.train.exponential_decay(self.learning_rate, self.global_step, self.decay_steps, self.decay_factor, staircase=True)
         optimizer = tf.train.AdamOptimizer(lr_decay)
+        if self.compute_dtype == "float16":
+            # Dynamic loss scaling keeps the small float16 gradients of the hidden layers from underflowing
+            optimizer = tf.train.experimental.MixedPrecisionLossScaleOptimizer(optimizer, "dynamic")
         train_step = optimizer.minimize(self.loss, global_step=self.global_step)
         train_step_ae = optimizer.minimize(self.loss_reconstruction_ze, global_step=self.global_step)
         train_step_som = optimizer.minimize(self.loss_a, global_step=self.global_step)
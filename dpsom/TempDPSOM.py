@@ -2,6 +2,7 @@
 Script for training the TempDPSOM model
 """
 
+import itertools
 import uuid
 import sys
 import timeit
@@ -18,10 +19,10 @@ from tqdm import tqdm
 import sacred
 from sacred.stflow import LogFileWriter
 import math
-import h5py
-from sklearn import metrics
 from TempDPSOM_model import TDPSOM
-from sklearn.model_selection import train_test_split
+from cluster_metrics import cluster_scores, cluster_label_stats
+from eicu_data import get_data_split
+from utils import prefetch_generator, epoch_permutation, TargetDistribution, extract_outputs, session_config
 
 ex = sacred.Experiment("hyperopt")
 ex.observers.append(sacred.observers.FileStorageObserver.create("../sacred_runs_eICU"))
@@ -50,17 +51,34 @@ def ex_config():
             logdir (path): Directory for the experiment logs.
             modelpath (path): Path for the model checkpoints.
             validation (bool): If "True" validation set is used for evaluation, otherwise test set is used.
+            data_path (path): HDF5 file of the eICU data-set, or directory of its memory-mapped arrays.
             dropout (float): Dropout factor for the feed-forward layers of the VAE.
             prior (float): Weight of the regularization term of the ELBO.
             val_epochs (bool): If "True" clustering results are saved every 10 epochs on default output files.
             more_runs (bool): Indicator whether to run the job once (False) or multiple times (True) outputting mean and
                               variance.
-        """
+            shuffle (bool): If "True" the training batches are drawn in a new random order every epoch.
+            prefetch (int): Number of batches prepared in a background thread during the training steps, 0 prepares
+                            them synchronously.
+            q_chunk_size (int): Number of time series for which the soft assignments are computed at a time, when
+                                refreshing the target distribution.
+            target_refresh_steps (int): Number of training steps after which the target distribution is refreshed,
+                                        0 refreshes it at the start of every epoch.
+            toroidal (bool): If "True" the SOM grid wraps around at its borders, otherwise nodes at the border
+                             have fewer neighbours.
+            intra_op_threads (int): Number of threads used within an operation, 0 lets TensorFlow choose.
+            inter_op_threads (int): Number of operations run in parallel, 0 lets TensorFlow choose.
+            xla_jit (bool): If "True" clusters of operations are compiled with XLA.
+            compute_dtype (str): Type of the computations of the hidden layers of the encoder and the decoder, in
+                                 ['float32', 'bfloat16', 'float16'], the variables stay in float32.
+                                 float16 is slow on CPUs, which should use bfloat16.
+    """
     input_size = 98
     num_epochs = 100
     batch_size = 300
     latent_dim = 20
     som_dim = [16,16]
+    toroidal = True
     learning_rate = 0.001
     alpha = 10.
     beta = 10.
@@ -76,6 +94,7 @@ def ex_config():
     logdir = "../logs/{}".format(ex_name)
     modelpath = "../models/{}/{}".format(ex_name, ex_name)
     validation = False
+    data_path = "../data/eICU_data.csv"
     dropout = 0.5
     prior = 0.00001
     val_epochs = False
@@ -83,35 +102,34 @@ def ex_config():
     save_pretrain = False
     use_saved_pretrain = False
     
+    shuffle = False
+    prefetch = 0
+    q_chunk_size = 1000
+    target_refresh_steps = 0
+
+    intra_op_threads = 0
+    inter_op_threads = 0
+    xla_jit = False
+    compute_dtype = "float32"
+
     benchmark=False # Benchmark train time per epoch and return
     train_ratio=1.0 # If changed, use a subset of the training data
 
 @ex.capture
-def get_data(validation):
-    """Load the saved data and split into training, validation and test set.
+def get_data(validation, data_path):
+    """Open the saved data and split into training, validation and test set. The sets are index
+        arrays into the data on disk, minibatches are read from it when they are accessed.
         Args:
             validation (bool): If "True" validation set is used for evaluation, otherwise test set is used.
+            data_path (path): HDF5 file of the eICU data-set, or directory of its memory-mapped arrays.
         Yields:
-            np.array: Training data.
-            np.array: Val/test data depending on validation value.
-            np.array: Training labels.
-            np.array: Val/test data depending on validation value.
-            np.array: Val/test labels."""
+            IndexedArray: Training data.
+            IndexedArray: Val/test data depending on validation value.
+            IndexedArray: Training labels.
+            IndexedArray: Val/test labels."""
 
     #TO DOWNLOAD THE DATA FIRST
-    hf = h5py.File('../data/eICU_data.csv', 'r')
-    #############################################
-    data_total = np.array(hf.get('x'))
-    endpoints_total = np.array(hf.get('y'))
-    hf.close()
-    data_train, data_val, y_train, endpoints_total_val = train_test_split(data_total[:int(len(data_total) * 0.85)],
-                                                                          endpoints_total[:int(len(data_total) * 0.85)],
-                                                                          test_size=0.20,
-                                                                          random_state=42)
-    if not validation:
-        data_val = data_total[int(len(data_total) * 0.85):]
-        endpoints_total_val = endpoints_total[int(len(data_total) * 0.85):]
-    return data_train, data_val, y_train, endpoints_total_val
+    return get_data_split(data_path, validation)
 
 
 def get_normalized_data(data, patientid, mins, scales):
@@ -119,45 +137,58 @@ def get_normalized_data(data, patientid, mins, scales):
             scales).drop(["patientunitstayid", "ts"], axis=1).fillna(0).values
 
 
+def time_step_rows(positions, max_n_step=72):
+    """Rows of the flattened time steps of the time series at the given positions, e.g. to select their
+        target distribution."""
+    return (np.reshape(positions, (-1, 1)) * max_n_step + np.arange(max_n_step)).reshape(-1)
+
+
 @ex.capture
-def batch_generator(data_train, data_val, endpoints_total_val, batch_size, mode="train"):
+def batch_generator(data_train, data_val, endpoints_total_val, batch_size, shuffle, seed, mode="train"):
     """Generator for the data batches.
         Args:
             data_train: training set.
             data_val: validation/test set.
             labels_val: labels of the validation set.
             batch_size (int): Batch size for the training.
+            shuffle (bool): If "True" the training batches are drawn in a new random order every epoch.
+            seed (int): Seed for the shuffling.
             mode (str): Mode in ['train', 'val', 'test'] that decides which data set the generator
                 samples from (default: 'train').
         Yields:
             np.array: Data batch.
             np.array: Labels batch.
-            int: Offset of the batch in dataset.
+            np.array: Positions of the batch in dataset.
     """
+    rnd = np.random.RandomState(seed)
     while True:
         if mode == "train":
+            order = epoch_permutation(len(data_train), shuffle, rnd)
             for i in range(len(data_train) // batch_size):
-                time_series = data_train[i * batch_size: (i + 1) * batch_size]
-                yield time_series, i
+                positions = order[i * batch_size: (i + 1) * batch_size]
+                time_series = data_train[positions]
+                yield time_series, positions
         elif mode == "val":
             for i in range(len(data_val) // batch_size):
-                time_series = data_val[i * batch_size: (i + 1) * batch_size]
-                time_series_endpoint = endpoints_total_val[i * batch_size: (i + 1) * batch_size]
-                yield time_series, time_series_endpoint, i
+                positions = np.arange(i * batch_size, (i + 1) * batch_size)
+                time_series = data_val[positions]
+                time_series_endpoint = endpoints_total_val[positions]
+                yield time_series, time_series_endpoint, positions
         else:
             raise ValueError("The mode has to be in {train, val}")
 
 
 @ex.capture
 def train_model(model, data_train, data_val, endpoints_total_val, lr_val, num_epochs, batch_size, latent_dim, som_dim,
-                learning_rate, epochs_pretrain, ex_name, logdir, modelpath, val_epochs, save_pretrain, use_saved_pretrain, benchmark, train_ratio):
+                learning_rate, epochs_pretrain, ex_name, logdir, modelpath, val_epochs, save_pretrain, use_saved_pretrain, benchmark, train_ratio,
+                prefetch, q_chunk_size, target_refresh_steps, intra_op_threads, inter_op_threads, xla_jit):
 
     """Trains the T-DPSOM model.
         Params:
             model (T-DPSOM): T-DPSOM model to train.
-            data_train (np.array): Training set.
-            data_val (np.array): Validation/test set.
-            endpoints_total_val (np.array): Validation/test labels.
+            data_train (IndexedArray): Training set.
+            data_val (IndexedArray): Validation/test set.
+            endpoints_total_val (IndexedArray): Validation/test labels.
             lr_val (tf.Tensor): Placeholder for the learning rate value.
             num_epochs (int): Number of training epochs.
             batch_size (int): Batch size for the training.
@@ -169,6 +200,13 @@ def train_model(model, data_train, data_val, endpoints_total_val, lr_val, num_ep
             logdir (path): Directory for the experiment logs.
             modelpath (path): Path for the model checkpoints.
             val_epochs (bool): If "True" clustering results are saved every 10 epochs on default output files.
+            prefetch (int): Number of batches prepared in a background thread during the training steps.
+            q_chunk_size (int): Number of time series for which the soft assignments are computed at a time.
+            target_refresh_steps (int): Number of training steps after which the target distribution is refreshed,
+                                        0 refreshes it at the start of every epoch.
+            intra_op_threads (int): Number of threads used within an operation.
+            inter_op_threads (int): Number of operations run in parallel.
+            xla_jit (bool): If "True" clusters of operations are compiled with XLA.
         """
 
     max_n_step = 72
@@ -178,12 +216,12 @@ def train_model(model, data_train, data_val, endpoints_total_val, lr_val, num_ep
     len_data_train = len(data_train)
     len_data_val = len(data_val)
     num_batches = len_data_train // batch_size
-    train_gen = batch_generator(data_train, data_val, endpoints_total_val, mode="train")
-    val_gen = batch_generator(data_train, data_val, endpoints_total_val, mode="val")
+    train_gen = prefetch_generator(batch_generator(data_train, data_val, endpoints_total_val, mode="train"), prefetch)
+    val_gen = prefetch_generator(batch_generator(data_train, data_val, endpoints_total_val, mode="val"), prefetch)
 
     saver = tf.train.Saver(max_to_keep=50)
     summaries = tf.summary.merge_all()
-    with tf.Session() as sess:
+    with tf.Session(config=session_config(intra_op_threads, inter_op_threads, xla_jit)) as sess:
         sess.run(tf.global_variables_initializer())
         test_losses = []
         test_losses_mean = []
@@ -334,6 +372,12 @@ def train_model(model, data_train, data_val, endpoints_total_val, lr_val, num_ep
                 saver.save(sess, pretrainpath)
 
         print("\n\nTraining...\n")
+        q_fn = lambda data_chunk: sess.run(model.q, feed_dict={x: data_chunk})
+        ppt = TargetDistribution(q_fn, data_train, som_dim[0] * som_dim[1], chunk_size=q_chunk_size,
+                                 rows_per_item=max_n_step)
+        ppv = TargetDistribution(q_fn, data_val, som_dim[0] * som_dim[1], chunk_size=q_chunk_size,
+                                 rows_per_item=max_n_step)
+        refresh_steps = target_refresh_steps if target_refresh_steps > 0 else num_batches
 
         if benchmark:
             t_begin_all=timeit.default_timer()
@@ -343,29 +387,14 @@ def train_model(model, data_train, data_val, endpoints_total_val, lr_val, num_ep
                 t_begin=timeit.default_timer()
             epochs += 1
             print(epochs)
-            f_dic = {x: data_train}
-            f_dic.update(training_dic)
-            q = []
-            for t in range(19):
-                q.extend(sess.run(model.q, feed_dict={
-                         x: data_train[int(len(data_train) / 20) * t: int(len(data_train) / 20) * (t + 1)]}))
-            q.extend(sess.run(model.q, feed_dict={x: data_train[int(len(data_train) / 20) * 19:]}))
-            q = np.array(q)
-            ppt = model.target_distribution(q)
-            q = []
-            f_dic = {x: data_val}
-            f_dic.update(training_dic)
-            for t in range(9):
-                q.extend(sess.run(model.q, feed_dict={
-                         x: data_val[int(len(data_val) / 10) * t: int(len(data_val) / 10) * (t + 1)]}))
-            q.extend(sess.run(model.q, feed_dict={x: data_val[int(len(data_val) / 10) * 9:]}))
-            q = np.array(q)
-            ppv = model.target_distribution(q)
 
             for i in range(num_batches):
+                if iterations % refresh_steps == 0:
+                    ppt.refresh()
+                    ppv.refresh()
                 iterations += 1
                 batch_data, ii = next(train_gen)
-                ftrain = {p: ppt[ii*batch_size*72: (ii + 1)*batch_size*72]}
+                ftrain = {p: ppt[time_step_rows(ii, max_n_step)]}
                 f_dic = {x: batch_data, lr_val: learning_rate}
                 f_dic.update(ftrain)
                 f_dic.update(training_dic)
@@ -373,7 +402,7 @@ def train_model(model, data_train, data_val, endpoints_total_val, lr_val, num_ep
                 train_step_prob.run(feed_dict=f_dic)
 
                 batch_val, _, ii = next(val_gen)
-                fval = {p: ppv[ii * batch_size*72: (ii + 1)*batch_size*72]}
+                fval = {p: ppv[time_step_rows(ii, max_n_step)]}
                 f_dic = {x: batch_val}
                 f_dic.update(fval)
                 f_dic.update(training_dic)
@@ -455,12 +484,16 @@ def train_model(model, data_train, data_val, endpoints_total_val, lr_val, num_ep
             print("\nNumber of time series in train: {} %, {}".format(train_ratio, len(data_train)))
             print("SOM init time: {:.3f}".format(ttime_som))
             print("SOM init time per epoch: {:.3f}".format(np.mean(ttime_som_per_epoch)))
+            print("SOM init steps/sec: {:.2f}".format(num_batches / np.mean(ttime_som_per_epoch)))
             print("AE pretrain time: {:.3f}".format(ttime_ae_pretrain))
             print("AE pretrain time per epoch: {:.3f}".format(np.mean(ttime_ae_per_epoch)))
+            print("AE pretrain steps/sec: {:.2f}".format(num_batches / np.mean(ttime_ae_per_epoch)))
             print("Training time: {:.3f}".format(ttime_training))
             print("Training time per epoch: {:.3f}".format(np.mean(ttime_per_epoch)))
+            print("Training steps/sec: {:.2f}".format(num_batches / np.mean(ttime_per_epoch)))
             print("Pred finetuning time: {:.3f}".format(ttime_pred))
             print("Pred finetuning time per epoch: {:.3f}".format(np.mean(ttime_pred_per_epoch)))
+            print("Pred finetuning steps/sec: {:.2f}".format(num_batches / np.mean(ttime_pred_per_epoch)))
             sys.exit(0)
 
         return results
@@ -468,7 +501,8 @@ def train_model(model, data_train, data_val, endpoints_total_val, lr_val, num_ep
 
 @ex.capture
 def evaluate_model(model, x, val_gen, len_data_val, modelpath, epochs, batch_size, som_dim, learning_rate, alpha, gamma,
-                   beta , theta, epochs_pretrain, ex_name, kappa, dropout, prior, latent_dim, eta):
+                   beta , theta, epochs_pretrain, ex_name, kappa, dropout, prior, latent_dim, eta, intra_op_threads,
+                   inter_op_threads, xla_jit):
     """Evaluates the performance of the trained model in terms of normalized
         mutual information adjusted mutual information score and purity.
 
@@ -493,6 +527,9 @@ def evaluate_model(model, x, val_gen, len_data_val, modelpath, epochs, batch_siz
             prior (float): Weight of the regularization term of the ELBO.
             latent_dim (int): Dimensionality of the T-DPSOM's latent space.
             eta (float): Weight for the prediction loss.
+            intra_op_threads (int): Number of threads used within an operation.
+            inter_op_threads (int): Number of operations run in parallel.
+            xla_jit (bool): If "True" clusters of operations are compiled with XLA.
 
         Returns:
             dict: Dictionary of evaluation results (NMI, AMI, Purity).
@@ -503,7 +540,7 @@ def evaluate_model(model, x, val_gen, len_data_val, modelpath, epochs, batch_siz
     saver = tf.train.Saver(keep_checkpoint_every_n_hours=2.)
     num_batches = len_data_val // batch_size
 
-    with tf.Session() as sess:
+    with tf.Session(config=session_config(intra_op_threads, inter_op_threads, xla_jit)) as sess:
         sess.run(tf.global_variables_initializer())
         saver.restore(sess, modelpath)
 
@@ -515,64 +552,38 @@ def evaluate_model(model, x, val_gen, len_data_val, modelpath, epochs, batch_siz
         training_dic = {is_training: True, z_e_p: np.zeros((max_n_step * batch_size, latent_dim)),
                         init_1: np.zeros((2, batch_size, 100)), z_e_rec: np.zeros((max_n_step * batch_size, latent_dim))}
 
-        test_k_all = []
-        labels_val_all = []
-        z_q_all = []
-        z_e_all = []
         print("Evaluation...")
 
-        for i in range(num_batches):
-            batch_data, batch_labels, ii = next(val_gen)
+        # All outputs of a batch are computed in one run, from the same sample of the embeddings
+        fetches = {"k": model.k, "z_q": model.z_q, "z_e": model.z_e_sample}
+
+        def run_batch(batch_data, batch_labels):
             f_dic = {x: batch_data}
             f_dic.update(training_dic)
-            test_k_all.extend(sess.run(model.k, feed_dict=f_dic))
-            labels_val_all.extend(batch_labels)
-            z_q_all.extend(sess.run(model.z_q, feed_dict=f_dic))
-            z_e_all.extend(sess.run(model.z_e_sample, feed_dict=f_dic))
-
-        labels_val_all = np.array(labels_val_all)
-        test_k_all = np.array(test_k_all)
-        labels_val_all = np.reshape(labels_val_all, (-1, labels_val_all.shape[-1]))
+            outputs = sess.run(fetches, feed_dict=f_dic)
+            outputs["labels"] = np.reshape(batch_labels, (-1, batch_labels.shape[-1]))
+            return outputs
+
+        outputs = extract_outputs(run_batch, itertools.islice(val_gen, num_batches), num_batches * batch_size)
+        test_k_all = outputs["k"]
+        labels_val_all = outputs["labels"]
         print("Mean: {:.3f}, Std: {:.3f}".format(np.mean(labels_val_all[:,3]), np.std(labels_val_all[:,3])))
-        NMI_24 = metrics.normalized_mutual_info_score(labels_val_all[:, 3], test_k_all)
-        NMI_12 = metrics.normalized_mutual_info_score(labels_val_all[:, 2], test_k_all)
-        NMI_6 = metrics.normalized_mutual_info_score(labels_val_all[:, 1], test_k_all)
-        NMI_1 = metrics.normalized_mutual_info_score(labels_val_all[:, 0], test_k_all)
-        AMI_1 = metrics.adjusted_mutual_info_score(test_k_all, labels_val_all[:, 0])
+        NMI_24 = cluster_scores(test_k_all, labels_val_all[:, 3], scores=["NMI"])["NMI"]
+        NMI_12 = cluster_scores(test_k_all, labels_val_all[:, 2], scores=["NMI"])["NMI"]
+        NMI_6 = cluster_scores(test_k_all, labels_val_all[:, 1], scores=["NMI"])["NMI"]
+        scores_1 = cluster_scores(test_k_all, labels_val_all[:, 0], scores=["NMI", "AMI"])
+        NMI_1 = scores_1["NMI"]
+        AMI_1 = scores_1["AMI"]
 
         mean = np.sum(labels_val_all[:, 0]) / len(labels_val_all[:, 0])
-        ones = np.ones((len(np.reshape(test_k_all, (-1)))))
-        clust_matr1 = np.zeros(som_dim[0] * som_dim[1])
-        labels = labels_val_all[:, 0]
-        for i in range(som_dim[0] * som_dim[1]):
-            dd = np.sum(ones[np.where(np.reshape(test_k_all, (-1)) == i)])
-            if dd == 0:
-                s1 = 0
-            else:
-                s1 = np.sum(labels[np.where(np.reshape(test_k_all, (-1)) == i)]) / np.sum(
-                    ones[np.where(np.reshape(test_k_all, (-1)) == i)])
-            clust_matr1[i] = s1
+        _, clust_matr1, _ = cluster_label_stats(test_k_all, labels_val_all[:, 0], som_dim[0] * som_dim[1],
+                                                empty_value=0)
 
         sd = som_dim[0]*som_dim[1]
-        k = np.arange(0, sd)
-        k1 = k // som_dim[0]
-        k2 = k % som_dim[1]
-        W = np.zeros((sd, sd))
-        for i in range(sd):
-            for j in range(sd):
-                d1 = np.abs((k1[i] - k1[j]))
-                d2 = np.abs((k2[i] - k2[j]))
-                d1 = min(som_dim[0] - d1, d1)
-                d2 = min(som_dim[1] - d2, d2)
-                W[i, j] = np.exp(-(d1 + d2))
-
-        M = 0
-        N_n = 0
-        for i in range(sd):
-            for j in range(sd):
-                M += (clust_matr1[i] - mean) * (clust_matr1[j] - mean) * W[i, j]
-        for i in range(sd):
-            N_n += (clust_matr1[i] - mean) ** 2
+        W = np.exp(-model.topology.grid_distances())
+        c = clust_matr1 - mean
+        M = c @ W @ c
+        N_n = np.sum(c ** 2)
         W_n = np.sum(W)
         I = M * sd / (N_n * W_n)
 
@@ -599,7 +610,7 @@ def evaluate_model(model, x, val_gen, len_data_val, modelpath, epochs, batch_siz
 
 @ex.automain
 def main(input_size, latent_dim, som_dim, learning_rate, decay_factor, alpha, beta, gamma, theta, ex_name, kappa, prior,
-         more_runs, dropout, eta, epochs_pretrain, batch_size, num_epochs, train_ratio):
+         more_runs, dropout, eta, epochs_pretrain, batch_size, num_epochs, train_ratio, toroidal, compute_dtype):
 
     input_channels = 98
 
@@ -607,12 +618,13 @@ def main(input_size, latent_dim, som_dim, learning_rate, decay_factor, alpha, be
 
     model = TDPSOM(input_size=input_size, latent_dim=latent_dim, som_dim=som_dim, learning_rate=lr_val,
                    decay_factor=decay_factor, dropout=dropout, input_channels=input_channels, alpha=alpha, beta=beta,
-                   eta=eta, kappa=kappa, theta=theta, gamma=gamma, prior=prior)
+                   eta=eta, kappa=kappa, theta=theta, gamma=gamma, prior=prior, toroidal=toroidal,
+                   compute_dtype=compute_dtype)
 
     data_train, data_val, _, endpoints_total_val = get_data()
 
     if train_ratio<1.0:
-        data_train=data_train[:int(len(data_train)*train_ratio)]
+        data_train=data_train.subset(slice(0, int(len(data_train)*train_ratio)))
 
     if not more_runs:
         results = train_model(model, data_train, data_val, endpoints_total_val, lr_val)
@@ -636,6 +648,7 @@ def main(input_size, latent_dim, som_dim, learning_rate, decay_factor, alpha, be
                         "epochs_pretrain=%d, epochs= %d, NOT WORKING !!\n"
                         % (som_dim[0], som_dim[1], latent_dim, batch_size, learning_rate,
                         theta, dropout, prior, kappa, gamma, beta, eta, epochs_pretrain, num_epochs))
+                    data_train.close()
                     return 0
             else:
                 NMI_24_all.append(results["NMI_24"])
@@ -668,4 +681,5 @@ def main(input_size, latent_dim, som_dim, learning_rate, decay_factor, alpha, be
                    MI_mean, MI_sd, ex_name))
         f.close()
 
+    data_train.close()
     return results
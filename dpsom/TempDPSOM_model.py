@@ -15,6 +15,9 @@ import tensorflow_probability as tfp
 from tensorflow.keras.layers import Input,Dense,Flatten,Dropout,Reshape,Conv2D,MaxPooling2D,UpSampling2D,Conv2DTranspose
 from tensorflow.keras.layers import BatchNormalization
 
+from som_distance import squared_distances
+from som_topology import SOMTopology
+
 
 def lazy_scope(function):
     """Creates a decorator for methods that makes their return values load lazily.
@@ -47,7 +50,7 @@ class TDPSOM:
 
     def __init__(self, input_size, latent_dim=10, som_dim=[8, 8], learning_rate=1e-4, decay_factor=0.99,
                  decay_steps=2000, input_channels=98, alpha=10., beta=100., gamma=100., kappa=0.,
-                 theta=1., eta=1., dropout=0.5, prior=0.001):
+                 theta=1., eta=1., dropout=0.5, prior=0.001, toroidal=True, compute_dtype="float32"):
 
         """Initialization method for the T-DPSOM model object.
         Args:
@@ -67,11 +70,17 @@ class TDPSOM:
             eta (float): Weight for the prediction loss (default: 1).
             dropout (float): Dropout factor for the feed-forward layers of the VAE (default: 0.5).
             prior (float): Weight of the regularization term of the ELBO (default: 0.5).
+            toroidal (bool): Indicator if the SOM grid wraps around at its borders (default: True).
+            compute_dtype (str): Type of the computations of the hidden layers of the encoder and the decoder,
+                "bfloat16" or "float16" run them in mixed precision with float32 variables, while the
+                distributions, the SOM embeddings and the LSTM prior stay in float32 (default: "float32").
         """
+        assert compute_dtype in ["float32", "bfloat16", "float16"], "Unknown compute_dtype {}".format(compute_dtype)
 
         self.input_size = input_size
         self.latent_dim = latent_dim
         self.som_dim = som_dim
+        self.topology = SOMTopology(som_dim, toroidal=toroidal)
         self.learning_rate = learning_rate
         self.decay_factor = decay_factor
         self.decay_steps = decay_steps
@@ -84,6 +93,8 @@ class TDPSOM:
         self.kappa = kappa
         self.dropout = dropout
         self.prior = prior
+        self.compute_dtype = compute_dtype
+        self.hidden_dtype = None if compute_dtype == "float32" else "mixed_{}".format(compute_dtype)
         self.is_training
         self.inputs
         self.x
@@ -100,6 +111,8 @@ class TDPSOM:
         self.z_q
         self.z_q_neighbors
         self.reconstruction_e
+        self.forecast
+        self.online_step
         self.loss_reconstruction_ze
         self.q
         self.p
@@ -156,16 +169,18 @@ class TDPSOM:
     def z_e(self):
         """Computes the distribution of probability of the latent embeddings."""
         with tf.variable_scope("encoder"):
-            h_1 = tf.keras.layers.Dense(500, activation=tf.nn.leaky_relu)(self.x)
-            h_1 = tf.keras.layers.Dropout(rate=self.dropout)(h_1)
-            h_1 = tf.keras.layers.BatchNormalization()(h_1)
-            h_1 = tf.keras.layers.Dense(500, activation=tf.nn.leaky_relu)(h_1)
-            h_1 = tf.keras.layers.Dropout(rate=self.dropout)(h_1)
-            h_1 = tf.keras.layers.BatchNormalization()(h_1)
-            h_2 = tf.keras.layers.Dense(2000, activation=tf.nn.leaky_relu)(h_1)
-            h_2 = tf.keras.layers.Dropout(rate=self.dropout)(h_2)
-            h_2 = tf.keras.layers.BatchNormalization()(h_2)
-            z_e = tf.keras.layers.Dense(tfp.layers.MultivariateNormalTriL.params_size(self.latent_dim),activation=None)(h_2)
+            h_1 = tf.keras.layers.Dense(500, activation=tf.nn.leaky_relu, dtype=self.hidden_dtype)(self.x)
+            h_1 = tf.keras.layers.Dropout(rate=self.dropout, dtype=self.hidden_dtype)(h_1)
+            h_1 = tf.keras.layers.BatchNormalization(dtype=self.hidden_dtype)(h_1)
+            h_1 = tf.keras.layers.Dense(500, activation=tf.nn.leaky_relu, dtype=self.hidden_dtype)(h_1)
+            h_1 = tf.keras.layers.Dropout(rate=self.dropout, dtype=self.hidden_dtype)(h_1)
+            h_1 = tf.keras.layers.BatchNormalization(dtype=self.hidden_dtype)(h_1)
+            h_2 = tf.keras.layers.Dense(2000, activation=tf.nn.leaky_relu, dtype=self.hidden_dtype)(h_1)
+            h_2 = tf.keras.layers.Dropout(rate=self.dropout, dtype=self.hidden_dtype)(h_2)
+            h_2 = tf.keras.layers.BatchNormalization(dtype=self.hidden_dtype)(h_2)
+            # The parameters of the distribution are computed in float32
+            z_e = tf.keras.layers.Dense(tfp.layers.MultivariateNormalTriL.params_size(self.latent_dim),activation=None,
+                                        dtype="float32")(h_2)
             z_e = tfp.layers.MultivariateNormalTriL(self.latent_dim)(z_e)
         return z_e
 
@@ -185,20 +200,14 @@ class TDPSOM:
     @lazy_scope
     def z_dist_flat(self):
         """Computes the distances between the centroids and the embeddings."""
-        z_dist = tf.squared_difference(tf.expand_dims(tf.expand_dims(self.z_e, 1), 1),
-                                       tf.expand_dims(self.embeddings, 0))
-        z_dist_red = tf.reduce_sum(z_dist, axis=-1)  # 1,32,8,8
-        z_dist_flat = tf.reshape(z_dist_red, [-1, self.som_dim[0] * self.som_dim[0]])  # 1,32,64
+        z_dist_flat = squared_distances(self.z_e, self.embeddings)
         return z_dist_flat
 
     @lazy_scope
     def z_dist_flat_ng(self):
         """Computes the distances between the centroids and the embeddings stopping the gradient of the latent
         embeddings."""
-        z_dist = tf.squared_difference(tf.expand_dims(tf.expand_dims(tf.stop_gradient(self.z_e), 1), 1),
-                                       tf.expand_dims(self.embeddings, 0))
-        z_dist_red = tf.reduce_sum(z_dist, axis=-1)  # 1,32,8,8
-        z_dist_flat = tf.reshape(z_dist_red, [-1, self.som_dim[0] * self.som_dim[1]])  # 1,32,64
+        z_dist_flat = squared_distances(tf.stop_gradient(self.z_e), self.embeddings)
         return z_dist_flat
 
     @lazy_scope
@@ -218,22 +227,113 @@ class TDPSOM:
             rnn_input = tf.stop_gradient(tf.reshape(z_e, [self.batch_size, self.step_size, self.latent_dim]))
             init_state_p = tf.placeholder(tf.float32, shape=[2, None, 100], name="init_state")
 
+            # The layers are kept to roll the prior forward in forecast
             cell = tf.keras.layers.CuDNNLSTM(100, return_sequences=True, return_state=True)
+            self.prediction_layers = [tf.keras.layers.Dense(100, activation=tf.nn.leaky_relu),
+                                      tf.keras.layers.Dense(tfp.layers.IndependentNormal.params_size(self.latent_dim),
+                                                            activation=None),
+                                      tfp.layers.IndependentNormal(self.latent_dim)]
+            self.prediction_cell = cell
             init_state = cell.get_initial_state(rnn_input)
             state = tf.cond(self.is_training, lambda: init_state, lambda: [init_state_p[0], init_state_p[1]])
             lstm_output, state_h, state_c = cell(rnn_input, initial_state=state)
             state = tf.identity([state_h, state_c], name="next_state")
             lstm_output = tf.reshape(lstm_output, [self.batch_size*self.step_size, 100])
 
-            h_1 = tf.keras.layers.Dense(100, activation=tf.nn.leaky_relu)(lstm_output)
-            next_z_e = tf.keras.layers.Dense(tfp.layers.IndependentNormal.params_size(self.latent_dim),
-                                            activation=None)(h_1)
-            next_z_e = tfp.layers.IndependentNormal(self.latent_dim)(next_z_e)
+            next_z_e = self._apply_layers(self.prediction_layers, lstm_output)
             #next_z_e = tf.keras.layers.Dense(self.latent_dim, activation=None)(h_1)
 
         next_z_e_sample = tf.reshape(tf.identity(next_z_e), [-1, self.step_size, self.latent_dim], name="next_z_e")
         return next_z_e
 
+    @lazy_scope
+    def forecast(self):
+        """Rolls the LSTM prior forward from the embeddings of the inputs for a number of future time steps, within
+        one graph execution. The number of steps is fed to the "horizon" placeholder (default: 6) and the
+        "sample" placeholder selects if the embeddings and the reconstructions are sampled from their
+        distributions, like the other tensors of the model, or set to their means (default: True).
+
+        Returns:
+            tuple: The predicted embeddings [batch_size, horizon, latent_dim], the indices of their closest
+                centroids [batch_size, horizon] and their reconstructions [batch_size, horizon, input_channels].
+        """
+        horizon = tf.placeholder_with_default(6, shape=[], name="horizon")
+        sample = tf.placeholder_with_default(True, shape=[], name="sample")
+        draw = lambda distribution: self._draw(distribution, sample)
+        embeddings = tf.reshape(self.embeddings, [self.som_dim[0] * self.som_dim[1], self.latent_dim])
+
+        # The LSTM is run over the encodings of the inputs, starting from the zero state
+        rnn_input = tf.reshape(draw(self.z_e), [self.batch_size, self.step_size, self.latent_dim])
+        lstm_output, state_h, state_c = self.prediction_cell(rnn_input)
+        z_next = draw(self._apply_layers(self.prediction_layers, lstm_output[:, -1]))
+
+        def step(t, z_next, state_h, state_c, z_e_array, k_array, x_array):
+            k = tf.argmin(squared_distances(z_next, embeddings), axis=-1)
+            x_hat = draw(self._apply_layers(self.decoder_layers, z_next))
+            lstm_output, state_h, state_c = self.prediction_cell(tf.expand_dims(z_next, 1),
+                                                                 initial_state=[state_h, state_c])
+            return (t + 1, draw(self._apply_layers(self.prediction_layers, lstm_output[:, -1])), state_h, state_c,
+                    z_e_array.write(t, z_next), k_array.write(t, k), x_array.write(t, x_hat))
+
+        arrays = [tf.TensorArray(dtype, size=horizon) for dtype in [tf.float32, tf.int64, tf.float32]]
+        _, _, _, _, z_e_array, k_array, x_array = tf.while_loop(lambda t, *_: t < horizon, step,
+                                                                [tf.constant(0), z_next, state_h, state_c] + arrays)
+        z_e_forecast = tf.transpose(z_e_array.stack(), [1, 0, 2], name="z_e_forecast")
+        k_forecast = tf.transpose(k_array.stack(), [1, 0], name="k_forecast")
+        x_forecast = tf.transpose(x_array.stack(), [1, 0, 2], name="x_forecast")
+        return z_e_forecast, k_forecast, x_forecast
+
+    @lazy_scope
+    def online_step(self):
+        """Advances the LSTM prior of every patient in the batch by one time step, from the encodings of the inputs,
+        which have one time step, and the LSTM states of the previous time steps fed to "state_h" and "state_c"
+        (zeros for the first time step). The "sample" placeholder selects if the embeddings and the reconstructions
+        are sampled from their distributions or set to their means (default: False).
+
+        Returns:
+            dict: The indices of the closest centroids [batch_size] and the soft assignments
+                [batch_size, n_nodes] of the inputs, the predicted next embeddings [batch_size, latent_dim], the
+                indices of their closest centroids [batch_size], their reconstructions
+                [batch_size, input_channels] and the next LSTM states [batch_size, 100].
+        """
+        state_h = tf.placeholder(tf.float32, shape=[None, 100], name="state_h")
+        state_c = tf.placeholder(tf.float32, shape=[None, 100], name="state_c")
+        sample = tf.placeholder_with_default(False, shape=[], name="sample")
+        draw = lambda distribution: self._draw(distribution, sample)
+        embeddings = tf.reshape(self.embeddings, [self.som_dim[0] * self.som_dim[1], self.latent_dim])
+
+        z_e = draw(self.z_e)
+        z_dist_flat = squared_distances(z_e, embeddings)
+        lstm_output, next_state_h, next_state_c = self.prediction_cell(tf.expand_dims(z_e, 1),
+                                                                       initial_state=[state_h, state_c])
+        next_z_e = draw(self._apply_layers(self.prediction_layers, lstm_output[:, -1]))
+        outputs = {"k": tf.argmin(z_dist_flat, axis=-1),
+                   "q": self.soft_assignments(z_dist_flat),
+                   "next_z_e": next_z_e,
+                   "next_k": tf.argmin(squared_distances(next_z_e, embeddings), axis=-1),
+                   "next_x": draw(self._apply_layers(self.decoder_layers, next_z_e)),
+                   "next_state_h": next_state_h,
+                   "next_state_c": next_state_c}
+        return {name: tf.identity(tensor, name=name) for name, tensor in outputs.items()}
+
+    def soft_assignments(self, z_dist_flat):
+        """Computes the soft assignments between the embeddings and the centroids from their squared distances."""
+        q = tf.keras.backend.epsilon() + 1.0 / (1.0 + z_dist_flat / self.alpha) ** ((self.alpha + 1.0) / 2.0)
+        return q / tf.reduce_sum(q, axis=1, keepdims=True)
+
+    @staticmethod
+    def _draw(distribution, sample):
+        """Samples from a distribution or takes its mean, depending on the boolean tensor sample."""
+        return tf.cond(sample, distribution.sample, distribution.mean)
+
+    @staticmethod
+    def _apply_layers(layers, inputs):
+        """Applies a stack of layers to the inputs."""
+        outputs = inputs
+        for layer in layers:
+            outputs = layer(outputs)
+        return outputs
+
     @lazy_scope
     def z_q(self):
         """Aggregates the respective closest embedding for every centroid."""
@@ -246,30 +346,21 @@ class TDPSOM:
     @lazy_scope
     def z_q_neighbors(self):
         """Aggregates the respective neighbors in the SOM grid for every z_q."""
-        k_1 = self.k // self.som_dim[1]
-        k_2 = self.k % self.som_dim[1]
-        k_stacked = tf.stack([k_1, k_2], axis=1)
-
-        k1_not_top = tf.less(k_1, tf.constant(self.som_dim[0] - 1, dtype=tf.int64))
-        k1_not_bottom = tf.greater(k_1, tf.constant(0, dtype=tf.int64))
-        k2_not_right = tf.less(k_2, tf.constant(self.som_dim[1] - 1, dtype=tf.int64))
-        k2_not_left = tf.greater(k_2, tf.constant(0, dtype=tf.int64))
-
-        k1_up = tf.where(k1_not_top, tf.add(k_1, 1), tf.zeros(tf.shape(k_1), dtype=tf.dtypes.int64))
-        k1_down = tf.where(k1_not_bottom, tf.subtract(k_1, 1),
-                           tf.ones(tf.shape(k_1), dtype=tf.dtypes.int64) * (self.som_dim[0] - 1))
-        k2_right = tf.where(k2_not_right, tf.add(k_2, 1), tf.zeros(tf.shape(k_2), dtype=tf.dtypes.int64))
-        k2_left = tf.where(k2_not_left, tf.subtract(k_2, 1),
-                           tf.ones(tf.shape(k_2), dtype=tf.dtypes.int64) * (self.som_dim[0] - 1))
-
-        z_q_up = tf.gather_nd(self.embeddings, tf.stack([k1_up, k_2], axis=1))
-        z_q_down = tf.gather_nd(self.embeddings, tf.stack([k1_down, k_2], axis=1))
-        z_q_right = tf.gather_nd(self.embeddings, tf.stack([k_1, k2_right], axis=1))
-        z_q_left = tf.gather_nd(self.embeddings, tf.stack([k_1, k2_left], axis=1))
-
-        z_q_neighbors = tf.stack([self.z_q, z_q_up, z_q_down, z_q_right, z_q_left], axis=1)
+        neighbours = tf.gather(tf.constant(self.topology.neighbours, dtype=tf.int64), self.k)
+        embeddings = tf.reshape(self.embeddings, [self.som_dim[0] * self.som_dim[1], self.latent_dim])
+        z_q_neighbors = tf.concat([tf.expand_dims(self.z_q, 1), tf.gather(embeddings, neighbours)], axis=1)
         return z_q_neighbors
 
+    def neighbours_mean(self, sq_diff):
+        """Mean of the squared differences [batch_size, 1 + n_neighbours, latent_dim] between the embeddings and
+        z_q_neighbors, over the neighbours that exist on the grid. Without wrap-around the missing neighbours of the
+        border nodes point to the node itself and are left out, instead of counting its centroid several times."""
+        if self.topology.complete:
+            return tf.reduce_mean(sq_diff)
+        mask = tf.gather(tf.constant(self.topology.mask), self.k)
+        mask = tf.concat([tf.ones_like(mask[:, :1]), mask], axis=1)
+        return tf.reduce_sum(sq_diff * tf.expand_dims(mask, -1)) / (tf.reduce_sum(mask) * self.latent_dim)
+
     @lazy_scope
     def reconstruction_e(self):
         """Reconstructs the input from the encodings by learning a Gaussian distribution."""
@@ -277,15 +368,17 @@ class TDPSOM:
             z_p = tf.placeholder(tf.float32, shape=[None, self.latent_dim], name="z_e")
             z_e = tf.cond(self.is_training, lambda: self.z_e, lambda: z_p)
 
-            h_1 = tf.keras.layers.Dense(2000, activation=tf.nn.leaky_relu)(z_e)
-            h_1 = tf.keras.layers.BatchNormalization()(h_1)
-            h_2 = tf.keras.layers.Dense(500, activation=tf.nn.leaky_relu)(h_1)
-            h_2 = tf.keras.layers.BatchNormalization()(h_2)
-            h_3 = tf.keras.layers.Dense(500, activation=tf.nn.leaky_relu)(h_2)
-            h_3 = tf.keras.layers.BatchNormalization()(h_3)
-            x_hat = tf.keras.layers.Dense(tfp.layers.IndependentNormal.params_size(self.input_channels),
-                                                activation=None)(h_3)
-            x_hat = tfp.layers.IndependentNormal(self.input_channels)(x_hat)
+            # The layers are kept to decode the forecasted embeddings
+            self.decoder_layers = [tf.keras.layers.Dense(2000, activation=tf.nn.leaky_relu, dtype=self.hidden_dtype),
+                                   tf.keras.layers.BatchNormalization(dtype=self.hidden_dtype),
+                                   tf.keras.layers.Dense(500, activation=tf.nn.leaky_relu, dtype=self.hidden_dtype),
+                                   tf.keras.layers.BatchNormalization(dtype=self.hidden_dtype),
+                                   tf.keras.layers.Dense(500, activation=tf.nn.leaky_relu, dtype=self.hidden_dtype),
+                                   tf.keras.layers.BatchNormalization(dtype=self.hidden_dtype),
+                                   tf.keras.layers.Dense(tfp.layers.IndependentNormal.params_size(
+                                       self.input_channels), activation=None, dtype="float32"),
+                                   tfp.layers.IndependentNormal(self.input_channels)]
+            x_hat = self._apply_layers(self.decoder_layers, z_e)
         x_hat_sampled = tf.identity(x_hat, name="x_hat")
         return x_hat
 
@@ -305,8 +398,7 @@ class TDPSOM:
     def q(self):
         """Computes the soft assignments between the embeddings and the centroids."""
         with tf.name_scope('distribution'):
-            q = tf.keras.backend.epsilon() + 1.0 / (1.0 + self.z_dist_flat / self.alpha) ** ((self.alpha + 1.0) / 2.0)
-            q = (q / tf.reduce_sum(q, axis=1, keepdims=True))
+            q = self.soft_assignments(self.z_dist_flat)
             q = tf.identity(q, name="q")
         return q
 
@@ -315,8 +407,7 @@ class TDPSOM:
         """Computes the soft assignments between the embeddings and the centroids stopping the gradient of the latent
         embeddings."""
         with tf.name_scope('distribution'):
-            q = tf.keras.backend.epsilon() + 1.0 / (1.0 + self.z_dist_flat_ng / self.alpha) ** ((self.alpha + 1.0) / 2.0)
-            q = (q / tf.reduce_sum(q, axis=1, keepdims=True))
+            q = self.soft_assignments(self.z_dist_flat_ng)
         return q
 
     @lazy_scope
@@ -340,34 +431,11 @@ class TDPSOM:
     @lazy_scope
     def loss_som(self):
         """Computes the SOM loss."""
-        k = tf.range(self.som_dim[0] * self.som_dim[1])
-        k_1 = k // self.som_dim[0]
-        k_2 = k % self.som_dim[1]
-
-        k1_not_top = tf.less(k_1, tf.constant(self.som_dim[0] - 1, dtype=tf.int32))
-        k1_not_bottom = tf.greater(k_1, tf.constant(0, dtype=tf.int32))
-        k2_not_right = tf.less(k_2, tf.constant(self.som_dim[1] - 1, dtype=tf.int32))
-        k2_not_left = tf.greater(k_2, tf.constant(0, dtype=tf.int32))
-
-        k1_up = tf.where(k1_not_top, tf.add(k_1, 1), tf.zeros(tf.shape(k_1), dtype=tf.dtypes.int32))
-        k1_down = tf.where(k1_not_bottom, tf.subtract(k_1, 1), tf.ones(tf.shape(k_1), dtype=tf.dtypes.int32) * (self.som_dim[0] - 1))
-        k2_right = tf.where(k2_not_right, tf.add(k_2, 1), tf.zeros(tf.shape(k_2), dtype=tf.dtypes.int32))
-        k2_left = tf.where(k2_not_left, tf.subtract(k_2, 1), tf.ones(tf.shape(k_2), dtype=tf.dtypes.int32) * (self.som_dim[0] - 1))
-
-        k_up = k1_up * self.som_dim[0] + k_2
-        k_down = k1_down * self.som_dim[0] + k_2
-        k_right = k_1 * self.som_dim[0] + k2_right
-        k_left = k_1 * self.som_dim[0] + k2_left
-
-        q_t = tf.transpose(self.q_ng)
-        q_up = tf.transpose(tf.gather_nd(q_t, tf.reshape(k_up, [self.som_dim[0] * self.som_dim[1], 1])))
-        q_down = tf.transpose(tf.gather_nd(q_t, tf.reshape(k_down, [self.som_dim[0] * self.som_dim[1], 1])))
-        q_right = tf.transpose(tf.gather_nd(q_t, tf.reshape(k_right, [self.som_dim[0] * self.som_dim[1], 1])))
-        q_left = tf.transpose(tf.gather_nd(q_t, tf.reshape(k_left, [self.som_dim[0] * self.som_dim[1], 1])))
-
-        q_neighbours = tf.concat([tf.expand_dims(q_up, -1), tf.expand_dims(q_down, -1),
-                                  tf.expand_dims(q_right, -1), tf.expand_dims(q_left, -1)], axis=2)
-        q_neighbours = tf.reduce_sum(tf.math.log(q_neighbours), axis=-1)
+        log_q_neighbours = tf.gather(tf.math.log(self.q_ng), np.reshape(self.topology.neighbours, [-1]), axis=1)
+        log_q_neighbours = tf.reshape(log_q_neighbours, [-1, self.topology.n_nodes, self.topology.n_neighbours])
+        if not self.topology.complete:
+            log_q_neighbours = log_q_neighbours * self.topology.mask
+        q_neighbours = tf.reduce_sum(log_q_neighbours, axis=-1)
 
         mask = tf.greater(self.q, 0.1 * tf.ones_like(self.q))
         new_q = tf.multiply(self.q, tf.cast(mask, tf.float32))
@@ -425,8 +493,8 @@ class TDPSOM:
     @lazy_scope
     def loss_som_old(self):
         """Computes the SOM loss."""
-        loss_som = tf.reduce_mean(
-            tf.squared_difference(tf.expand_dims(tf.stop_gradient(self.z_e), axis=1), self.z_q_neighbors))
+        sq_diff = tf.squared_difference(tf.expand_dims(tf.stop_gradient(self.z_e), axis=1), self.z_q_neighbors)
+        loss_som = self.neighbours_mean(sq_diff)
         tf.summary.scalar("loss_som_old", loss_som)
         return loss_som
 
@@ -443,6 +511,9 @@ class TDPSOM:
         lr_decay = tf.train.exponential_decay(self.learning_rate, self.global_step, self.decay_steps, self.decay_factor,
                                               staircase=True)
         optimizer = tf.train.AdamOptimizer(lr_decay)
+        if self.compute_dtype == "float16":
+            # Dynamic loss scaling keeps the small float16 gradients of the hidden layers from underflowing
+            optimizer = tf.train.experimental.MixedPrecisionLossScaleOptimizer(optimizer, "dynamic")
         train_step = optimizer.minimize(self.loss, global_step=self.global_step)
         train_step_prob = optimizer.minimize(self.loss_prediction, global_step=self.global_step)
         train_step_ae = optimizer.minimize(self.loss_reconstruction_ze, global_step=self.global_step)
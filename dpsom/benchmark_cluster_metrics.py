@@ -0,0 +1,91 @@
+"""
+Benchmark of the clustering metrics computed from one contingency matrix,
+against the per-sample loops and the separate scikit-learn scores they
+replace, on random SOM assignments
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+from sklearn import metrics
+
+from cluster_metrics import cluster_scores, cluster_label_stats
+
+
+def cluster_purity_loop(y_pred, y_true):
+    """Purity with the contingency matrix and the relabelling built in per-sample loops."""
+    y_true = y_true.astype(np.int64)
+    D = max(y_pred.max(), y_true.max()) + 1
+    w = np.zeros((D, D), dtype=np.int64)
+    for i in range(y_pred.size):
+        w[y_pred[i], y_true[i]] += 1
+    label_mapping = w.argmax(axis=1)
+    y_pred_voted = y_pred.copy()
+    for i in range(y_pred.size):
+        y_pred_voted[i] = label_mapping[y_pred[i]]
+    return metrics.accuracy_score(y_pred_voted, y_true)
+
+
+def cluster_means_loop(k, labels, n_clusters):
+    """Mean label of every cluster, selecting its data points with np.where."""
+    clust_matr = np.zeros(n_clusters)
+    for i in range(n_clusters):
+        idx = np.where(k == i)
+        clust_matr[i] = np.sum(labels[idx]) / idx[0].size if idx[0].size > 0 else 0
+    return clust_matr
+
+
+def time_call(fn):
+    t_begin = timeit.default_timer()
+    result = fn()
+    return result, timeit.default_timer() - t_begin
+
+
+def benchmark_cluster_metrics(configs):
+    rs = np.random.RandomState(configs["random_state"])
+    n_clusters = configs["som_dim"] ** 2
+
+    for n_samples in configs["n_samples"]:
+        k = rs.randint(0, n_clusters, n_samples)
+        # Labels that depend on the clusters, like the APACHE scores of the SOM nodes
+        labels = (k % configs["n_classes"] + rs.randint(0, 3, n_samples)) % configs["n_classes"]
+
+        timings = {}
+        if configs["with_loops"]:
+            purity_loop, timings["purity loop"] = time_call(lambda: cluster_purity_loop(k, labels))
+        (nmi_sk, ami_sk), timings["sklearn NMI+AMI"] = time_call(
+            lambda: (metrics.normalized_mutual_info_score(labels, k), metrics.adjusted_mutual_info_score(k, labels)))
+        scores, timings["contingency NMI+purity"] = time_call(
+            lambda: cluster_scores(k, labels, scores=["NMI", "Purity"]))
+        ami, timings["contingency AMI"] = time_call(lambda: cluster_scores(k, labels, scores=["AMI"])["AMI"])
+        means_loop, timings["cluster means np.where loop"] = time_call(
+            lambda: cluster_means_loop(k, labels, n_clusters))
+        (_, means, _), timings["cluster means bincount"] = time_call(
+            lambda: cluster_label_stats(k, labels, n_clusters, empty_value=0))
+
+        assert np.isclose(scores["NMI"], nmi_sk) and np.isclose(ami, ami_sk)
+        assert np.allclose(means, means_loop)
+        if configs["with_loops"]:
+            assert np.isclose(scores["Purity"], purity_loop)
+
+        print("Assignments: {}, clusters: {}, classes: {}".format(n_samples, n_clusters, configs["n_classes"]))
+        for name, seconds in timings.items():
+            print("  {}: {:.3f} s".format(name, seconds))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # Parameters
+    parser.add_argument("--n_samples", type=int, nargs="+", default=[1000000, 10000000],
+                        help="Numbers of cluster assignments to benchmark")
+    parser.add_argument("--som_dim", type=int, default=16, help="Size of each side of the SOM grid")
+    parser.add_argument("--n_classes", type=int, default=40, help="Number of distinct labels")
+    parser.add_argument("--with_loops", action="store_true", default=False,
+                        help="Also time the per-sample purity loop, which is slow for many assignments")
+    parser.add_argument("--random_state", type=int, default=2020, help="Random seed")
+
+    configs = vars(parser.parse_args())
+
+    benchmark_cluster_metrics(configs)
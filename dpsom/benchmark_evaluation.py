@@ -0,0 +1,82 @@
+"""
+Benchmark of the evaluation throughput of T-DPSOM, with one session run per output and batch whose results are
+appended to lists, as evaluate_model did, against extract_outputs, which computes all outputs of a batch in one
+session run and writes them into preallocated arrays. Also checks that the outputs of one run are consistent, i.e.
+that z_q are the centroids of the SOM nodes k.
+"""
+
+import argparse
+import timeit
+import tracemalloc
+
+import numpy as np
+
+try:
+    import tensorflow.compat.v1 as tf
+    tf.disable_v2_behavior()
+except:
+    import tensorflow as tf
+
+from TempDPSOM_model import TDPSOM
+from utils import extract_outputs
+
+
+def val_batches(data_val, batch_size):
+    for i in range(len(data_val) // batch_size):
+        positions = np.arange(i * batch_size, (i + 1) * batch_size)
+        yield data_val[positions], positions
+
+
+def evaluate_separate_runs(sess, fetches, x, data_val, batch_size):
+    outputs = {name: [] for name in fetches}
+    for batch_data, _ in val_batches(data_val, batch_size):
+        for name, tensor in fetches.items():
+            outputs[name].extend(sess.run(tensor, feed_dict={x: batch_data}))
+    return {name: np.array(output) for name, output in outputs.items()}
+
+
+def evaluate_one_run(sess, fetches, x, data_val, batch_size):
+    run_batch = lambda batch_data: sess.run(fetches, feed_dict={x: batch_data})
+    return extract_outputs(run_batch, val_batches(data_val, batch_size), len(data_val) // batch_size * batch_size)
+
+
+def benchmark_evaluation(configs):
+    rs = np.random.RandomState(configs["random_state"])
+    data_val = rs.normal(size=(configs["n_patients"], configs["max_n_step"], 98)).astype(np.float32)
+    som_dim = [configs["som_dim"], configs["som_dim"]]
+    model = TDPSOM(input_size=98, latent_dim=configs["latent_dim"], som_dim=som_dim)
+    fetches = {"k": model.k, "z_q": model.z_q, "z_e": model.z_e_sample}
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        embeddings = sess.run(model.embeddings).reshape((-1, configs["latent_dim"]))
+        # Warm-up run, which is not timed
+        sess.run(fetches, feed_dict={model.inputs: data_val[:configs["batch_size"]]})
+
+        results = {}
+        for name, evaluate in [("separate runs", evaluate_separate_runs), ("one run", evaluate_one_run)]:
+            tracemalloc.start()
+            t_begin = timeit.default_timer()
+            outputs = evaluate(sess, fetches, model.inputs, data_val, configs["batch_size"])
+            t_end = timeit.default_timer()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[name] = outputs
+            print("{}: {:.1f} patients/s, peak memory of the outputs {:.1f} MB".format(
+                name, len(outputs["k"]) / configs["max_n_step"] / (t_end - t_begin), peak / 1e6))
+
+    outputs = results["one run"]
+    assert np.array_equal(outputs["z_q"], embeddings[outputs["k"]])
+    print("z_q of one run are the centroids of k")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_patients", type=int, default=3000, help="Number of patients of the validation set")
+    parser.add_argument("--batch_size", type=int, default=300, help="Number of patients per batch")
+    parser.add_argument("--max_n_step", type=int, default=72, help="Length of the time series")
+    parser.add_argument("--latent_dim", type=int, default=10, help="Dimensionality of the latent space")
+    parser.add_argument("--som_dim", type=int, default=16, help="Size of each side of the SOM grid")
+    parser.add_argument("--random_state", type=int, default=2020, help="Random seed")
+    configs = vars(parser.parse_args())
+    benchmark_evaluation(configs)
@@ -0,0 +1,112 @@
+"""
+Benchmark of the cold start and of the time per batch of the frozen inference graph of T-DPSOM, against restoring
+the full training graph from its meta graph and feeding the dummy arrays of its training branches, as in
+evaluate_model. The model is initialized at random with a fixed seed, so that both graphs draw the same samples of the
+embeddings, and the outputs of the two graphs are checked to be equal.
+"""
+
+import argparse
+import os
+import tempfile
+import timeit
+
+import numpy as np
+
+try:
+    import tensorflow.compat.v1 as tf
+    tf.disable_v2_behavior()
+except:
+    import tensorflow as tf
+
+from TempDPSOM_model import TDPSOM
+from inference_graph import export_inference_graph, InferenceModel
+
+OUTPUTS = ["z_e_sample/z_e", "k/k", "q/distribution/q"]
+
+
+def restore_full_graph(model_path, batch_size, max_n_step, latent_dim):
+    """Restores the meta graph and the variables of a checkpoint and returns the session with the dummy feeds."""
+    tf.reset_default_graph()
+    sess = tf.Session()
+    saver = tf.train.import_meta_graph(model_path + ".meta")
+    saver.restore(sess, model_path)
+    graph = tf.get_default_graph()
+    training_dic = {graph.get_tensor_by_name("is_training/is_training:0"): True,
+                    graph.get_tensor_by_name("prediction/next_state/input_lstm:0"):
+                        np.zeros((max_n_step * batch_size, latent_dim)),
+                    graph.get_tensor_by_name("prediction/next_state/init_state:0"): np.zeros((2, batch_size, 100)),
+                    graph.get_tensor_by_name("reconstruction_e/decoder/z_e:0"):
+                        np.zeros((max_n_step * batch_size, latent_dim))}
+    return sess, training_dic
+
+
+def benchmark_inference_graph(configs):
+    batch_size = configs["batch_size"]
+    max_n_step = configs["max_n_step"]
+    latent_dim = configs["latent_dim"]
+    rs = np.random.RandomState(configs["random_state"])
+    batches = [rs.normal(size=(batch_size, max_n_step, 98)).astype(np.float32) for _ in range(configs["n_batches"])]
+
+    export_dir = tempfile.mkdtemp()
+    model_path = os.path.join(export_dir, "model")
+    graph_path = os.path.join(export_dir, "model.pb")
+    tf.set_random_seed(configs["random_state"])
+    TDPSOM(input_size=98, latent_dim=latent_dim, som_dim=[configs["som_dim"], configs["som_dim"]])
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        tf.train.Saver().save(sess, model_path)
+        export_inference_graph(sess, graph_path, prediction=configs["prediction"])
+    checkpoint_size = sum(os.path.getsize(os.path.join(export_dir, f)) for f in os.listdir(export_dir)
+                          if f.startswith("model.") and f != "model.pb")
+    print("Checkpoint {:.1f} MB, frozen graph {:.1f} MB".format(checkpoint_size / 1e6,
+                                                                os.path.getsize(graph_path) / 1e6))
+
+    # Cold start, until the outputs of the first batch are computed
+    t_begin = timeit.default_timer()
+    sess, training_dic = restore_full_graph(model_path, batch_size, max_n_step, latent_dim)
+    graph = tf.get_default_graph()
+    fetches = {name: graph.get_tensor_by_name(name + ":0") for name in OUTPUTS}
+    f_dic = {graph.get_tensor_by_name("inputs/x:0"): batches[0]}
+    f_dic.update(training_dic)
+    full_first = sess.run(fetches, feed_dict=f_dic)
+    full_cold = timeit.default_timer() - t_begin
+
+    t_begin = timeit.default_timer()
+    model = InferenceModel(graph_path)
+    frozen_first = model.run(OUTPUTS, batches[0])
+    frozen_cold = timeit.default_timer() - t_begin
+
+    for name in OUTPUTS:
+        assert np.allclose(full_first[name], frozen_first[name], atol=1e-5), name
+
+    t_begin = timeit.default_timer()
+    for batch_data in batches:
+        f_dic = {graph.get_tensor_by_name("inputs/x:0"): batch_data}
+        f_dic.update(training_dic)
+        sess.run(fetches, feed_dict=f_dic)
+    full_batch = (timeit.default_timer() - t_begin) / len(batches)
+    sess.close()
+
+    t_begin = timeit.default_timer()
+    for batch_data in batches:
+        model.run(OUTPUTS, batch_data)
+    frozen_batch = (timeit.default_timer() - t_begin) / len(batches)
+    model.close()
+
+    print("Full graph: cold start {:.3f} s, {:.1f} ms per batch".format(full_cold, full_batch * 1000.))
+    print("Frozen graph: cold start {:.3f} s, {:.1f} ms per batch".format(frozen_cold, frozen_batch * 1000.))
+    print("Outputs of the frozen graph equal to the full graph")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=300, help="Number of patients per batch")
+    parser.add_argument("--max_n_step", type=int, default=72, help="Length of the time series")
+    parser.add_argument("--n_batches", type=int, default=20, help="Number of timed batches")
+    parser.add_argument("--latent_dim", type=int, default=10, help="Dimensionality of the latent space")
+    parser.add_argument("--som_dim", type=int, default=16, help="Size of each side of the SOM grid")
+    parser.add_argument("--prediction", default=False, action="store_true",
+                        help="Keep the outputs of the LSTM prior and of the decoder in the frozen graph")
+    parser.add_argument("--random_state", type=int, default=2020, help="Random seed")
+    configs = vars(parser.parse_args())
+    benchmark_inference_graph(configs)
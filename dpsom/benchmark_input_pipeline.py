@@ -0,0 +1,125 @@
+"""
+Benchmark of the training steps per second of the T-DPSOM model, with the
+batches prepared synchronously, prefetched in a background thread, and
+prefetched in a shuffled order. The batches are read out of core from an
+eICU-like HDF5 file.
+"""
+
+import argparse
+import os
+import tempfile
+import timeit
+
+import numpy as np
+import h5py
+
+try:
+    import tensorflow.compat.v1 as tf
+    tf.disable_v2_behavior()
+except:
+    import tensorflow as tf
+
+from TempDPSOM_model import TDPSOM
+from TempDPSOM import batch_generator, time_step_rows
+from eicu_data import get_data_split
+from utils import prefetch_generator
+
+# Number of channels of the saved eICU time series, fixed by the model's input
+INPUT_CHANNELS = 98
+
+MODES = [("sync", False, 0), ("prefetch", False, 2), ("shuffle+prefetch", True, 2)]
+
+
+def write_synthetic_data(path, n_patients, max_n_step, input_channels, rs):
+    """Writes random time series and labels in the layout of the saved eICU data-set."""
+    with h5py.File(path, "w") as hf:
+        hf.create_dataset("x", data=rs.normal(size=(n_patients, max_n_step, input_channels)).astype(np.float32),
+                          chunks=(1, max_n_step, input_channels))
+        hf.create_dataset("y", data=rs.randint(0, 20, size=(n_patients, max_n_step, 12)).astype(np.float32))
+
+
+def benchmark_mode(sess, model, phases, data_train, data_val, endpoints_val, configs, shuffle, prefetch):
+    """Runs n_steps training steps of each phase and returns its steps per second."""
+    batch_size = configs["batch_size"]
+    max_n_step = configs["max_n_step"]
+    latent_dim = configs["latent_dim"]
+    n_clusters = configs["som_dim"] * configs["som_dim"]
+    graph = tf.get_default_graph()
+    init_1 = graph.get_tensor_by_name("prediction/next_state/init_state:0")
+    z_e_p = graph.get_tensor_by_name("prediction/next_state/input_lstm:0")
+    z_e_rec = graph.get_tensor_by_name("reconstruction_e/decoder/z_e:0")
+    training_dic = {model.is_training: True, z_e_p: np.zeros((max_n_step * batch_size, latent_dim)),
+                    init_1: np.zeros((2, batch_size, 100)), z_e_rec: np.zeros((max_n_step * batch_size, latent_dim))}
+    ppt = np.full((len(data_train) * max_n_step, n_clusters), 1.0 / n_clusters, dtype=np.float32)
+
+    train_gen = prefetch_generator(batch_generator(data_train, data_val, endpoints_val, batch_size=batch_size,
+                                                   shuffle=shuffle, seed=configs["random_state"], mode="train"),
+                                   prefetch)
+    steps_per_sec = {}
+    for phase, train_step in phases:
+        # Warm-up step, which is not timed
+        batch_data, ii = next(train_gen)
+        f_dic = {model.inputs: batch_data, model.p: ppt[time_step_rows(ii, max_n_step)]}
+        f_dic.update(training_dic)
+        sess.run(train_step, feed_dict=f_dic)
+
+        t_begin = timeit.default_timer()
+        for _ in range(configs["n_steps"]):
+            batch_data, ii = next(train_gen)
+            f_dic = {model.inputs: batch_data, model.p: ppt[time_step_rows(ii, max_n_step)]}
+            f_dic.update(training_dic)
+            sess.run(train_step, feed_dict=f_dic)
+        steps_per_sec[phase] = configs["n_steps"] / (timeit.default_timer() - t_begin)
+    return steps_per_sec
+
+
+def benchmark_input_pipeline(configs):
+    rs = np.random.RandomState(configs["random_state"])
+    data_path = configs["data_path"]
+    if data_path is None:
+        data_path = os.path.join(tempfile.mkdtemp(), "eICU_synthetic.h5")
+        write_synthetic_data(data_path, configs["n_patients"], configs["max_n_step"], INPUT_CHANNELS, rs)
+    data_train, data_val, _, endpoints_val = get_data_split(data_path, validation=True)
+
+    model = TDPSOM(input_size=INPUT_CHANNELS, latent_dim=configs["latent_dim"],
+                   som_dim=[configs["som_dim"], configs["som_dim"]], learning_rate=0.001,
+                   input_channels=INPUT_CHANNELS)
+    train_step, train_step_ae, train_step_som, train_step_prob = model.optimize
+    phases = [("ae_pretrain", train_step_ae), ("som_init", train_step_som), ("training", [train_step, train_step_prob]),
+              ("pred_finetuning", train_step_prob)]
+
+    results = {}
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        for mode, shuffle, prefetch in MODES:
+            results[mode] = benchmark_mode(sess, model, phases, data_train, data_val, endpoints_val, configs,
+                                           shuffle, prefetch)
+
+    print("Training time series: {}, batch size: {}, steps per phase: {}".format(len(data_train),
+                                                                                  configs["batch_size"],
+                                                                                  configs["n_steps"]))
+    for phase, _ in phases:
+        print("{}: ".format(phase) + ", ".join(["{} {:.2f} steps/sec".format(mode, results[mode][phase])
+                                                 for mode, _, _ in MODES]))
+    data_train.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # Input paths
+    parser.add_argument("--data_path", default=None,
+                        help="Saved eICU data-set to read the batches from, synthetic data is used if not given")
+
+    # Parameters
+    parser.add_argument("--n_patients", type=int, default=6000, help="Number of synthetic time series")
+    parser.add_argument("--max_n_step", type=int, default=72, help="Length of the time series")
+    parser.add_argument("--latent_dim", type=int, default=20, help="Dimensionality of the latent space")
+    parser.add_argument("--som_dim", type=int, default=16, help="Size of each side of the SOM grid")
+    parser.add_argument("--batch_size", type=int, default=300, help="Batch size")
+    parser.add_argument("--n_steps", type=int, default=20, help="Number of timed training steps per phase and mode")
+    parser.add_argument("--random_state", type=int, default=2020, help="Random seed")
+
+    configs = vars(parser.parse_args())
+
+    benchmark_input_pipeline(configs)
@@ -0,0 +1,105 @@
+"""
+Replay of the eICU data-set through the online inference of T-DPSOM, one hourly feature vector per bed and hour,
+against re-encoding the whole history of every bed each hour. Reports the percentiles of the latency of the updates
+and checks that the SOM nodes and the next-step predictions of the online updates are equal to the ones of the
+whole windows.
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+
+try:
+    import tensorflow.compat.v1 as tf
+    tf.disable_v2_behavior()
+except:
+    import tensorflow as tf
+
+from TempDPSOM_model import TDPSOM
+from online_inference import OnlineTDPSOM
+from som_distance import squared_distances_np
+import eicu_data
+
+
+def latency_summary(name, latencies, n_beds):
+    """Prints the percentiles of the latencies of the updates in milliseconds."""
+    latencies = np.array(latencies) * 1000.
+    print("{}: p50 {:.2f} ms, p90 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms, {:.1f} us per bed".format(
+        name, np.percentile(latencies, 50), np.percentile(latencies, 90), np.percentile(latencies, 99),
+        np.max(latencies), np.mean(latencies) * 1000. / n_beds))
+
+
+def window_predictions(sess, model, z_e_mean, next_z_e_mean, x_window):
+    """SOM nodes of all time steps and prediction of the next embedding from whole windows, with the means of the
+    distributions, as in the online updates."""
+    z_e = sess.run(z_e_mean, feed_dict={model.inputs: x_window})
+    embeddings = sess.run(model.embeddings).reshape((-1, model.latent_dim))
+    k = np.argmin(squared_distances_np(z_e, embeddings), axis=-1).reshape(x_window.shape[:2])
+    graph = tf.get_default_graph()
+    next_z_e = sess.run(next_z_e_mean, feed_dict={
+        model.inputs: x_window, model.is_training: False,
+        graph.get_tensor_by_name("prediction/next_state/input_lstm:0"): z_e,
+        graph.get_tensor_by_name("prediction/next_state/init_state:0"): np.zeros((2, x_window.shape[0], 100))})
+    return k, next_z_e.reshape((x_window.shape[0], x_window.shape[1], -1))[:, -1]
+
+
+def benchmark_online_inference(configs):
+    hf, x_data, _ = eicu_data.open_data(configs["data_path"])
+    _, idx_test = eicu_data.split_indices(x_data.shape[0], validation=False)
+    beds = np.sort(idx_test[:configs["n_beds"]])
+    x_beds = np.array(x_data[beds.tolist()], dtype=np.float32)
+    n_steps = min(configs["n_steps"], x_beds.shape[1])
+    if hf is not None:
+        hf.close()
+
+    som_dim = [configs["som_dim"], configs["som_dim"]]
+    model = TDPSOM(input_size=x_beds.shape[2], latent_dim=configs["latent_dim"], som_dim=som_dim,
+                   input_channels=x_beds.shape[2])
+    # The means are built once, outside of the timed loops
+    z_e_mean = model.z_e.mean()
+    next_z_e_mean = model.prediction.mean()
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        if configs["model_path"] is not None:
+            tf.train.Saver().restore(sess, configs["model_path"])
+
+        online = OnlineTDPSOM(sess)
+        online_latencies = []
+        online_k = np.zeros((len(beds), n_steps), dtype=np.int64)
+        for t in range(n_steps):
+            features = {pid: x_beds[idx, t] for idx, pid in enumerate(beds)}
+            t_begin = timeit.default_timer()
+            results = online.update(features)
+            online_latencies.append(timeit.default_timer() - t_begin)
+            online_k[:, t] = results["k"]
+
+        # Re-encoding of the history of every bed at every hour
+        rerun_latencies = []
+        for t in range(n_steps):
+            t_begin = timeit.default_timer()
+            window_predictions(sess, model, z_e_mean, next_z_e_mean, x_beds[:, :t + 1])
+            rerun_latencies.append(timeit.default_timer() - t_begin)
+
+        window_k, window_next_z_e = window_predictions(sess, model, z_e_mean, next_z_e_mean, x_beds[:, :n_steps])
+
+    print("Replayed {} hours of {} beds".format(n_steps, len(beds)))
+    latency_summary("Online updates", online_latencies, len(beds))
+    latency_summary("Re-encoding the history", rerun_latencies, len(beds))
+    assert np.array_equal(online_k, window_k)
+    assert np.allclose(results["next_z_e"], window_next_z_e, atol=1e-4)
+    print("SOM nodes and next-step predictions equal to the whole windows")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", default="../data/eICU_data.csv",
+                        help="HDF5 file or directory of memory-mapped arrays of the eICU data-set")
+    parser.add_argument("--model_path", default=None,
+                        help="Checkpoint of a trained model, by default the weights are initialized at random")
+    parser.add_argument("--n_beds", type=int, default=200, help="Number of patients replayed concurrently")
+    parser.add_argument("--n_steps", type=int, default=72, help="Number of hours replayed")
+    parser.add_argument("--latent_dim", type=int, default=10, help="Dimensionality of the latent space")
+    parser.add_argument("--som_dim", type=int, default=16, help="Size of each side of the SOM grid")
+    configs = vars(parser.parse_args())
+    benchmark_online_inference(configs)
@@ -0,0 +1,103 @@
+"""
+Benchmark of the training steps per second of the T-DPSOM model on CPU with the performance settings of the
+training script: the numbers of intra-op and inter-op threads of the session, XLA auto-clustering and the type of
+the computations of the hidden layers of the encoder and the decoder. The batches are synthetic time series held in
+memory, so that only the training steps are timed.
+"""
+
+import argparse
+import os
+import timeit
+
+import numpy as np
+
+try:
+    import tensorflow.compat.v1 as tf
+    tf.disable_v2_behavior()
+except:
+    import tensorflow as tf
+
+from TempDPSOM_model import TDPSOM
+from utils import session_config, enable_xla_cpu_jit
+
+
+def settings(intra_op_threads, inter_op_threads):
+    """Settings compared by the benchmark, as (name, intra_op_threads, inter_op_threads, xla_jit, compute_dtype)."""
+    return [("default", 0, 0, False, "float32"),
+            ("threads", intra_op_threads, inter_op_threads, False, "float32"),
+            ("threads+xla", intra_op_threads, inter_op_threads, True, "float32"),
+            ("threads+bfloat16", intra_op_threads, inter_op_threads, False, "bfloat16"),
+            ("threads+float16", intra_op_threads, inter_op_threads, False, "float16"),
+            ("threads+xla+bfloat16", intra_op_threads, inter_op_threads, True, "bfloat16")]
+
+
+def benchmark_setting(configs, batches, intra_op_threads, inter_op_threads, xla_jit, compute_dtype):
+    """Runs n_steps training steps with one setting and returns its steps per second and the final loss."""
+    batch_size = configs["batch_size"]
+    max_n_step = configs["max_n_step"]
+    latent_dim = configs["latent_dim"]
+    n_clusters = configs["som_dim"] * configs["som_dim"]
+
+    tf.reset_default_graph()
+    tf.set_random_seed(configs["random_state"])
+    model = TDPSOM(input_size=98, latent_dim=latent_dim, som_dim=[configs["som_dim"], configs["som_dim"]],
+                   compute_dtype=compute_dtype)
+    train_step = model.optimize[0]
+    graph = tf.get_default_graph()
+    training_dic = {model.is_training: True,
+                    graph.get_tensor_by_name("prediction/next_state/input_lstm:0"):
+                        np.zeros((max_n_step * batch_size, latent_dim)),
+                    graph.get_tensor_by_name("prediction/next_state/init_state:0"): np.zeros((2, batch_size, 100)),
+                    graph.get_tensor_by_name("reconstruction_e/decoder/z_e:0"):
+                        np.zeros((max_n_step * batch_size, latent_dim)),
+                    model.p: np.full((max_n_step * batch_size, n_clusters), 1.0 / n_clusters, dtype=np.float32)}
+
+    with tf.Session(config=session_config(intra_op_threads, inter_op_threads, xla_jit)) as sess:
+        sess.run(tf.global_variables_initializer())
+        f_dic = {model.inputs: batches[0]}
+        f_dic.update(training_dic)
+        # Warm-up steps, which are not timed and include the compilation of the XLA clusters
+        for _ in range(2):
+            sess.run(train_step, feed_dict=f_dic)
+
+        t_begin = timeit.default_timer()
+        for i in range(configs["n_steps"]):
+            f_dic = {model.inputs: batches[i % len(batches)]}
+            f_dic.update(training_dic)
+            sess.run(train_step, feed_dict=f_dic)
+        steps_per_sec = configs["n_steps"] / (timeit.default_timer() - t_begin)
+        loss = sess.run(model.loss, feed_dict=f_dic)
+    return steps_per_sec, loss
+
+
+def benchmark_performance_config(configs):
+    # Before the first session, the settings without XLA are not affected
+    enable_xla_cpu_jit()
+    rs = np.random.RandomState(configs["random_state"])
+    batches = [rs.normal(size=(configs["batch_size"], configs["max_n_step"], 98)).astype(np.float32)
+               for _ in range(4)]
+    for name, intra_op_threads, inter_op_threads, xla_jit, compute_dtype in settings(
+            configs["intra_op_threads"], configs["inter_op_threads"]):
+        if configs["settings"] is not None and name not in configs["settings"]:
+            continue
+        steps_per_sec, loss = benchmark_setting(configs, batches, intra_op_threads, inter_op_threads, xla_jit,
+                                                compute_dtype)
+        print("{}: {:.2f} steps/sec, loss after the steps {:.3f}".format(name, steps_per_sec, loss))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=300, help="Number of patients per batch")
+    parser.add_argument("--max_n_step", type=int, default=72, help="Length of the time series")
+    parser.add_argument("--n_steps", type=int, default=20, help="Number of timed training steps per setting")
+    parser.add_argument("--latent_dim", type=int, default=10, help="Dimensionality of the latent space")
+    parser.add_argument("--som_dim", type=int, default=16, help="Size of each side of the SOM grid")
+    parser.add_argument("--intra_op_threads", type=int, default=os.cpu_count(),
+                        help="Number of threads used within an operation in the tuned settings")
+    parser.add_argument("--inter_op_threads", type=int, default=2,
+                        help="Number of operations run in parallel in the tuned settings")
+    parser.add_argument("--settings", nargs="+", default=None,
+                        help="Names of the compared settings, by default all of them")
+    parser.add_argument("--random_state", type=int, default=2020, help="Random seed")
+    configs = vars(parser.parse_args())
+    benchmark_performance_config(configs)
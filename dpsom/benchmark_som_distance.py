@@ -0,0 +1,98 @@
+"""
+Benchmark of the distances between the encodings and the SOM embeddings, with
+the broadcast (batch_size, som_dim, som_dim, latent_dim) squared difference
+against the matrix-form expansion of som_distance, sweeping the size of the SOM
+and of the latent space. Reports the throughput of a forward and backward pass
+and the peak memory of the allocator during the step.
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+
+try:
+    import tensorflow.compat.v1 as tf
+    tf.disable_v2_behavior()
+except:
+    import tensorflow as tf
+
+from som_distance import squared_distances
+
+
+def squared_distances_broadcast(z, embeddings):
+    """Previous form of the distances, materializing the 4D tensor of the differences."""
+    som_dim = embeddings.get_shape().as_list()[:2]
+    z_dist = tf.squared_difference(tf.expand_dims(tf.expand_dims(z, 1), 1), tf.expand_dims(embeddings, 0))
+    z_dist_red = tf.reduce_sum(z_dist, axis=-1)
+    return tf.reshape(z_dist_red, [-1, som_dim[0] * som_dim[1]])
+
+
+def peak_bytes(run_metadata):
+    """Largest peak of the memory allocators over the nodes of a traced step."""
+    peak = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for memory in node_stats.memory:
+                peak = max(peak, memory.peak_bytes)
+    return peak
+
+
+def benchmark_distance(distance_fn, batch_size, som_dim, latent_dim, n_steps, rs):
+    """Times the distances and their gradients, returns the steps per second, the peak memory and the values."""
+    graph = tf.Graph()
+    with graph.as_default():
+        z = tf.placeholder(tf.float32, shape=[None, latent_dim])
+        embeddings = tf.Variable(rs.normal(size=(som_dim, som_dim, latent_dim)).astype(np.float32))
+        z_dist_flat = distance_fn(z, embeddings)
+        # Student's t kernel of the soft assignments, as in the clustering loss of the models
+        q = 1.0 / (1.0 + z_dist_flat / 10.) ** (11. / 2.)
+        grads = tf.gradients(tf.reduce_sum(q), [z, embeddings])
+        z_batch = rs.normal(size=(batch_size, latent_dim)).astype(np.float32)
+        with tf.Session(graph=graph) as sess:
+            sess.run(tf.global_variables_initializer())
+            run_metadata = tf.RunMetadata()
+            values = sess.run(z_dist_flat, feed_dict={z: z_batch},
+                              options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+            sess.run(grads, feed_dict={z: z_batch})
+            t_begin = timeit.default_timer()
+            for _ in range(n_steps):
+                sess.run(grads, feed_dict={z: z_batch})
+            steps_per_sec = n_steps / (timeit.default_timer() - t_begin)
+    return steps_per_sec, peak_bytes(run_metadata), values
+
+
+def benchmark_som_distance(configs):
+    rs = np.random.RandomState(configs["random_state"])
+    batch_size = configs["batch_size"]
+    print("Batch size: {}, steps: {}".format(batch_size, configs["n_steps"]))
+    for som_dim in configs["som_dim"]:
+        for latent_dim in configs["latent_dim"]:
+            seed = rs.randint(2 ** 31)
+            results = {}
+            for name, distance_fn in [("broadcast", squared_distances_broadcast), ("matrix", squared_distances)]:
+                results[name] = benchmark_distance(distance_fn, batch_size, som_dim, latent_dim, configs["n_steps"],
+                                                   np.random.RandomState(seed))
+            # Both forms see the same encodings and embeddings, drawn from the same seed
+            ref, values = results["broadcast"][2], results["matrix"][2]
+            assert np.allclose(values, ref, rtol=1e-4, atol=1e-4 * ref.max())
+            print("som_dim=[{0},{0}], latent_dim={1}: ".format(som_dim, latent_dim) + ", ".join(
+                ["{} {:.1f} steps/sec, peak {:.1f} MB".format(name, steps_per_sec, peak / 2. ** 20)
+                 for name, (steps_per_sec, peak, _) in results.items()]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # Parameters
+    parser.add_argument("--som_dim", type=int, nargs="+", default=[8, 16, 32], help="Sizes of each side of the SOM grid")
+    parser.add_argument("--latent_dim", type=int, nargs="+", default=[20, 100],
+                        help="Dimensionalities of the latent space")
+    parser.add_argument("--batch_size", type=int, default=300 * 72,
+                        help="Number of encodings per step, the time steps of a T-DPSOM batch by default")
+    parser.add_argument("--n_steps", type=int, default=10, help="Number of timed steps per configuration")
+    parser.add_argument("--random_state", type=int, default=2020, help="Random seed")
+
+    configs = vars(parser.parse_args())
+
+    benchmark_som_distance(configs)
@@ -0,0 +1,149 @@
+"""
+Clustering metrics computed from a single contingency matrix of the cluster
+assignments and the labels
+"""
+
+import numpy as np
+from sklearn.metrics.cluster import expected_mutual_information
+
+
+def contingency_matrix(clusters, labels, n_clusters=None):
+    """
+    Counts the data points of every cluster and class
+    # Arguments
+        clusters: cluster assignments in [0, n_clusters), numpy.array with shape `(n_samples,)`
+        labels: labels of any type, numpy.array with shape `(n_samples,)`
+        n_clusters: number of clusters, if None the largest assignment + 1
+    # Return
+        contingency: numpy.array with shape `(n_clusters, n_classes)`
+        classes: sorted distinct labels, the columns of the contingency matrix
+    """
+    clusters = np.reshape(clusters, (-1)).astype(np.int64)
+    labels = np.reshape(labels, (-1))
+    assert clusters.size == labels.size
+    if n_clusters is None:
+        n_clusters = clusters.max() + 1 if clusters.size > 0 else 0
+    if np.issubdtype(labels.dtype, np.integer) and labels.size > 0 and labels.min() >= 0 \
+            and labels.max() < labels.size:
+        # Small non-negative integer labels are counted directly, without sorting them
+        n_values = labels.max() + 1
+        contingency = np.reshape(np.bincount(clusters * n_values + labels, minlength=n_clusters * n_values),
+                                 (n_clusters, n_values))
+        classes = np.flatnonzero(contingency.sum(axis=0))
+        return contingency[:, classes], classes.astype(labels.dtype)
+    classes, label_codes = np.unique(labels, return_inverse=True)
+    label_codes = np.reshape(label_codes, (-1))
+    contingency = np.bincount(clusters * classes.size + label_codes, minlength=n_clusters * classes.size)
+    return np.reshape(contingency, (n_clusters, classes.size)), classes
+
+
+def purity(contingency):
+    """
+    Clustering purity, the ratio of data points in the majority class of their cluster
+    """
+    n_samples = contingency.sum()
+    if n_samples == 0:
+        return 0.
+    return contingency.max(axis=1).sum() / n_samples
+
+
+def entropy(counts):
+    """
+    Entropy of a labelling in nats, given the number of data points of each label
+    """
+    counts = counts[counts > 0].astype(np.float64)
+    if counts.size == 0:
+        return 1.
+    n_samples = counts.sum()
+    return -np.sum((counts / n_samples) * (np.log(counts) - np.log(n_samples)))
+
+
+def mutual_information(contingency):
+    """
+    Mutual information between clusters and classes in nats
+    """
+    n_samples = contingency.sum()
+    rows, cols = np.nonzero(contingency)
+    n_ij = contingency[rows, cols].astype(np.float64)
+    a = contingency.sum(axis=1).astype(np.float64)
+    b = contingency.sum(axis=0).astype(np.float64)
+    mi = np.sum(n_ij / n_samples * (np.log(n_ij) + np.log(n_samples) - np.log(a[rows]) - np.log(b[cols])))
+    return max(mi, 0.)
+
+
+def _n_used(contingency):
+    return np.count_nonzero(contingency.sum(axis=1)), np.count_nonzero(contingency.sum(axis=0))
+
+
+def normalized_mutual_information(contingency):
+    """
+    Normalized mutual information, with the arithmetic mean of the entropies as normalizer
+    """
+    n_clusters, n_classes = _n_used(contingency)
+    if n_clusters == n_classes == 1 or n_clusters == n_classes == 0:
+        return 1.
+    mi = mutual_information(contingency)
+    if mi == 0:
+        return 0.
+    normalizer = (entropy(contingency.sum(axis=1)) + entropy(contingency.sum(axis=0))) / 2.
+    return mi / normalizer
+
+
+def adjusted_mutual_information(contingency):
+    """
+    Mutual information adjusted for chance, with the arithmetic mean of the entropies as normalizer
+    """
+    n_clusters, n_classes = _n_used(contingency)
+    if n_clusters == n_classes == 1 or n_clusters == n_classes == 0:
+        return 1.
+    elif n_clusters == 1 or n_classes == 1:
+        return 0.
+    contingency = contingency[contingency.sum(axis=1) > 0][:, contingency.sum(axis=0) > 0]
+    mi = mutual_information(contingency)
+    emi = expected_mutual_information(contingency, contingency.sum())
+    normalizer = (entropy(contingency.sum(axis=1)) + entropy(contingency.sum(axis=0))) / 2.
+    eps = np.finfo("float64").eps
+    denominator = normalizer - emi
+    denominator = min(denominator, -eps) if denominator < 0 else max(denominator, eps)
+    numerator = mi - emi
+    numerator = min(numerator, -eps) if numerator < 0 else max(numerator, eps)
+    return numerator / denominator
+
+
+def cluster_scores(clusters, labels, scores=("NMI", "AMI", "Purity")):
+    """
+    Computes several clustering scores from one contingency matrix
+    # Arguments
+        clusters: cluster assignments, numpy.array with shape `(n_samples,)`
+        labels: labels, numpy.array with shape `(n_samples,)`
+        scores: names of the scores in ['NMI', 'AMI', 'Purity'] to compute
+    # Return
+        dict of the scores
+    """
+    score_fns = {"NMI": normalized_mutual_information, "AMI": adjusted_mutual_information, "Purity": purity}
+    contingency, _ = contingency_matrix(clusters, labels)
+    return {score: score_fns[score](contingency) for score in scores}
+
+
+def cluster_label_stats(clusters, values, n_clusters, empty_value=np.nan):
+    """
+    Size of every cluster and mean and standard deviation of a label over its data points
+    # Arguments
+        clusters: cluster assignments in [0, n_clusters), numpy.array with shape `(n_samples,)`
+        values: numerical labels, numpy.array with shape `(n_samples,)`
+        n_clusters: number of clusters
+        empty_value: mean and standard deviation of the empty clusters
+    # Return
+        counts, means, stds: numpy.arrays with shape `(n_clusters,)`
+    """
+    clusters = np.reshape(clusters, (-1)).astype(np.int64)
+    values = np.reshape(values, (-1)).astype(np.float64)
+    counts = np.bincount(clusters, minlength=n_clusters)
+    sums = np.bincount(clusters, weights=values, minlength=n_clusters)
+    sq_sums = np.bincount(clusters, weights=values ** 2, minlength=n_clusters)
+    non_empty = counts > 0
+    means = np.full(n_clusters, empty_value, dtype=np.float64)
+    stds = np.full(n_clusters, empty_value, dtype=np.float64)
+    means[non_empty] = sums[non_empty] / counts[non_empty]
+    stds[non_empty] = np.sqrt(np.maximum(sq_sums[non_empty] / counts[non_empty] - means[non_empty] ** 2, 0.))
+    return counts, means, stds
@@ -0,0 +1,169 @@
+"""
+Out-of-core access to the saved eICU data-set, whose splits are index arrays
+into the data on disk
+"""
+
+import os
+
+import numpy as np
+import h5py
+from sklearn.model_selection import train_test_split
+
+
+def open_data(data_path):
+    """Opens the time series and the labels of the data-set without reading them.
+        Args:
+            data_path (path): HDF5 file with the data-sets 'x' and 'y', or a directory with
+                              the memory-mapped arrays 'x.npy' and 'y.npy'.
+        Returns:
+            h5py.File: Open file, None for memory-mapped arrays.
+            array-like: Time series of shape (n_patients, max_n_step, n_channels).
+            array-like: Labels of shape (n_patients, max_n_step, n_labels).
+    """
+    if os.path.isdir(data_path):
+        x = np.load(os.path.join(data_path, "x.npy"), mmap_mode="r")
+        y = np.load(os.path.join(data_path, "y.npy"), mmap_mode="r")
+        return None, x, y
+    hf = h5py.File(data_path, "r")
+    return hf, hf["x"], hf["y"]
+
+
+def convert_to_memmap(data_path, out_dir, chunk_size=10000):
+    """Copies the HDF5 data-set to memory-mapped .npy arrays, chunk by chunk.
+        Args:
+            data_path (path): HDF5 file with the data-sets 'x' and 'y'.
+            out_dir (path): Directory to write 'x.npy' and 'y.npy' to.
+            chunk_size (int): Number of patients copied at a time.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    with h5py.File(data_path, "r") as hf:
+        for key in ["x", "y"]:
+            ds = hf[key]
+            out = np.lib.format.open_memmap(os.path.join(out_dir, "{}.npy".format(key)), mode="w+",
+                                            dtype=ds.dtype, shape=ds.shape)
+            for start in range(0, ds.shape[0], chunk_size):
+                stop = min(start + chunk_size, ds.shape[0])
+                out[start:stop] = ds[start:stop]
+            out.flush()
+            del out
+
+
+def split_indices(n_total, validation, test_ratio=0.15, val_ratio=0.20, random_state=42):
+    """Splits the patients into training and val/test set, the last test_ratio of the patients
+        is the test set, the validation set is a random val_ratio of the others.
+        Args:
+            n_total (int): Number of patients in the data-set.
+            validation (bool): If "True" the validation indices are returned, otherwise the test indices.
+            test_ratio (float): Ratio of the patients in the test set.
+            val_ratio (float): Ratio of the remaining patients in the validation set.
+            random_state (int): Seed of the validation split.
+        Returns:
+            np.array: Indices of the training set.
+            np.array: Indices of the val/test set.
+    """
+    n_train_val = int(n_total * (1 - test_ratio))
+    idx_train, idx_val = train_test_split(np.arange(n_train_val), test_size=val_ratio, random_state=random_state)
+    if not validation:
+        idx_val = np.arange(n_train_val, n_total)
+    return idx_train, idx_val
+
+
+class IndexedArray:
+    """Rows of an on-disk array selected by an index array. Only the rows that are indexed are
+    read into memory, so that the splits of the data-set do not copy it."""
+
+    def __init__(self, data, indices, hf=None):
+        """Args:
+            data (array-like): h5py data-set or memory-mapped array.
+            indices (np.array): Rows of the data in this set, in order.
+            hf (h5py.File): Open file of the data, which is closed by close (default: None).
+        """
+        self.data = data
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.hf = hf
+
+    def __len__(self):
+        return self.indices.size
+
+    @property
+    def shape(self):
+        return (self.indices.size,) + tuple(self.data.shape[1:])
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def take(self, positions):
+        """Reads the rows at the given positions of this set into memory."""
+        rows = self.indices[positions]
+        if isinstance(self.data, np.ndarray):
+            return np.asarray(self.data[rows])
+        # h5py only supports increasing, unique indices
+        rows_sorted, inverse = np.unique(rows, return_inverse=True)
+        if rows_sorted.size > 0 and rows_sorted[-1] - rows_sorted[0] + 1 == rows_sorted.size:
+            block = self.data[rows_sorted[0]:rows_sorted[-1] + 1]
+        else:
+            block = self.data[rows_sorted]
+        return block[inverse.reshape(-1)]
+
+    def subset(self, positions):
+        """Returns the set restricted to the given positions, without reading any data."""
+        return IndexedArray(self.data, self.indices[positions], hf=self.hf)
+
+    def batches(self, batch_size, permutation=None):
+        """Yields the full minibatches of the set, in the order of a permutation of the positions."""
+        if permutation is None:
+            permutation = np.arange(len(self))
+        for i in range(len(self) // batch_size):
+            yield self.take(permutation[i * batch_size: (i + 1) * batch_size])
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows = self[key[0]]
+            if np.isscalar(key[0]):
+                return rows[key[1:]]
+            return rows[(slice(None),) + key[1:]]
+        if np.isscalar(key):
+            return self.take([key])[0]
+        return self.take(key)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.take(slice(None))
+        return data if dtype is None else data.astype(dtype)
+
+    def close(self):
+        """Closes the file of the data, which is shared by all sets of a split of the data-set."""
+        if self.hf is not None:
+            self.hf.close()
+
+
+def get_data_split(data_path, validation, random_state=42):
+    """Opens the data-set and splits it into training and val/test set by index arrays.
+        Args:
+            data_path (path): HDF5 file or directory of memory-mapped arrays, see open_data.
+            validation (bool): If "True" validation set is returned, otherwise the test set.
+            random_state (int): Seed of the validation split.
+        Returns:
+            IndexedArray: Training data.
+            IndexedArray: Val/test data depending on validation value.
+            IndexedArray: Training labels.
+            IndexedArray: Val/test labels depending on validation value.
+        The sets share the open file of the data-set, which is closed by calling close on any of them.
+    """
+    hf, x, y = open_data(data_path)
+    idx_train, idx_val = split_indices(x.shape[0], validation, random_state=random_state)
+    return IndexedArray(x, idx_train, hf=hf), IndexedArray(x, idx_val, hf=hf), IndexedArray(y, idx_train, hf=hf), \
+           IndexedArray(y, idx_val, hf=hf)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Converts the saved eICU data-set to memory-mapped arrays")
+    parser.add_argument("--data_path", default="../data/eICU_data.csv", help="HDF5 file of the data-set")
+    parser.add_argument("--out_dir", default="../data/eICU_data_memmap",
+                        help="Directory to write the memory-mapped arrays to")
+    parser.add_argument("--chunk_size", type=int, default=10000, help="Number of patients copied at a time")
+    args = parser.parse_args()
+    convert_to_memmap(args.data_path, args.out_dir, chunk_size=args.chunk_size)
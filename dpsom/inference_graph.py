@@ -0,0 +1,126 @@
+"""
+Export of a trained DPSOM or T-DPSOM model to a frozen inference graph. The variables are folded into constants and
+the graph is pruned to the tensors of the requested outputs, so that it holds neither the optimizers and summaries
+nor the training branches of the model, whose placeholders have to be fed with dummy arrays in the full graph. The
+exported file is a single GraphDef which is loaded by InferenceModel without the model classes.
+"""
+
+import argparse
+
+import numpy as np
+
+try:
+    import tensorflow.compat.v1 as tf
+    tf.disable_v2_behavior()
+except:
+    import tensorflow as tf
+
+INPUT = "inputs/x"
+
+# Embeddings, SOM nodes, soft assignments and closest centroids of the inputs, "sample_z_e" is the scope of the
+# embeddings in DPSOM and "z_e_sample" in T-DPSOM
+CLUSTER_OUTPUTS = ["z_e_sample/z_e", "sample_z_e/z_e", "k/k", "q/distribution/q", "z_q/z_q"]
+
+# One-step and multi-step predictions of the LSTM prior and their reconstructions by the decoder (T-DPSOM only)
+PREDICTION_OUTPUTS = ["online_step/k", "online_step/q", "online_step/next_z_e", "online_step/next_k",
+                      "online_step/next_x", "online_step/next_state_h", "online_step/next_state_c",
+                      "forecast/z_e_forecast", "forecast/k_forecast", "forecast/x_forecast"]
+
+LEARNING_PHASE = "keras_learning_phase"
+
+
+def export_inference_graph(sess, export_path, prediction=False):
+    """Freezes the variables of the graph of the session and writes the graph pruned to the inference outputs.
+
+    Args:
+        sess (tf.Session): Session with the trained model.
+        export_path (path): Path of the frozen graph.
+        prediction (bool): If "True" the outputs of the LSTM prior and of the decoder of T-DPSOM are kept as well
+                           (default: False).
+
+    Returns:
+        list: Names of the outputs of the frozen graph.
+    """
+    graph_def = sess.graph.as_graph_def()
+    node_names = set(node.name for node in graph_def.node)
+    outputs = [name for name in CLUSTER_OUTPUTS + (PREDICTION_OUTPUTS if prediction else []) if name in node_names]
+    frozen_graph_def = tf.graph_util.convert_variables_to_constants(sess, graph_def, outputs)
+
+    # The Keras layers are fixed to their inference behaviour, without dropout and with the moving statistics of the
+    # batch normalization
+    for node in frozen_graph_def.node:
+        if node.name == LEARNING_PHASE:
+            node.op = "Const"
+            del node.input[:]
+            dtype = node.attr["dtype"].type
+            node.attr.clear()
+            node.attr["dtype"].type = dtype
+            node.attr["value"].tensor.CopyFrom(tf.make_tensor_proto(False))
+
+    with tf.gfile.GFile(export_path, "wb") as f:
+        f.write(frozen_graph_def.SerializeToString())
+    return outputs
+
+
+class InferenceModel:
+    """Frozen inference graph of a DPSOM or T-DPSOM model, with its own graph and session."""
+
+    def __init__(self, graph_path, config=None):
+        """Loads a frozen graph written by export_inference_graph.
+            Args:
+                graph_path (path): Path of the frozen graph.
+                config (tf.ConfigProto): Configuration of the session (default: None).
+        """
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(graph_path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        node_names = set(node.name for node in graph_def.node)
+        self.output_names = [name for name in CLUSTER_OUTPUTS + PREDICTION_OUTPUTS if name in node_names]
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.sess = tf.Session(graph=self.graph, config=config)
+        self.x = self.graph.get_tensor_by_name(INPUT + ":0")
+
+    def tensor(self, name):
+        return self.graph.get_tensor_by_name(name + ":0")
+
+    def run(self, outputs, x, feeds=None):
+        """Computes the outputs for a batch of inputs in one session run.
+            Args:
+                outputs (list): Names of the outputs.
+                x (np.array): Inputs of the model.
+                feeds (dict): Values of further placeholders by their names, e.g. "forecast/horizon" (default: None).
+            Returns:
+                dict: The value of each output.
+        """
+        feed_dict = {self.x: x}
+        if feeds is not None:
+            feed_dict.update({self.tensor(name): value for name, value in feeds.items()})
+        return self.sess.run({name: self.tensor(name) for name in outputs}, feed_dict=feed_dict)
+
+    def predict(self, outputs, x, batch_size=300, feeds=None):
+        """Computes the outputs for all inputs in batches of batch_size inputs, the batches are concatenated along
+        the first axis of the outputs."""
+        results = [self.run(outputs, x[i:i + batch_size], feeds) for i in range(0, len(x), batch_size)]
+        return {name: np.concatenate([result[name] for result in results]) for name in outputs}
+
+    def close(self):
+        self.sess.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", required=True, help="Checkpoint of the trained model, with its meta graph")
+    parser.add_argument("--export_path", default=None, help="Path of the frozen graph (default: model_path.pb)")
+    parser.add_argument("--prediction", default=False, action="store_true",
+                        help="Keep the outputs of the LSTM prior and of the decoder of T-DPSOM")
+    configs = vars(parser.parse_args())
+    export_path = configs["export_path"] if configs["export_path"] is not None else configs["model_path"] + ".pb"
+
+    with tf.Session() as sess:
+        saver = tf.train.import_meta_graph(configs["model_path"] + ".meta")
+        saver.restore(sess, configs["model_path"])
+        outputs = export_inference_graph(sess, export_path, prediction=configs["prediction"])
+    print("Exported {} to {}".format(", ".join(outputs), export_path))
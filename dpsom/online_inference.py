@@ -0,0 +1,78 @@
+"""
+Online inference of the T-DPSOM model on streaming time series. The LSTM state and the current SOM node of every
+patient are kept between the time steps, so that a new feature vector is processed in constant time instead of
+re-encoding the whole history, and the new vectors of all patients are processed in one session run.
+"""
+
+import numpy as np
+
+try:
+    import tensorflow.compat.v1 as tf
+    tf.disable_v2_behavior()
+except:
+    import tensorflow as tf
+
+ONLINE_OUTPUTS = ["k", "q", "next_z_e", "next_k", "next_x", "next_state_h", "next_state_c"]
+
+
+class OnlineTDPSOM:
+    """Keeps the state of every patient and advances it by one time step per new feature vector."""
+
+    def __init__(self, sess, sample=False, lstm_units=100):
+        """Looks up the tensors of the online step in the graph of the session, which is either built from the
+        TDPSOM class or imported from a saved meta graph.
+            Args:
+                sess (tf.Session): Session with the restored T-DPSOM model.
+                sample (bool): If "True" the embeddings and the reconstructions are sampled from their
+                               distributions, otherwise they are their means (default: False).
+                lstm_units (int): Size of the LSTM states (default: 100).
+        """
+        graph = sess.graph
+        self.sess = sess
+        self.sample = sample
+        self.lstm_units = lstm_units
+        self.x = graph.get_tensor_by_name("inputs/x:0")
+        self.state_h = graph.get_tensor_by_name("online_step/state_h:0")
+        self.state_c = graph.get_tensor_by_name("online_step/state_c:0")
+        self.sample_p = graph.get_tensor_by_name("online_step/sample:0")
+        self.outputs = {name: graph.get_tensor_by_name("online_step/{}:0".format(name)) for name in ONLINE_OUTPUTS}
+        self.states = {}
+        self.nodes = {}
+
+    def update(self, features):
+        """Processes one new feature vector per patient in one session run. Patients without a state start from the
+        zero state of the LSTM.
+            Args:
+                features (dict): Feature vector of shape (input_channels,) of every patient with a new time step.
+            Returns:
+                dict: The patients in the order of the rows of the other arrays ('pids'), the current SOM nodes
+                      ('k'), their soft assignments ('q'), the predicted next embeddings ('next_z_e'), their SOM
+                      nodes ('next_k') and their reconstructions ('next_x').
+        """
+        pids = list(features.keys())
+        if len(pids) == 0:
+            return {"pids": []}
+        zero_state = np.zeros((2, self.lstm_units), dtype=np.float32)
+        states = np.stack([self.states.get(pid, zero_state) for pid in pids], axis=1)
+        x = np.stack([features[pid] for pid in pids]).astype(np.float32)[:, np.newaxis, :]
+
+        results = self.sess.run(self.outputs, feed_dict={self.x: x, self.state_h: states[0],
+                                                         self.state_c: states[1], self.sample_p: self.sample})
+        for idx, pid in enumerate(pids):
+            self.states[pid] = np.stack([results["next_state_h"][idx], results["next_state_c"][idx]])
+            self.nodes[pid] = results["k"][idx]
+        results["pids"] = pids
+        del results["next_state_h"], results["next_state_c"]
+        return results
+
+    def current_node(self, pid):
+        """The SOM node of the last time step of a patient, None if the patient has no state."""
+        return self.nodes.get(pid)
+
+    def discharge(self, pid):
+        """Drops the state of a patient."""
+        self.states.pop(pid, None)
+        self.nodes.pop(pid, None)
+
+    def n_patients(self):
+        return len(self.states)
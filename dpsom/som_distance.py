@@ -0,0 +1,45 @@
+"""
+Squared euclidean distances between encodings and the SOM embeddings, computed
+with the expansion ||z||^2 - 2 z.e + ||e||^2 instead of broadcasting their
+differences to a (batch_size, som_dim[0], som_dim[1], latent_dim) tensor
+"""
+
+import numpy as np
+
+try:
+    import tensorflow.compat.v1 as tf
+    tf.disable_v2_behavior()
+except:
+    import tensorflow as tf
+
+
+def squared_distances(z, embeddings):
+    """Computes the squared distances between every encoding and every SOM node.
+    Args:
+        z (tf.Tensor): Encodings with shape (batch_size, latent_dim).
+        embeddings (tf.Tensor): SOM embeddings with shape (som_dim[0], som_dim[1], latent_dim).
+    Returns:
+        tf.Tensor: Squared distances with shape (batch_size, som_dim[0] * som_dim[1]).
+    """
+    z = tf.convert_to_tensor(z)
+    latent_dim = embeddings.get_shape().as_list()[-1]
+    emb = tf.reshape(embeddings, [-1, latent_dim])
+    z_sq = tf.reduce_sum(tf.square(z), axis=-1, keepdims=True)
+    emb_sq = tf.reduce_sum(tf.square(emb), axis=-1)
+    z_dist = z_sq - 2. * tf.matmul(z, emb, transpose_b=True) + tf.expand_dims(emb_sq, 0)
+    # The expansion can be slightly negative through cancellation when an encoding lies on a node
+    return tf.maximum(z_dist, 0.)
+
+
+def squared_distances_np(z, embeddings):
+    """Numpy version of squared_distances, for encodings and embeddings fetched from a session.
+    Args:
+        z (np.array): Encodings with shape (n_samples, latent_dim).
+        embeddings (np.array): SOM embeddings with shape (som_dim[0], som_dim[1], latent_dim).
+    Returns:
+        np.array: Squared distances with shape (n_samples, som_dim[0] * som_dim[1]).
+    """
+    emb = np.reshape(embeddings, (-1, embeddings.shape[-1]))
+    z = np.reshape(z, (-1, emb.shape[-1]))
+    z_dist = np.sum(z ** 2, axis=-1, keepdims=True) - 2. * z @ emb.T + np.sum(emb ** 2, axis=-1)[np.newaxis, :]
+    return np.maximum(z_dist, 0.)
@@ -0,0 +1,69 @@
+"""
+Topology of the SOM grid, precomputed once as static neighbour index tables
+"""
+
+import numpy as np
+
+# Grid offsets (row, column) of the neighbours of a node, in the order up, down, right, left of the original
+# neighbour computation
+NEIGHBOURHOODS = {
+    "von_neumann": [(1, 0), (-1, 0), (0, 1), (0, -1)],
+    "moore": [(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)],
+}
+
+
+class SOMTopology:
+    """Neighbourhood structure of a 2D SOM grid, whose nodes are numbered row by row."""
+
+    def __init__(self, som_dim, neighbourhood="von_neumann", toroidal=True):
+        """Precomputes the neighbour index table of the grid.
+        Args:
+            som_dim (list): The dimensionality of the self-organizing map.
+            neighbourhood (str): Neighbourhood in ['von_neumann', 'moore'], the 4 or 8 adjacent nodes.
+            toroidal (bool): If "True" the grid wraps around at its borders, otherwise nodes at the border have
+                             fewer neighbours.
+        """
+        if neighbourhood not in NEIGHBOURHOODS:
+            raise ValueError("The neighbourhood has to be in {}".format(set(NEIGHBOURHOODS.keys())))
+        self.som_dim = som_dim
+        self.neighbourhood = neighbourhood
+        self.toroidal = toroidal
+        self.n_nodes = som_dim[0] * som_dim[1]
+        self.neighbours, self.mask = self._neighbour_table(NEIGHBOURHOODS[neighbourhood])
+
+    @property
+    def n_neighbours(self):
+        return self.neighbours.shape[1]
+
+    @property
+    def complete(self):
+        """Whether every node has all its neighbours, so that the mask can be ignored."""
+        return bool(np.all(self.mask == 1))
+
+    def _neighbour_table(self, offsets):
+        k = np.arange(self.n_nodes)
+        k_1 = k // self.som_dim[1]
+        k_2 = k % self.som_dim[1]
+        neighbours = np.empty((self.n_nodes, len(offsets)), dtype=np.int32)
+        mask = np.ones((self.n_nodes, len(offsets)), dtype=np.float32)
+        for j, (d_1, d_2) in enumerate(offsets):
+            n_1 = k_1 + d_1
+            n_2 = k_2 + d_2
+            inside = (n_1 >= 0) & (n_1 < self.som_dim[0]) & (n_2 >= 0) & (n_2 < self.som_dim[1])
+            if self.toroidal:
+                neighbours[:, j] = (n_1 % self.som_dim[0]) * self.som_dim[1] + n_2 % self.som_dim[1]
+            else:
+                # Missing neighbours point to the node itself and are masked out
+                neighbours[:, j] = np.where(inside, n_1 * self.som_dim[1] + n_2, k)
+                mask[:, j] = inside
+        return neighbours, mask
+
+    def grid_distances(self):
+        """Manhattan distances between all pairs of nodes on the grid, shape (n_nodes, n_nodes)."""
+        k = np.arange(self.n_nodes)
+        d_1 = np.abs((k // self.som_dim[1])[:, np.newaxis] - (k // self.som_dim[1])[np.newaxis, :])
+        d_2 = np.abs((k % self.som_dim[1])[:, np.newaxis] - (k % self.som_dim[1])[np.newaxis, :])
+        if self.toroidal:
+            d_1 = np.minimum(self.som_dim[0] - d_1, d_1)
+            d_2 = np.minimum(self.som_dim[1] - d_2, d_2)
+        return d_1 + d_2
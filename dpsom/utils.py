@@ -2,8 +2,19 @@
 Utility functions for the DPSOM model
 """
 
+import os
+import queue
+import threading
+
 import numpy as np
-from sklearn import metrics
+
+try:
+    import tensorflow.compat.v1 as tf
+    tf.disable_v2_behavior()
+except:
+    import tensorflow as tf
+
+from cluster_metrics import contingency_matrix, purity
 
 def cluster_purity(y_pred,y_true):
     """
@@ -14,14 +25,203 @@ def cluster_purity(y_pred,y_true):
     # Return
         purity, in [0,1]
     """
-    y_true = y_true.astype(np.int64)
     assert y_pred.size == y_true.size
-    D = max(y_pred.max(), y_true.max()) + 1
-    w = np.zeros((D, D), dtype=np.int64)
-    for i in range(y_pred.size):
-        w[y_pred[i], y_true[i]] += 1
-    label_mapping = w.argmax(axis=1)
-    y_pred_voted = y_pred.copy()
-    for i in range(y_pred.size):
-        y_pred_voted[i] = label_mapping[y_pred[i]]
-    return metrics.accuracy_score(y_pred_voted, y_true)
+    contingency, _ = contingency_matrix(y_pred, y_true.astype(np.int64))
+    return purity(contingency)
+
+
+class PrefetchGenerator:
+    """
+    Runs a batch generator in a background thread, which keeps up to
+    buffer_size batches ready in a bounded queue, so that the preparation of
+    the next batches overlaps with the training step on the current one.
+    The thread stops once the generator is exhausted or the object is
+    garbage collected.
+    # Arguments
+        generator: generator of the batches
+        buffer_size: maximum number of batches that are prepared in advance
+    """
+
+    def __init__(self, generator, buffer_size=2):
+        self._queue = queue.Queue(maxsize=buffer_size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fill, args=(generator, self._queue, self._stop))
+        self._thread.daemon = True
+        self._thread.start()
+
+    @staticmethod
+    def _put(batch_queue, stop, item):
+        while not stop.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @staticmethod
+    def _fill(generator, batch_queue, stop):
+        # Does not reference the PrefetchGenerator, so that it can be collected
+        try:
+            for item in generator:
+                if not PrefetchGenerator._put(batch_queue, stop, (False, item)):
+                    return
+        except Exception as exc:
+            PrefetchGenerator._put(batch_queue, stop, (True, exc))
+            return
+        PrefetchGenerator._put(batch_queue, stop, (True, StopIteration()))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        done, item = self._queue.get()
+        if done:
+            self._queue.put((done, item))
+            raise item
+        return item
+
+    def close(self):
+        self._stop.set()
+
+    def __del__(self):
+        self.close()
+
+
+def prefetch_generator(generator, buffer_size):
+    """
+    Wraps a batch generator into a PrefetchGenerator if buffer_size > 0
+    """
+    if buffer_size > 0:
+        return PrefetchGenerator(generator, buffer_size)
+    return generator
+
+
+def epoch_permutation(n, shuffle, rnd):
+    """
+    Order of the positions of a data set in which to visit them in one epoch
+    # Arguments
+        n: size of the data set
+        shuffle: if True, a random permutation, otherwise the original order
+        rnd: numpy.random.RandomState used for shuffling
+    """
+    if shuffle:
+        return rnd.permutation(n)
+    return np.arange(n)
+
+
+class TargetDistribution:
+    """
+    Target distribution P of the clustering loss over a data set, computed
+    from the soft assignments q of all its data points. q is computed in a
+    streaming pass over chunks of the data set into a preallocated float32
+    buffer, accumulating its per-cluster sums, and P is computed from them for
+    the rows of each batch, when it is selected.
+    # Arguments
+        q_fn: function returning q of shape (n_rows, n_clusters) for a chunk
+        data: data set, an array-like supporting len and slicing
+        n_clusters: number of SOM nodes
+        chunk_size: number of data points for which q is computed at a time
+        rows_per_item: number of rows of q per data point, e.g. the number of
+            time steps of a time series
+    """
+
+    def __init__(self, q_fn, data, n_clusters, chunk_size=1000, rows_per_item=1):
+        self.q_fn = q_fn
+        self.data = data
+        self.chunk_size = chunk_size
+        self.rows_per_item = rows_per_item
+        self.q = np.empty((len(data) * rows_per_item, n_clusters), dtype=np.float32)
+        self.col_sums = np.zeros(n_clusters, dtype=np.float64)
+
+    def refresh(self):
+        """
+        Recomputes q over the whole data set with the current model
+        """
+        self.col_sums[:] = 0
+        for start in range(0, len(self.data), self.chunk_size):
+            stop = min(start + self.chunk_size, len(self.data))
+            q_chunk = self.q_fn(self.data[start:stop])
+            self.q[start * self.rows_per_item: stop * self.rows_per_item] = q_chunk
+            self.col_sums += np.sum(q_chunk, axis=0, dtype=np.float64)
+
+    def __getitem__(self, rows):
+        q = self.q[rows]
+        p = q ** 2 / self.col_sums.astype(np.float32)
+        return p / p.sum(axis=1, keepdims=True)
+
+
+def extract_outputs(run_fn, batches, n_items, h5_group=None):
+    """
+    Computes the outputs of a model on the batches of a data set, all outputs
+    of a batch in one call of run_fn, and writes them into arrays allocated
+    for the whole data set at the positions of the batch, instead of
+    appending them to lists. The arrays are allocated at the first batch,
+    with the shapes and types of its outputs. Outputs with several rows per
+    item of the batch, e.g. flattened over the time steps, keep the rows of
+    an item contiguous.
+    # Arguments
+        run_fn: function returning a dict of the outputs of a batch, e.g. one
+            session run of all fetches, called with the batch without its
+            positions
+        batches: iterable of tuples, whose last element are the positions of
+            the items of the batch in the data set
+        n_items: number of items of the data set
+        h5_group: HDF5 file or group, if given the outputs are written to its
+            datasets instead of arrays in memory
+    # Return
+        dict of the arrays, or HDF5 datasets, of the outputs
+    """
+    outputs = None
+    for batch in batches:
+        positions = np.asarray(batch[-1])
+        results = run_fn(*batch[:-1])
+        if outputs is None:
+            outputs = {}
+            for name, result in results.items():
+                result = np.asarray(result)
+                shape = (n_items * (result.shape[0] // len(positions)),) + result.shape[1:]
+                if h5_group is not None:
+                    outputs[name] = h5_group.create_dataset(name, shape=shape, dtype=result.dtype)
+                else:
+                    outputs[name] = np.empty(shape, dtype=result.dtype)
+        for name, result in results.items():
+            rows_per_item = outputs[name].shape[0] // n_items
+            rows = (positions.reshape((-1, 1)) * rows_per_item + np.arange(rows_per_item)).reshape(-1)
+            if np.array_equal(rows, np.arange(rows[0], rows[0] + len(rows))):
+                rows = slice(rows[0], rows[0] + len(rows))
+            outputs[name][rows] = result
+    return outputs
+
+
+def session_config(intra_op_threads=0, inter_op_threads=0, xla_jit=False):
+    """
+    Configuration of the training and evaluation sessions
+    # Arguments
+        intra_op_threads: number of threads used within an operation, e.g.
+            a matrix multiplication, 0 lets TensorFlow choose
+        inter_op_threads: number of operations run in parallel, 0 lets
+            TensorFlow choose
+        xla_jit: if True, clusters of operations are compiled with XLA, also
+            on the CPU, see enable_xla_cpu_jit
+    # Return
+        tf.ConfigProto
+    """
+    config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                            inter_op_parallelism_threads=inter_op_threads)
+    if xla_jit:
+        enable_xla_cpu_jit()
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return config
+
+
+def enable_xla_cpu_jit():
+    """
+    Lets the XLA auto-clustering of the sessions apply to the CPU, which it
+    does not by default. The flag is read when the first session of the
+    process is created, so this has to be called before it. It has no effect
+    on sessions without XLA auto-clustering.
+    """
+    xla_flags = os.environ.get("TF_XLA_FLAGS", "")
+    if "--tf_xla_cpu_global_jit" not in xla_flags:
+        os.environ["TF_XLA_FLAGS"] = (xla_flags + " --tf_xla_cpu_global_jit").strip()
@@ -0,0 +1,73 @@
+"""
+Benchmark of the vectorized endpoint labelling against the forward window loop,
+on synthetic ICU stays
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+import pandas as pd
+
+import classes.dynamic_endpoints as eicu_dynamic_tf
+
+
+def synthetic_stay(n_steps, rs):
+    ''' Imputed time grid of one synthetic stay, with values spread over all
+    APACHE severity bands'''
+    df_imputed = pd.DataFrame({"ts": np.arange(n_steps)*60.0,
+        "vs_temperature": rs.normal(37, 2.5, n_steps),
+        "vs_systemicmean": rs.normal(85, 30, n_steps),
+        "vs_respiration": rs.normal(18, 10, n_steps),
+        "lab_HCO3": rs.normal(25, 8, n_steps),
+        "lab_sodium": rs.normal(140, 15, n_steps),
+        "lab_potassium": rs.normal(4.2, 1.2, n_steps),
+        "lab_creatinine": rs.gamma(2.0, 0.8, n_steps)})
+    df_pat = pd.DataFrame({"hospitaldischargelocation": ["Death"],
+        "unitdischargelocation": ["Floor"]})
+    return df_imputed, df_pat
+
+
+def benchmark_dynamic_endpoints(configs):
+    rs = np.random.RandomState(configs["random_state"])
+    n_steps = configs["stay_days"]*24
+    stays = [synthetic_stay(n_steps, rs) for _ in range(configs["n_stays"])]
+    extractor = eicu_dynamic_tf.DynamicEndpointExtractor()
+    timings = {}
+    outputs = {}
+
+    for mode, vectorized in [("loop", False), ("vectorized", True)]:
+        extractor.vectorized = vectorized
+        t_begin = timeit.default_timer()
+        outputs[mode] = [extractor.transform(df_imputed, df_pat, pid=pid) \
+                for pid, (df_imputed, df_pat) in enumerate(stays)]
+        timings[mode] = timeit.default_timer()-t_begin
+
+    for df_loop, df_vec in zip(outputs["loop"], outputs["vectorized"]):
+        assert(list(df_loop.columns) == list(df_vec.columns))
+        for col in df_loop.columns:
+            assert(np.array_equal(df_loop[col].values, df_vec[col].values))
+
+    print("Stays: {}, time steps per stay: {}".format(configs["n_stays"],
+        n_steps))
+    for mode in ["loop", "vectorized"]:
+        print("{}: {:.3f} s total, {:.4f} s per stay".format(mode,
+            timings[mode], timings[mode]/configs["n_stays"]))
+    print("Speed-up: {:.1f}x, outputs are identical".format(timings["loop"]\
+            /timings["vectorized"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # Parameters
+    parser.add_argument("--n_stays", type=int, default=10,
+            help="Number of synthetic stays to label")
+    parser.add_argument("--stay_days", type=int, default=30,
+            help="Length of each synthetic stay in days")
+    parser.add_argument("--random_state", type=int, default=2020,
+            help="Random seed for the synthetic data")
+
+    configs = vars(parser.parse_args())
+
+    benchmark_dynamic_endpoints(configs)
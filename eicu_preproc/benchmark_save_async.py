@@ -0,0 +1,126 @@
+"""
+Benchmark of the vectorized placement of the asynchronous observations in
+Timegridder.save_async against the per-observation loop it replaces, on a
+synthetic stay with vital signs at 1 minute resolution
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+import pandas as pd
+
+import classes.imputer as eicu_tf_impute
+
+VS_VARS = ["heartrate", "sao2", "respiration", "temperature",
+        "systemicmean"]
+AVS_VARS = ["noninvasivesystolic", "noninvasivediastolic", "noninvasivemean"]
+LAB_VARS = ["sodium", "potassium", "creatinine", "glucose", "lactate"]
+
+
+def synthetic_stay(stay_days, rs):
+    ''' Raw vital sign and lab tables of one synthetic stay, with the periodic
+    vital signs every minute, the aperiodic ones every 30 minutes and a few
+    labs a day, with missing values'''
+    n_mins = stay_days*24*60
+    vs_ts = np.arange(n_mins, dtype=np.float64)
+    df_vs = pd.DataFrame({"observationoffset": vs_ts})
+    for var in VS_VARS:
+        values = rs.normal(80, 15, n_mins)
+        values[rs.rand(n_mins) < 0.2] = np.nan
+        df_vs[var] = values
+    avs_ts = np.arange(0, n_mins, 30, dtype=np.float64)
+    df_avs = pd.DataFrame({"observationoffset": avs_ts})
+    for var in AVS_VARS:
+        values = rs.normal(90, 20, avs_ts.size)
+        values[rs.rand(avs_ts.size) < 0.3] = np.nan
+        df_avs[var] = values
+    n_labs = stay_days*6*len(LAB_VARS)
+    df_lab = pd.DataFrame({"labresultoffset": rs.randint(0, n_mins, n_labs)\
+            .astype(np.float64),
+        "labname": rs.choice(LAB_VARS+["troponin"], n_labs),
+        "labresult": rs.normal(5, 2, n_labs)})
+    return df_lab, df_vs, df_avs
+
+
+def save_async_loop(grid_model, df_lab, df_vs, df_avs):
+    ''' Previous save_async, placing every observation with np.where on the
+    time grid and tracking the empty rows in a list'''
+    df_lab = df_lab.sort_values(by="labresultoffset", kind="mergesort")
+    df_vs = df_vs.sort_values(by="observationoffset", kind="mergesort")
+    df_avs = df_avs.sort_values(by="observationoffset", kind="mergesort")
+    hr_col = df_vs[["observationoffset", "heartrate"]].dropna()
+    min_ts = hr_col.observationoffset.min()
+    max_ts = hr_col.observationoffset.max()
+    N = int(max_ts - min_ts + 1)
+    data_mat = np.zeros((N, 1 + len(grid_model.sel_vs_vars) \
+            + len(grid_model.sel_avs_vars) + len(grid_model.lab_vars)))*np.nan
+    time_arr = np.arange(min_ts, max_ts+1, 1).astype(np.int32)
+    data_mat[:,0] = time_arr
+
+    var_names = ["ts"]
+    var_idx = 1
+    ts_idx_list = list(range(N))
+    tables = [("vs", var, df_vs, "observationoffset", var) \
+            for var in grid_model.sel_vs_vars]
+    tables += [("avs", var, df_avs, "observationoffset", var) \
+            for var in grid_model.sel_avs_vars]
+    tables += [("lab", var, df_lab[df_lab["labname"] == var],
+        "labresultoffset", "labresult") for var in grid_model.lab_vars]
+    for prefix, var, df, ts_col, val_col in tables:
+        finite_df = df[[ts_col, val_col]].dropna()
+        for ts,val in zip(np.array(finite_df[ts_col]),
+                np.array(finite_df[val_col])):
+            if ts >= min_ts and ts <= max_ts:
+                ts_idx = np.where(time_arr==ts)[0][0]
+                data_mat[ts_idx, var_idx] = val
+                if ts_idx in ts_idx_list:
+                    ts_idx_list.remove(ts_idx)
+        var_idx += 1
+        var_names.append( "{}_{}".format(prefix, var) )
+
+    data_mat = np.delete(data_mat, ts_idx_list, 0)
+    return pd.DataFrame(data_mat, columns=var_names)
+
+
+def benchmark_save_async(configs):
+    rs = np.random.RandomState(configs["random_state"])
+    df_lab, df_vs, df_avs = synthetic_stay(configs["stay_days"], rs)
+    grid_model = eicu_tf_impute.Timegridder(sel_vs_vars=VS_VARS,
+            sel_avs_vars=AVS_VARS)
+    grid_model.set_selected_lab_vars(LAB_VARS)
+
+    t_begin = timeit.default_timer()
+    df_loop = save_async_loop(grid_model, df_lab, df_vs, df_avs)
+    t_loop = timeit.default_timer()-t_begin
+
+    t_begin = timeit.default_timer()
+    df_async = grid_model.save_async(df_lab.copy(), df_vs.copy(),
+            df_avs.copy())
+    t_vectorized = timeit.default_timer()-t_begin
+
+    assert(list(df_loop.columns) == list(df_async.columns))
+    assert(np.array_equal(df_loop.values, df_async.values, equal_nan=True))
+
+    print("Stay: {} days, observations: {} vital sign rows, {} lab rows, "
+            "output rows: {}".format(configs["stay_days"],
+                df_vs.shape[0]+df_avs.shape[0], df_lab.shape[0],
+                df_async.shape[0]))
+    print("loop: {:.3f} s, vectorized: {:.3f} s".format(t_loop,
+        t_vectorized))
+    print("Speed-up: {:.1f}x, outputs are identical".format(t_loop\
+            /t_vectorized))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # Parameters
+    parser.add_argument("--stay_days", type=int, default=30,
+            help="Length of the synthetic stay in days")
+    parser.add_argument("--random_state", type=int, default=2020,
+            help="Random seed for the synthetic data")
+
+    configs = vars(parser.parse_args())
+
+    benchmark_save_async(configs)
@@ -37,6 +37,42 @@ class DynamicEndpointExtractor():
         self.relevant_variables_vitals = ["temperature", "systemicmean", "respiration"]
         self.relevant_variables_lab = ["HCO3", "sodium", "potassium", "creatinine"]
 
+        # APACHE severity bands, as (output prefix, input column, unit factor,
+        # [(config, [lower, upper)), ...]), in order of decreasing severity
+        self.severity_bands = [
+            ("vs_temperature", "vs_temperature", 1, [
+                ("high4", [41, np.inf]), ("low4", [-np.inf, 30]),
+                ("high3", [39, 41]), ("low3", [30, 32]), ("low2", [32, 34]),
+                ("high1", [38.5, 39]), ("low1", [34, 36])]),
+            ("vs_systemicmean", "vs_systemicmean", 1, [
+                ("high4", [160, np.inf]), ("low4", [-np.inf, 50]),
+                ("high3", [130, 160]), ("high2", [110, 130]),
+                ("low2", [50, 70])]),
+            ("vs_respiration", "vs_respiration", 1, [
+                ("high4", [50, np.inf]), ("low4", [-np.inf, 6]),
+                ("high3", [35, 50]), ("low2", [6, 10]), ("high1", [25, 35]),
+                ("low1", [10, 12])]),
+            ("lab_hc03", "lab_HCO3", 1, [
+                ("high4", [52, np.inf]), ("low4", [-np.inf, 15]),
+                ("high3", [41, 52]), ("low3", [15, 18]), ("low2", [18, 23]),
+                ("high1", [32, 41])]),
+            ("lab_sodium", "lab_sodium", 1, [
+                ("high4", [180, np.inf]), ("low4", [-np.inf, 111]),
+                ("high3", [160, 180]), ("low3", [111, 120]),
+                ("high2", [155, 160]), ("low2", [120, 130]),
+                ("high1", [150, 155])]),
+            ("lab_potassium", "lab_potassium", 1, [
+                ("high4", [7, np.inf]), ("low4", [-np.inf, 2.5]),
+                ("high3", [6, 7]), ("low2", [2.5, 3]), ("high1", [5.5, 6]),
+                ("low1", [3, 3.5])]),
+            # Wrong unit in the input data
+            ("lab_creatinine", "lab_creatinine", 100, [
+                ("high4", [350, np.inf]), ("high3", [200, 350]),
+                ("high2", [150, 200]), ("low2", [-np.inf, 60])])]
+
+        # Use cumulative counts instead of looping over forward windows
+        self.vectorized = True
+
     def transform(self, df_imputed, df_pat, pid=None):
 
         df_out_dict = {}
@@ -81,170 +117,66 @@ class DynamicEndpointExtractor():
                     arr = np.zeros(df_imputed.shape[0], dtype=np.float64)
                     df_out_dict["hospital_discharge_{}_{}".format(var, hor)] = arr
 
-        # Process the vital sign variables of interest
-        temperature = np.array(df_imputed["vs_temperature"])
-        abpm = np.array(df_imputed["vs_systemicmean"])
-        rrate = np.array(df_imputed["vs_respiration"])
-        hco3 = np.array(df_imputed["lab_HCO3"])
-        sodium = np.array(df_imputed["lab_sodium"])
-        potassium = np.array(df_imputed["lab_potassium"])
-        creatinine = np.array(df_imputed["lab_creatinine"])*100  # Wrong unit in the input data
-
-        for hor in self.back_horizons:
-
-            full_score_out = np.zeros(df_imputed.shape[0])
-
-            # TEMPERATURE
-
-            set_indices = {}
-
-            for config, thresholds in [("high4", [41, np.inf]), ("low4", [-np.inf, 30]), ("high3", [39, 41]), ("low3", [30, 32]),
-                                       ("low2", [32, 34]), ("high1", [38.5, 39]), ("low1", [34, 36])]:
-
-                temp_out = np.zeros(df_imputed.shape[0])
-
-                for idx in np.arange(temperature.size):
-                    forward_window = temperature[idx:min(temperature.size, idx+hor)]
-                    assert(np.isfinite(forward_window).all())
-                    if ((forward_window >= thresholds[0]) & (forward_window < thresholds[1])).any():
-                        temp_out[idx] = 1.0
-
-                        if idx not in set_indices:
-                            full_score_out[idx] += int(config[-1])
-                            set_indices[idx] = True
-
-                df_out_dict["vs_temperature_{}_{}".format(config, hor)] = temp_out
-
-            # MEAN ARTERIAL PRESSURE
-
-            set_indices = {}
-
-            for config, thresholds in [("high4", [160, np.inf]), ("low4", [-np.inf, 50]), ("high3", [130, 160]), ("high2", [110, 130]),
-                                       ("low2", [50, 70])]:
-
-                abpm_out = np.zeros(df_imputed.shape[0])
-
-                for idx in np.arange(abpm.size):
-                    forward_window = abpm[idx:min(abpm.size, idx+hor)]
-                    assert(np.isfinite(forward_window).all())
-                    if ((forward_window >= thresholds[0]) & (forward_window < thresholds[1])).any():
-                        abpm_out[idx] = 1.0
-
-                        if idx not in set_indices:
-                            full_score_out[idx] += int(config[-1])
-                            set_indices[idx] = True
-
-                df_out_dict["vs_systemicmean_{}_{}".format(config, hor)] = abpm_out
-
-            # RESPIRATION RATE
-
-            set_indices = {}
-
-            for config, thresholds in [("high4", [50, np.inf]), ("low4", [-np.inf, 6]), ("high3", [35, 50]), ("low2", [6, 10]),
-                                       ("high1", [25, 35]), ("low1", [10, 12])]:
-
-                rrate_out = np.zeros(df_imputed.shape[0])
-
-                for idx in np.arange(rrate.size):
-                    forward_window = rrate[idx:min(rrate.size, idx+hor)]
-                    assert(np.isfinite(forward_window).all())
-                    if ((forward_window >= thresholds[0]) & (forward_window < thresholds[1])).any():
-                        rrate_out[idx] = 1.0
-
-                        if idx not in set_indices:
-                            full_score_out[idx] += int(config[-1])
-                            set_indices[idx] = True
-
-                df_out_dict["vs_respiration_{}_{}".format(config, hor)] = rrate_out
-
-            # HCO3 LAB VALUE
+        # Process the vital sign and lab variables of interest, all bands and
+        # horizons of a variable at once
+        band_outs = {}
 
-            set_indices = {}
+        for out_prefix, in_col, unit_factor, bands in self.severity_bands:
+            values = np.array(df_imputed[in_col])*unit_factor
+            assert(np.isfinite(values).all())
 
-            for config, thresholds in [("high4", [52, np.inf]), ("low4", [-np.inf, 15]), ("high3", [41, 52]), ("low3", [15, 18]), ("low2", [18, 23]), ("high1", [32, 41])]:
-
-                hco3_out = np.zeros(df_imputed.shape[0])
-
-                for idx in np.arange(hco3.size):
-                    forward_window = hco3[idx:min(hco3.size, idx+hor)]
-
-                    if not np.isfinite(forward_window).all():
-                        ipdb.set_trace()
-
-                    assert(np.isfinite(forward_window).all())
-                    if ((forward_window >= thresholds[0]) & (forward_window < thresholds[1])).any():
-                        hco3_out[idx] = 1.0
-
-                        if idx not in set_indices:
-                            full_score_out[idx] += int(config[-1])
-                            set_indices[idx] = True
-
-                df_out_dict["lab_hc03_{}_{}".format(config, hor)] = hco3_out
-
-            # SODIUM LAB VALUE
-
-            set_indices = {}
-
-            for config, thresholds in [("high4", [180, np.inf]), ("low4", [-np.inf, 111]), ("high3", [160, 180]), ("low3", [111, 120]), ("high2", [155, 160]), ("low2", [120, 130]), ("high1", [150, 155])]:
-
-                sodium_out = np.zeros(df_imputed.shape[0])
-
-                for idx in np.arange(sodium.size):
-                    forward_window = sodium[idx:min(sodium.size, idx+hor)]
-                    assert(np.isfinite(forward_window).all())
-                    if ((forward_window >= thresholds[0]) & (forward_window < thresholds[1])).any():
-                        sodium_out[idx] = 1.0
-
-                        if idx not in set_indices:
-                            full_score_out[idx] += int(config[-1])
-                            set_indices[idx] = True
-
-                df_out_dict["lab_sodium_{}_{}".format(config, hor)] = sodium_out
-
-            # POTASSIUM LAB VALUE
-
-            set_indices = {}
-
-            for config, thresholds in [("high4", [7, np.inf]), ("low4", [-np.inf, 2.5]), ("high3", [6, 7]), ("low2", [2.5, 3]), ("high1", [5.5, 6]), ("low1", [3, 3.5])]:
-
-                potassium_out = np.zeros(df_imputed.shape[0])
-
-                for idx in np.arange(potassium.size):
-                    forward_window = potassium[idx:min(potassium.size, idx+hor)]
-                    assert(np.isfinite(forward_window).all())
-                    if ((forward_window >= thresholds[0]) & (forward_window < thresholds[1])).any():
-                        potassium_out[idx] = 1.0
-
-                        if idx not in set_indices:
-                            full_score_out[idx] += int(config[-1])
-                            set_indices[idx] = True
-
-                df_out_dict["lab_potassium_{}_{}".format(config, hor)] = potassium_out
-
-            # CREATININE LAB VALUE
-
-            set_indices = {}
+            if self.vectorized:
+                band_outs[out_prefix] = self._forward_window_bands(values,
+                        bands, self.back_horizons)
+            else:
+                band_outs[out_prefix] = self._forward_window_bands_loop(values,
+                        bands, self.back_horizons)
 
-            for config, thresholds in [("high4", [350, np.inf]), ("high3", [200, 350]), ("high2", [150, 200]), ("low2", [-np.inf, 60])]:
+        for hidx, hor in enumerate(self.back_horizons):
 
-                creatinine_out = np.zeros(creatinine.size)
+            full_score_out = np.zeros(df_imputed.shape[0])
 
-                for idx in np.arange(creatinine.size):
-                    forward_window = creatinine[idx:min(creatinine.size, idx+hor)]
-                    assert(np.isfinite(forward_window).all())
-                    if ((forward_window >= thresholds[0]) & (forward_window < thresholds[1])).any():
-                        creatinine_out[idx] = 1.0
+            for out_prefix, _, _, bands in self.severity_bands:
 
-                        if idx not in set_indices:
-                            full_score_out[idx] += int(config[-1])
-                            set_indices[idx] = True
+                # Only the first (most severe) band that is hit contributes to
+                # the score at a time point
+                set_indices = np.zeros(df_imputed.shape[0], dtype=np.bool_)
 
-                df_out_dict["lab_creatinine_{}_{}".format(config, hor)] = creatinine_out
+                for (config, _), out_arr in zip(bands,
+                        band_outs[out_prefix][hidx]):
+                    hit_first = (out_arr == 1.0) & ~set_indices
+                    full_score_out[hit_first] += int(config[-1])
+                    set_indices |= hit_first
+                    df_out_dict["{}_{}_{}".format(out_prefix, config,
+                        hor)] = out_arr
 
             df_out_dict["full_score_{}".format(hor)] = full_score_out
 
-        # Process the lab variables of interest
-
         df_out = pd.DataFrame(df_out_dict)
 
         return df_out
+
+    def _forward_window_bands(self, values, bands, horizons):
+        ''' Marks, for each horizon and band, the time points for which a
+        value in the band occurs in the forward window of that length'''
+        lower = np.array([thresholds[0] for _, thresholds in bands])
+        upper = np.array([thresholds[1] for _, thresholds in bands])
+        in_band = (values >= lower[:, np.newaxis]) \
+                & (values < upper[:, np.newaxis])
+        return mlhc_array.forward_window_any(in_band, horizons).astype(\
+                np.float64)
+
+    def _forward_window_bands_loop(self, values, bands, horizons):
+        ''' Reference implementation of _forward_window_bands, looping over
+        all forward windows'''
+        band_out = np.zeros((len(horizons), len(bands), values.size))
+
+        for hidx, hor in enumerate(horizons):
+            for bidx, (_, thresholds) in enumerate(bands):
+                for idx in np.arange(values.size):
+                    forward_window = values[idx:min(values.size, idx+hor)]
+                    if ((forward_window >= thresholds[0]) & (forward_window \
+                            < thresholds[1])).any():
+                        band_out[hidx, bidx, idx] = 1.0
+
+        return band_out
@@ -19,7 +19,8 @@ class Timegridder():
     ''' Function transforming the input table from the eICU tables into " \
             "imputed values'''
 
-    def __init__(self, timegrid_step_mins=60.0):
+    def __init__(self, timegrid_step_mins=60.0, sel_vs_vars=None,
+            sel_avs_vars=None):
 
 #        # List of selected vitalPeriodic variables
 #        self.sel_vs_vars = ["temperature", "sao2", "heartrate", "respiration",
@@ -32,19 +33,22 @@ class Timegridder():
 #                "noninvasivemean", "paop", "cardiacoutput",
 #                "cardiacinput", "svr", "svri", "pvr", "pvri"]
 #
-        vs_vars = []
-        with open( pj(HOME, "Datasets/eicu-2.0/included_per_variables.txt") ) \
-                as fp:
-            for line in fp:
-                vs_vars.append( line.strip() )
-        self.sel_vs_vars = vs_vars
-
-        avs_vars = []
-        with open( pj(HOME, "Datasets/eicu-2.0/included_aper_variables.txt") )\
-                as fp:
-            for line in fp:
-                avs_vars.append( line.strip() )
-        self.sel_avs_vars = avs_vars
+        # The selected variables are read from the variable lists by default
+        if sel_vs_vars is None:
+            sel_vs_vars = []
+            with open( pj(HOME,
+                "Datasets/eicu-2.0/included_per_variables.txt") ) as fp:
+                for line in fp:
+                    sel_vs_vars.append( line.strip() )
+        self.sel_vs_vars = sel_vs_vars
+
+        if sel_avs_vars is None:
+            sel_avs_vars = []
+            with open( pj(HOME,
+                "Datasets/eicu-2.0/included_aper_variables.txt") ) as fp:
+                for line in fp:
+                    sel_avs_vars.append( line.strip() )
+        self.sel_avs_vars = sel_avs_vars
 
         # Time grid interval length in minutes
         self.timegrid_step_mins = timegrid_step_mins
@@ -96,52 +100,38 @@ class Timegridder():
         # Add timestamps in at the end
 
         var_names = ["ts"]
+        var_names.extend(["vs_{}".format(var) for var in self.sel_vs_vars])
+        var_names.extend(["avs_{}".format(var) for var in self.sel_avs_vars])
+        var_names.extend(["lab_{}".format(var) for var in self.lab_vars])
+
+        # Timestamps that have data in any variable
+        occupied = np.zeros(N, dtype=np.bool_)
         var_idx = 1
-        ts_idx_list = list(range(N)) # List of timestamps that have no data
-        for var in self.sel_vs_vars:
-            finite_df = df_vs[["observationoffset", var]].dropna() 
-            raw_ts = np.array(finite_df["observationoffset"])
-            raw_values = np.array(finite_df[var])
-            for ts,val in zip(raw_ts,raw_values):
-                if ts >= min_ts and ts <= max_ts:
-                    ts_idx = np.where(time_arr==ts)[0][0]
-                    data_mat[ts_idx, var_idx] = val
-                    if ts_idx in ts_idx_list:
-                        ts_idx_list.remove(ts_idx)
-            var_idx += 1
-            var_names.append( "vs_{}".format(var) )
-
-        for var in self.sel_avs_vars:
-            finite_df = df_avs[["observationoffset", var]].dropna()
-            raw_ts = np.array(finite_df["observationoffset"])
-            raw_values = np.array(finite_df[var])
-            for ts,val in zip(raw_ts,raw_values):
-                if ts >= min_ts and ts <= max_ts:
-                    ts_idx = np.where(time_arr==ts)[0][0]
-                    data_mat[ts_idx, var_idx] = val
-                    if ts_idx in ts_idx_list:
-                        ts_idx_list.remove(ts_idx)
-            var_idx += 1
-            var_names.append( "avs_{}".format(var) )
-
-        for var in self.lab_vars:
-            sel_df = df_lab[df_lab["labname"] == var]
-            if sel_df.shape[0] > 0:
-                finite_df = sel_df[["labresultoffset", "labresult"]].dropna()
-                raw_ts = np.array(finite_df["labresultoffset"])
-                raw_values = np.array(finite_df["labresult"])
-                for ts,val in zip(raw_ts,raw_values):
-                    if ts >= min_ts and ts <= max_ts:
-                        ts_idx = np.where(time_arr==ts)[0][0]
-                        data_mat[ts_idx, var_idx] = val
-                        if ts_idx in ts_idx_list:
-                            ts_idx_list.remove(ts_idx)
-            var_idx += 1
-            var_names.append( "lab_{}".format(var) )
+        self._place_async(data_mat, occupied, time_arr, var_idx,
+                np.array(df_vs["observationoffset"], dtype=np.float64),
+                np.array(df_vs[self.sel_vs_vars], dtype=np.float64))
+        var_idx += len(self.sel_vs_vars)
+
+        self._place_async(data_mat, occupied, time_arr, var_idx,
+                np.array(df_avs["observationoffset"], dtype=np.float64),
+                np.array(df_avs[self.sel_avs_vars], dtype=np.float64))
+        var_idx += len(self.sel_avs_vars)
+
+        # Spread the lab results into one column per selected lab variable
+        lab_codes = np.array(pd.Categorical(df_lab["labname"],
+            categories=self.lab_vars).codes)
+        sel_rows = lab_codes >= 0
+        lab_values = mlhc_array.empty_nan((np.sum(sel_rows),
+            len(self.lab_vars)))
+        lab_values[np.arange(lab_values.shape[0]), lab_codes[sel_rows]] = \
+                np.array(df_lab["labresult"], dtype=np.float64)[sel_rows]
+        self._place_async(data_mat, occupied, time_arr, var_idx,
+                np.array(df_lab["labresultoffset"], dtype=np.float64)[sel_rows],
+                lab_values)
 
         self._adapt_vars_for_async(reset=True)
 
-        data_mat = np.delete(data_mat, ts_idx_list, 0)
+        data_mat = data_mat[occupied]
 
         df_out = pd.DataFrame(data_mat, columns=var_names)
         return df_out
@@ -164,51 +154,75 @@ class Timegridder():
             df_out_dict["patientunitstayid"] = mlhc_array.value_empty(\
                     timegrid.size, int(pid))
 
-        for var in self.sel_vs_vars:
-            finite_df = df_vs[["observationoffset", var]].dropna()
-            raw_ts = np.array(finite_df["observationoffset"])
-            raw_values = np.array(finite_df[var])
-            pred_values = eicu_impute.impute_variable(raw_ts, raw_values,
-                    timegrid, leave_nan_threshold_secs=\
-                            self.max_forward_fill_secs_vs,
-                            grid_period=self.timegrid_step_mins,
-                            normal_value=self.var_quantile_dict[\
-                                    "periodic_"+var][49])
-            df_out_dict["vs_{}".format(var)] = pred_values
-
-        for var in self.sel_avs_vars:
-            finite_df = df_avs[["observationoffset", var]].dropna()
-            raw_ts = np.array(finite_df["observationoffset"])
-            raw_values = np.array(finite_df[var])
-            pred_values = eicu_impute.impute_variable(raw_ts, raw_values,
-                    timegrid, leave_nan_threshold_secs=\
-                            self.max_forward_fill_secs_avs,
-                            grid_period=self.timegrid_step_mins,
-                            normal_value=self.var_quantile_dict[\
-                                    "aperiodic_"+var][49])
-            df_out_dict["avs_{}".format(var)] = pred_values
-
-        for var in self.lab_vars:
-            normal_value = self.var_quantile_dict["lab_"+var][49]
-            sel_df = df_lab[df_lab["labname"] == var]
-            if sel_df.shape[0] == 0:
-                pred_values = mlhc_array.value_empty(timegrid.size,
-                        normal_value)
-            else:
-                finite_df = sel_df[["labresultoffset", "labresult"]].dropna()
-                raw_ts = np.array(finite_df["labresultoffset"])
-                raw_values = np.array(finite_df["labresult"])
-                pred_values = eicu_impute.impute_variable(raw_ts, raw_values,
-                        timegrid, leave_nan_threshold_secs=\
-                                self.max_forward_fill_secs_lab,
-                                grid_period=self.timegrid_step_mins,
-                                normal_value=normal_value)
-
-            df_out_dict["lab_{}".format(var)] = pred_values
+        # Impute all variables of a table in a single call
+        pred_values = eicu_impute.impute_variables(\
+                np.array(df_vs["observationoffset"]),
+                np.array(df_vs[self.sel_vs_vars], dtype=np.float64), timegrid,
+                leave_nan_threshold_secs=self.max_forward_fill_secs_vs,
+                grid_period=self.timegrid_step_mins,
+                normal_values=[self.var_quantile_dict["periodic_"+var][49] \
+                        for var in self.sel_vs_vars])
+
+        for vidx, var in enumerate(self.sel_vs_vars):
+            df_out_dict["vs_{}".format(var)] = pred_values[:, vidx]
+
+        pred_values = eicu_impute.impute_variables(\
+                np.array(df_avs["observationoffset"]),
+                np.array(df_avs[self.sel_avs_vars], dtype=np.float64),
+                timegrid,
+                leave_nan_threshold_secs=self.max_forward_fill_secs_avs,
+                grid_period=self.timegrid_step_mins,
+                normal_values=[self.var_quantile_dict["aperiodic_"+var][49] \
+                        for var in self.sel_avs_vars])
+
+        for vidx, var in enumerate(self.sel_avs_vars):
+            df_out_dict["avs_{}".format(var)] = pred_values[:, vidx]
+
+        # Spread the lab results into one column per selected lab variable
+        lab_codes = np.array(pd.Categorical(df_lab["labname"],
+            categories=self.lab_vars).codes)
+        sel_rows = lab_codes >= 0
+        lab_values = mlhc_array.empty_nan((np.sum(sel_rows),
+            len(self.lab_vars)))
+        lab_values[np.arange(lab_values.shape[0]), lab_codes[sel_rows]] = \
+                np.array(df_lab["labresult"], dtype=np.float64)[sel_rows]
+
+        pred_values = eicu_impute.impute_variables(\
+                np.array(df_lab["labresultoffset"])[sel_rows], lab_values,
+                timegrid,
+                leave_nan_threshold_secs=self.max_forward_fill_secs_lab,
+                grid_period=self.timegrid_step_mins,
+                normal_values=[self.var_quantile_dict["lab_"+var][49] \
+                        for var in self.lab_vars])
+
+        for vidx, var in enumerate(self.lab_vars):
+            df_out_dict["lab_{}".format(var)] = pred_values[:, vidx]
 
         df_out = pd.DataFrame(df_out_dict)
         return df_out
 
+    def _place_async(self, data_mat, occupied, time_arr, var_idx, raw_ts,
+            raw_values):
+        ''' Writes the non-missing observations of a table, with time stamps
+        raw_ts and one column per variable in raw_values, into the columns of
+        data_mat starting at var_idx, at the rows of their time stamps in
+        time_arr, and marks these rows as occupied. Observations outside of
+        time_arr are dropped, and the last of several observations of a
+        variable at the same time stamp is kept'''
+        ts_idx = np.searchsorted(time_arr, raw_ts)
+        on_grid = (raw_ts >= time_arr[0]) & (raw_ts <= time_arr[-1])
+        on_grid[on_grid] = time_arr[ts_idx[on_grid]] == raw_ts[on_grid]
+        obs_idx, col_idx = np.nonzero(~np.isnan(raw_values) \
+                & on_grid[:, np.newaxis])
+        flat_idx = ts_idx[obs_idx]*data_mat.shape[1] + var_idx + col_idx
+
+        # Keep the first index of every cell in the reversed order
+        _, last_idx = np.unique(flat_idx[::-1], return_index=True)
+        last_idx = flat_idx.size - 1 - last_idx
+        data_mat.flat[flat_idx[last_idx]] = \
+                raw_values[obs_idx[last_idx], col_idx[last_idx]]
+        occupied[ts_idx[obs_idx]] = True
+
     def _adapt_vars_for_async(self, reset):
         if reset:
             self.timegrid_step_mins = self._cache_tsm
@@ -5,6 +5,8 @@ Static data extraction from eICU
 import numpy as np
 import pandas as pd
 
+import functions.util_table as mlhc_table
+
 class StaticExtractor():
     
     def __init__(self):
@@ -124,19 +126,91 @@ class StaticExtractor():
         df_out = pd.DataFrame(df_out_dict)
 
         if self.debug:
-            n_cols = len(df_out.columns.values.tolist())
-            assert(n_cols == 71)
-            col_types = df_out.dtypes.values.tolist()
-            float_cnt = 0
-            int_cnt = 0
+            self._check_output(df_out)
+
+        return df_out
+
+    def read_tables(self, table_paths, pids, chunk_size=1000000):
+        ''' Reads the used columns of the patient, apacheApsVar,
+        apachePatientResult and apachePredVar tables, given in this order, in
+        one chunked pass over each table, keeping the rows of the patient
+        stays'''
+        table_columns = [["gender"]+self.pat_table_cont_vars,
+                self.aav_table_cont_vars, self.apr_table_cont_vars,
+                self.apv_table_cont_vars]
+        return [mlhc_table.read_table_columns(table_path,
+            ["patientunitstayid"]+columns, pids=pids, chunk_size=chunk_size) \
+                    for table_path, columns in zip(table_paths, table_columns)]
+
+    def _rows_by_pid(self, df, pids, unique=False):
+        ''' Returns the first row of each patient stay of a table, in the order
+        of pids, with missing values for stays without a row'''
+        df = df.assign(patientunitstayid=df["patientunitstayid"].astype(\
+                np.int64))
+        df = df[df["patientunitstayid"].isin(pids)]
+        if unique:
+            assert(not df["patientunitstayid"].duplicated().any())
+        return df.drop_duplicates("patientunitstayid", keep="first")\
+                .set_index("patientunitstayid").reindex(pids)
+
+    def transform_all(self, df_pat, df_aav, df_apr, df_apv, pids):
+        ''' Extracts the static variables of many patient stays at once, from
+        the tables joined on patientunitstayid, and returns one row per
+        patient stay, in the order of pids, with the same columns and values
+        as transform'''
+        pids = pd.Index(np.array(pids, dtype=np.int64))
+        df_out_dict = {}
+
+        if self.create_pid_col:
+            df_out_dict["patientunitstayid"] = np.array(pids, dtype=np.int64)
 
-            for col_type in col_types:
-                if col_type == np.dtype("int64"):
-                    int_cnt += 1
-                elif col_type == np.dtype("float64"):
-                    float_cnt += 1
+        # Every patient stay has a row in the patient table
+        assert(pids.isin(df_pat["patientunitstayid"].astype(np.int64)).all())
+        df_pat = self._rows_by_pid(df_pat, pids)
 
-            assert(float_cnt == 70)
-            assert(int_cnt == 1)
+        # GENDER
+        df_out_dict["patient_gender"] = np.array(df_pat["gender"].map(\
+                {"Male": 1.0, "Female": 0.0}), dtype=np.float64)
+
+        # ALL CONTINUOUS VARIABLES IN PATIENT TABLE, NON-NUMERIC VALUES ARE
+        # MISSING
+        for var in self.pat_table_cont_vars:
+            df_out_dict["patient_{}".format(var)] = np.array(pd.to_numeric(\
+                    df_pat[var], errors="coerce"), dtype=np.float64)
+
+        # -1 ENCODING FOR MISSING VALUES IN THE AAV AND APV TABLES
+        table_specs = [(df_aav, "apacheapsvar", self.aav_table_cont_vars,
+            True), (df_apr, "apachepatientresult", self.apr_table_cont_vars,
+                False), (df_apv, "apachepredvar", self.apv_table_cont_vars,
+                    True)]
+
+        for df_table, prefix, table_vars, unique in table_specs:
+            df_table = self._rows_by_pid(df_table, pids, unique=unique)
+            var_vals = np.array(df_table[table_vars], dtype=np.float64)
+            if unique:
+                var_vals[var_vals == -1] = np.nan
+            for var_idx, var in enumerate(table_vars):
+                df_out_dict["{}_{}".format(prefix, var)] = var_vals[:, var_idx]
+
+        df_out = pd.DataFrame(df_out_dict)
+
+        if self.debug:
+            self._check_output(df_out)
 
         return df_out
+
+    def _check_output(self, df_out):
+        n_cols = len(df_out.columns.values.tolist())
+        assert(n_cols == 71)
+        col_types = df_out.dtypes.values.tolist()
+        float_cnt = 0
+        int_cnt = 0
+
+        for col_type in col_types:
+            if col_type == np.dtype("int64"):
+                int_cnt += 1
+            elif col_type == np.dtype("float64"):
+                float_cnt += 1
+
+        assert(float_cnt == 70)
+        assert(int_cnt == 1)
@@ -5,9 +5,10 @@ import argparse
 import os
 
 import pandas as pd
-import numpy as np
 
 import functions.util_io as mlhc_io
+import functions.util_quantile as mlhc_quantile
+import functions.util_table as mlhc_table
 
 pe = os.path.exists
 pj = os.path.join
@@ -24,74 +25,48 @@ def save_variable_quantiles(configs):
     var_quantiles={}
 
     print("Lab table...")
-    df_lab = pd.read_hdf(configs["lab_table_path"],mode='r')
-    df_lab = df_lab[df_lab.patientunitstayid.isin(all_pids)]
+    df_lab = mlhc_table.read_table_columns(configs["lab_table_path"],
+            ["labname", "labresult"], pids=all_pids,
+            chunk_size=configs["chunk_size"])
     print("Loaded lab table with {} rows".format(df_lab.shape[0]))
-    all_lab_vars = df_lab.labname.unique()
-
-    for lab_var in all_lab_vars:
-        print("Lab variable: {}".format(lab_var))
-        df_var = df_lab[df_lab.labname==lab_var]
-        var_quantiles["lab_"+lab_var]=[]
-
-        for quantile in np.arange(0.01,1.00,0.01):
-            quant_val = df_var.labresult.quantile(quantile)
-            var_quantiles["lab_"+lab_var].append(quant_val)
-
-        print("List length: {}".format(len(var_quantiles["lab_"+lab_var])))
+    lab_quantiles = mlhc_quantile.grouped_quantiles(df_lab, "labname",
+            "labresult")
+    for lab_var, quant_vals in lab_quantiles.items():
+        var_quantiles["lab_"+lab_var] = quant_vals
+    print("Lab variables: {}".format(len(lab_quantiles)))
     gc.collect()
-        
+
     print("Vital periodic table...")
-    found_eof = False
-    ct = 0
-    blk_sz = 1000000
-    df_cts = []
-    num_records = 0
-    while not found_eof:
-        df_ct = pd.read_hdf(configs["vital_per_path"], mode='r',
-                start=ct*blk_sz, stop=(ct+1)*blk_sz)
-        if len(df_ct) != blk_sz:
-            found_eof = True
-        df_ct = df_ct[ df_ct.patientunitstayid.isin(all_pids) ]
-        df_cts.append(df_ct)
-        num_records += len(df_ct)
-        ct += 1
-        print("%d Vital periodic records loaded" % num_records)
-    df_vital_per = pd.concat(df_cts)
-    print("Loaded vital periodic table with {} rows".format(\
-            df_vital_per.shape[0]))
+    vital_per_chunks = mlhc_table.iter_table_chunks(configs["vital_per_path"],
+            columns=vital_per_variables, pids=all_pids,
+            chunk_size=configs["chunk_size"])
+    if configs["quantile_mode"] == "sketch":
+        per_quantiles = mlhc_table.fold_chunks(vital_per_chunks,
+                {"quantiles": mlhc_table.ColumnSketches(vital_per_variables,
+                    compression=configs["sketch_compression"])})["quantiles"]
+    else:
+        df_vital_per = pd.concat(list(vital_per_chunks))
+        print("Loaded vital periodic table with {} rows".format(\
+                df_vital_per.shape[0]))
+        per_quantiles = mlhc_quantile.column_quantiles(df_vital_per,
+                vital_per_variables)
+        del df_vital_per
 
     for per_var in vital_per_variables:
-        print("Periodic variable: {}".format(per_var))
-        df_col = df_vital_per[per_var]
-        var_quantiles["periodic_"+per_var] = []
-
-        for quantile in np.arange(0.01,1.00,0.01):
-            quant_val = df_col.quantile(quantile)
-            var_quantiles["periodic_"+per_var].append(quant_val)
-                
-        print("List length: {}".format(\
-                len(var_quantiles["periodic_"+per_var])))
+        var_quantiles["periodic_"+per_var] = per_quantiles[per_var]
 
     gc.collect()
     print("Vital aperiodic table...")
-    df_vital_aper = pd.read_hdf(configs["vital_aper_path"],mode='r')
-    df_vital_aper = df_vital_aper[df_vital_aper.patientunitstayid.isin(\
-            all_pids)]
+    df_vital_aper = mlhc_table.read_table_columns(configs["vital_aper_path"],
+            vital_aper_variables, pids=all_pids,
+            chunk_size=configs["chunk_size"])
     print("Loaded vital aperiodic table with {} rows".format(\
             df_vital_aper.shape[0]))
-    
+
+    aper_quantiles = mlhc_quantile.column_quantiles(df_vital_aper,
+            vital_aper_variables)
     for aper_var in vital_aper_variables:
-        print("Aperiodic variable: {}".format(aper_var))
-        df_col = df_vital_aper[aper_var]
-        var_quantiles["aperiodic_"+aper_var] = []
-        
-        for quantile in np.arange(0.01,1.00,0.01):
-            quant_val = df_col.quantile(quantile)
-            var_quantiles["aperiodic_"+aper_var].append(quant_val)
-                        
-        print("List length: {}".format(\
-                len(var_quantiles["aperiodic_"+aper_var])))
+        var_quantiles["aperiodic_"+aper_var] = aper_quantiles[aper_var]
 
     gc.collect()
     quantile_fp=open(configs["quantile_path"],mode='w')
@@ -128,6 +103,17 @@ if __name__=="__main__":
             default=pj(HOME, "Datasets/eicu-2.0/var_quantiles.json"),
             help="JSON quantile dict")
 
+    # Parameters
+    parser.add_argument("--chunk_size", type=int, default=1000000,
+            help="Number of rows of the tables read at a time")
+    parser.add_argument("--quantile_mode", default="exact",
+            choices=["exact", "sketch"],
+            help="Exact quantiles of the periodic table loaded in memory, or "
+            "approximate ones merged from a sketch of each chunk")
+    parser.add_argument("--sketch_compression", type=int, default=10000,
+            help="Points kept per chunk and variable in sketch mode, the "
+            "rank error is at most the number of rows divided by this")
+
     configs=vars(parser.parse_args())
     
     save_variable_quantiles(configs)
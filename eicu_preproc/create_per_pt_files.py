@@ -11,23 +11,42 @@ pe = os.path.exists
 pj = os.path.join
 HOME = os.path.expanduser("~")
 
+def write_csv_files(df, pts_dir):
+    # One pass over the batch instead of one scan per patient
+    for pt_id, df_pt in df.groupby("patientunitstayid", sort=False):
+        df_pt.to_csv( pj(pts_dir, str(pt_id)+".csv") )
+
+
 def main(cfg):
     data_supdir = os.path.abspath( cfg["data_supdir"] )
     batches_dir = pj(data_supdir, cfg["batches_subdir"])
-    pts_dir = pj(data_supdir, cfg["batches_subdir"]+"_pts")
+    if cfg["output_format"] == "parquet":
+        # Imported here, as the CSV files do not need pyarrow
+        import functions.util_parquet as mlhc_parquet
+        pts_dir = pj(data_supdir, cfg["batches_subdir"]+"_parquet")
+    else:
+        pts_dir = pj(data_supdir, cfg["batches_subdir"]+"_pts")
     if not pe(pts_dir):
         os.makedirs(pts_dir)
     print("Processing batches...")
-    for f in os.listdir(batches_dir):
+    df_indices = []
+    for f in sorted(os.listdir(batches_dir)):
         if not f.endswith(".h5"):
             continue
         df = pd.read_hdf( pj(batches_dir,f) )
         convert_d = {"patientunitstayid" : "int64", "ts" : "int64"}
         df = df.astype(convert_d)
-        pt_ids = df.patientunitstayid.unique()
-        for pt_id in pt_ids:
-            df_pt = df[ df.patientunitstayid==pt_id ]
-            df_pt.to_csv( pj(pts_dir, str(pt_id)+".csv") )
+        if cfg["output_format"] == "parquet":
+            df_indices.append(mlhc_parquet.write_patient_file(df,
+                pj(pts_dir, os.path.splitext(f)[0]+".parquet"),
+                row_group_patients=cfg["row_group_patients"],
+                compression=cfg["compression"]))
+        else:
+            write_csv_files(df, pts_dir)
+    if cfg["output_format"] == "parquet":
+        df_index = mlhc_parquet.write_pid_index(df_indices, pts_dir)
+        print("Indexed {} patient stays in {} files".format(df_index.shape[0],
+            len(df_indices)))
     print("...Done")
 
 
@@ -37,6 +56,15 @@ if __name__ == "__main__":
             default=pj(HOME, "Datasets/EHRs/eICU"))
     parser.add_argument("-b", "--batches-subdir", type=str,
             default="time_grid")
+    parser.add_argument("--output_format", default="csv",
+            choices=["csv", "parquet"],
+            help="One CSV file per patient, or a Parquet dataset with one " \
+                    "file per batch and an index of the rows of each patient")
+    parser.add_argument("--row_group_patients", type=int, default=8,
+            help="Number of patients per row group of the Parquet files, " \
+                    "the unit that is read to access one patient")
+    parser.add_argument("--compression", default="zstd",
+            help="Compression codec of the Parquet files")
     cfg = vars( parser.parse_args() )
     main(cfg)
 
@@ -5,7 +5,9 @@ Create a single csv file with all the static info in it
 import argparse
 import numpy as np
 import os
-import pandas as pd
+
+import classes.static_extractor as eicu_static_tf
+import functions.util_io as mlhc_io
 
 pe = os.path.exists
 pj = os.path.join
@@ -13,17 +15,27 @@ HOME = os.path.expanduser("~")
 
 def main(cfg):
     data_supdir = os.path.abspath( cfg["data_supdir"] )
-    static_dir = pj(data_supdir, "static_pts")
-    paths = [pj(static_dir,f) for f in os.listdir(static_dir)]
-    df = pd.read_csv(paths[0])
-    for path in paths[1:]:
-        df = df.append( pd.read_csv(path) )
+    pids = list(map(int, mlhc_io.read_list_from_file(cfg["included_pid_path"])))
+    # The static variables of all patient stays are extracted at once, from
+    # the tables joined on patientunitstayid
+    static_extractor = eicu_static_tf.StaticExtractor()
+    table_paths = [pj(cfg["hdf_dir"], "{}.h5".format(table)) for table in \
+            ["patient", "apacheApsVar", "apachePatientResult", "apachePredVar"]]
+    df = static_extractor.transform_all(*static_extractor.read_tables(\
+            table_paths, pids, chunk_size=cfg["chunk_size"]), pids=pids)
     df.to_csv( pj(data_supdir, "static.csv") )
+    print("Wrote static data of {} patient stays".format(df.shape[0]))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--data-supdir", type=str,
             default=pj(HOME, "Datasets/EHRs/eICU"))
+    parser.add_argument("--hdf_dir", default=pj(HOME, "Datasets/eicu-2.0/hdf"),
+            help="Directory of the HDF tables")
+    parser.add_argument("--included_pid_path",
+            default=pj(HOME, "Datasets/eicu-2.0/included_pid_stays.txt"),
+            help="Patient stays whose static data is saved")
+    parser.add_argument("--chunk_size", type=int, default=1000000,
+            help="Number of table rows read at a time")
     cfg = vars( parser.parse_args() )
     main(cfg)
-
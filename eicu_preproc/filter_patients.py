@@ -6,48 +6,64 @@ import argparse
 import ipdb
 import numpy as np
 import os
-import pandas as pd
 
 import functions.util_io as mlhc_io
+import functions.util_table as mlhc_table
 
 pe = os.path.exists
 pj = os.path.join
 HOME = os.path.expanduser("~")
 
+def compute_hr_spans(configs, pids):
+    ''' Computes the first and last time and the largest gap between
+    consecutive heart rate observations of all patient stays, in one chunked
+    scan of the vital periodic table'''
+    if configs["partition_dir"] is None:
+        table_path = configs["vital_per_table_path"]
+        dset_id = None
+    else:
+        # Rows of a stay are contiguous in the partitioned table
+        table_path = pj(configs["partition_dir"], os.path.basename(\
+                configs["vital_per_table_path"]))
+        dset_id = "data"
+    columns = ["patientunitstayid", "observationoffset", "heartrate"]
+    spans = mlhc_table.fold_chunks(mlhc_table.iter_table_chunks(table_path,
+        columns=columns, pids=pids, chunk_size=configs["chunk_size"],
+        dset_id=dset_id), {"hr": mlhc_table.ObservationSpans(\
+            "observationoffset", "heartrate")})["hr"]
+
+    # Stays whose rows are spread over chunks with interleaved times are
+    # summarized again from all of their rows
+    inexact_pids = spans.index[~spans["exact"]]
+    if len(inexact_pids) > 0:
+        print("Re-reading {} interleaved patient stays".format(\
+                len(inexact_pids)))
+        hr_spans = mlhc_table.ObservationSpans("observationoffset",
+                "heartrate")
+        spans.loc[inexact_pids] = hr_spans.summarize(\
+                mlhc_table.read_table_columns(table_path, columns,
+                    pids=inexact_pids, chunk_size=configs["chunk_size"],
+                    dset_id=dset_id)).loc[inexact_pids]
+    return spans
+
+
 def filter_patients(configs):
     pid_list = mlhc_io.read_list_from_file(configs["all_pid_stay_path"])
     print("Number of PID stays in the database: {}".format(len(pid_list)))
-    included_patients = []
-
-    for pidx, pid in enumerate(pid_list):
-        if (pidx+1) % 100 == 0:
-            print("PID: {}/{}".format(pidx+1, len(pid_list)))
-            print("Included patient stays: {}/{}".format(\
-                    len(included_patients), pidx+1))
-        df_vs = pd.read_hdf(configs["vital_per_table_path"], mode='r',
-                where="patientunitstayid={}".format(pid))
-        df_vs.sort_values(by="observationoffset", inplace=True,
-                kind="mergesort")
-        hr_col = df_vs[["observationoffset", "heartrate"]].dropna()
-        diffed_hr_col = hr_col["observationoffset"].diff()
-        min_ts = hr_col.observationoffset.min()
-        max_ts = hr_col.observationoffset.max()
-        segment_hours = (max_ts-min_ts)/60.0
-
-        # Exclude stays longer than 30 days or shorter than 1 day
-        if np.isnan(segment_hours) or segment_hours < 24*configs[\
-                "min_length_days"] or segment_hours > configs[\
-                "max_length_days"]*24:
-            continue
-
-        max_disconnect_mins = int(diffed_hr_col.max())
-
-        # Exclude stays where the HR sensor is disconnected for more than 60
-        # minutes.
-        if max_disconnect_mins > configs["max_hr_disconnect_mins"]:
-            continue
-
-        included_patients.append(pid)
+    spans = compute_hr_spans(configs, list(map(int, pid_list)))
+    spans = spans.reindex(list(map(int, pid_list)))
+    segment_hours = np.array((spans["max"]-spans["min"])/60.0)
+    max_disconnect_mins = np.trunc(np.array(spans["gap"]))
+
+    # Exclude stays longer than 30 days or shorter than 1 day, and stays
+    # where the HR sensor is disconnected for more than 60 minutes.
+    included = ~np.isnan(segment_hours) \
+            & (segment_hours >= 24*configs["min_length_days"]) \
+            & (segment_hours <= 24*configs["max_length_days"]) \
+            & ~(max_disconnect_mins > configs["max_hr_disconnect_mins"])
+    included_patients = [pid for pid, inc in zip(pid_list, included) if inc]
+    print("Included patient stays: {}/{}".format(len(included_patients),
+        len(pid_list)))
 
     sorted_inc_pids = list(sorted(included_patients))
     mlhc_io.write_list_to_file(configs["output_path"], sorted_inc_pids)
@@ -63,6 +79,9 @@ if __name__ == "__main__":
     parser.add_argument("--vital_per_table_path",
             default=pj(HOME, "Datasets/eicu-2.0/hdf/vitalPeriodic.h5"),
             help="Location of the vital periodic table") 
+    parser.add_argument("--partition_dir", default=None,
+            help="Directory of the patient-partitioned tables, if given " \
+                    "the partitioned vital periodic table is scanned")
 
     # Output paths
     parser.add_argument("--output_path",
@@ -76,6 +95,8 @@ if __name__ == "__main__":
             help="Maximum length of a valid ICU stay in days")
     parser.add_argument("--max_hr_disconnect_mins", type=int, default=60,
             help="Max time in minutes that HR channel could be disconnected")
+    parser.add_argument("--chunk_size", type=int, default=1000000,
+            help="Number of table rows read at a time")
 
     args = parser.parse_args()
     configs = vars(args)
@@ -15,12 +15,20 @@ matplotlib.use("pdf")
 import matplotlib.pyplot as plt
 
 import functions.util_io as mlhc_io
+import functions.util_table as mlhc_table
 
 pe = os.path.exists
 pj = os.path.join
 HOME = os.path.expanduser("~")
 
 
+def covered_patient_counts(patient_counts, pid_weights):
+    ''' Returns the number of patients with at least one observation of each
+    variable, given the observation counts per patient stay'''
+    weights = pid_weights.reindex(patient_counts.index, fill_value=0)
+    return ((patient_counts > 0).mul(weights, axis=0)).sum().astype(int)
+
+
 def filter_variables(configs):
 
     vital_variables = ["temperature", "sao2", "heartrate", "respiration",
@@ -43,48 +51,60 @@ def filter_variables(configs):
     all_pids = list(map(int, mlhc_io.read_list_from_file(configs[\
             "included_pid_path"])))
 
-    var_obs_count_dict = {}
-    aper_var_obs_count_dict = {}
-    lab_var_obs_count_dict = {}
-
     if configs["debug_mode"]:
         base_size = 1000
+        # Patients counted in the debug mode
+        count_pids = all_pids[:base_size-1]
     else:
         base_size = len(all_pids)
+        count_pids = all_pids
+
+    # Observations of each variable per patient stay, counted in one chunked
+    # scan per table
+    if configs["partition_dir"] is None:
+        scan_dir = configs["hdf_dir"]
+        dset_id = None
+    else:
+        scan_dir = configs["partition_dir"]
+        dset_id = "data"
+    scan = lambda table_path, columns: mlhc_table.iter_table_chunks(pj(\
+            scan_dir, os.path.basename(table_path)), columns=[\
+                "patientunitstayid"]+columns, pids=count_pids,
+            chunk_size=configs["chunk_size"], dset_id=dset_id)
+
+    print("Counting periodic vital signs")
+    per_counts = mlhc_table.fold_chunks(scan(periodic_path, vital_variables),
+            {"counts": mlhc_table.PatientCounts(vital_variables)})["counts"]
+    print("Counting aperiodic vital signs")
+    aper_counts = mlhc_table.fold_chunks(scan(aperiodic_path,
+        vital_aper_variables), {"counts": mlhc_table.PatientCounts(\
+            vital_aper_variables)})["counts"]
+    print("Counting lab variables")
+    lab_counts = mlhc_table.fold_chunks(scan(lab_path, ["labname",
+        "labresult"]), {"counts": mlhc_table.PatientKeyCounts("labname",
+            "labresult")})["counts"].rename("count").reset_index()
+    lab_counts["labname"] = lab_counts["labname"].str.strip()
+    lab_counts = lab_counts.groupby(["patientunitstayid", "labname"])[\
+            "count"].sum().unstack(fill_value=0)
 
-    for pidx, pat in enumerate(all_pids):
-        if (pidx+1) % 1000 == 0:
-            print("Patient {}/{}".format(pidx+1, len(all_pids)))
-            if configs["debug_mode"]:
-                break
-
-        df_periodic = pd.read_hdf(periodic_path, mode='r',
-                where="patientunitstayid={}".format(pat))
-        df_aperiodic = pd.read_hdf(aperiodic_path, mode='r',
-                where="patientunitstayid={}".format(pat))
-        df_lab = pd.read_hdf(lab_path, mode='r', where="patientunitstayid={}"\
-                .format(pat))[["labname", "labresult"]].dropna()
-        unique_lab_vars = list(map(lambda elem: elem.strip(),
-            list(df_lab.labname.unique())))
-
-        for var in unique_lab_vars:
-            if var not in lab_var_obs_count_dict:
-                lab_var_obs_count_dict[var] = 0
-            lab_var_obs_count_dict[var] += 1
-
-        for var in vital_variables:
-            df_var = df_periodic[var].dropna()
-            if df_var.shape[0] > 0:
-                if var not in var_obs_count_dict:
-                    var_obs_count_dict[var] = 0
-                var_obs_count_dict[var] += 1
-
-        for var in vital_aper_variables:
-            df_var = df_aperiodic[var].dropna()
-            if df_var.shape[0] > 0:
-                if var not in aper_var_obs_count_dict:
-                    aper_var_obs_count_dict[var] = 0
-                aper_var_obs_count_dict[var] += 1
+    # Number of patients with observations of each variable, a patient that
+    # is listed several times is counted several times
+    pid_weights = pd.Series(count_pids).value_counts()
+    per_coverage = covered_patient_counts(per_counts, pid_weights)
+    aper_coverage = covered_patient_counts(aper_counts, pid_weights)
+    lab_coverage = covered_patient_counts(lab_counts, pid_weights)
+    var_obs_count_dict = dict(per_coverage[per_coverage > 0])
+    aper_var_obs_count_dict = dict(aper_coverage[aper_coverage > 0])
+    lab_var_obs_count_dict = dict(lab_coverage[lab_coverage > 0])
+
+    for name, counts, coverage in [("Periodic", per_counts, per_coverage),
+            ("Aperiodic", aper_counts, aper_coverage),
+            ("Lab", lab_counts, lab_coverage)]:
+        for var in coverage.index:
+            print("{} {}: {} patients ({:.1f} %), median {} observations " \
+                    "per patient".format(name, var, coverage[var],
+                        100*coverage[var]/base_size,
+                        counts[var][counts[var] > 0].median()))
 
     non_selected_vars = []
     per_selected_vars = []
@@ -123,11 +143,14 @@ def filter_variables(configs):
     mlhc_io.write_list_to_file(configs["output_selected_lab_vars"],
             lab_selected_vars)
 
+    # The variable distributions do not change with the selection threshold
+    if configs["skip_plots"]:
+        return
+
     for var in per_selected_vars:
         print("Analyzing variable: {}".format(var))
-        df_var = pd.read_hdf(periodic_path, mode='r', columns=[var,
-            "patientunitstayid"]).dropna()
-        df_var = df_var[df_var["patientunitstayid"].isin(all_pids)][var]
+        df_var = mlhc_table.read_table_columns(periodic_path, [var],
+                pids=all_pids, chunk_size=configs["chunk_size"])[var].dropna()
         f, axarr = plt.subplots(2)
         lower_cutoff = np.percentile(np.array(df_var), 0.1)
         upper_cutoff = np.percentile(np.array(df_var), 99.9)
@@ -148,9 +171,8 @@ def filter_variables(configs):
 
     for var in aper_selected_vars:
         print("Analyzing variable: {}".format(var))
-        df_var = pd.read_hdf(aperiodic_path, mode='r', columns=[var,
-            "patientunitstayid"]).dropna()
-        df_var = df_var[df_var["patientunitstayid"].isin(all_pids)][var]
+        df_var = mlhc_table.read_table_columns(aperiodic_path, [var],
+                pids=all_pids, chunk_size=configs["chunk_size"])[var].dropna()
         f, axarr = plt.subplots(2)
         lower_cutoff = np.percentile(np.array(df_var), 0.1)
         upper_cutoff = np.percentile(np.array(df_var), 99.9)
@@ -169,9 +191,10 @@ def filter_variables(configs):
         if configs["debug_mode"]:
             break
 
-    df_all_vars = pd.read_hdf(lab_path, mode='r', columns=["labname",
-        "labresult", "patientunitstayid"]).dropna()
-    df_all_vars = df_all_vars[df_all_vars["patientunitstayid"].isin(all_pids)]
+    df_all_vars = mlhc_table.read_table_columns(lab_path, ["labname",
+        "labresult"], pids=all_pids, chunk_size=configs["chunk_size"]).dropna()
+    # The selected lab variables are the stripped lab names
+    df_all_vars["labname"] = df_all_vars["labname"].str.strip()
 
     for var in lab_selected_vars:
         print("Analyzing variable: {}".format(var))
@@ -203,6 +226,9 @@ if __name__ == "__main__":
             help="Location where the included PIDs are saved")
     parser.add_argument("--hdf_dir", default=pj(HOME, "Datasets/eicu-2.0/hdf"),
             help="Directory where HDF input files are located")  
+    parser.add_argument("--partition_dir", default=None,
+            help="Directory of the patient-partitioned tables, if given " \
+                    "these are used instead of where= queries")
     
     # Output paths
     parser.add_argument("--output_selected_per_vars",
@@ -220,6 +246,11 @@ if __name__ == "__main__":
     # Parameters
     parser.add_argument("--debug_mode", action="store_true", default=False,
             help="Should debug mode be enabled?")
+    parser.add_argument("--chunk_size", type=int, default=1000000,
+            help="Number of rows of the tables read at a time")
+    parser.add_argument("--skip_plots", action="store_true", default=False,
+            help="Only write the variable lists, without plotting the " \
+                    "distributions of the selected variables")
     parser.add_argument("--required_var_freq", type=float, default=0.1,
             help="What proportion of PIDs need to have a variable to be " \
                     "included?")    
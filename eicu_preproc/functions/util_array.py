@@ -67,3 +67,20 @@ def array_mode(in_arr):
     midpoint=(edges[max_idx]+edges[max_ids+1])/2
     return midpoint
 
+
+def forward_window_any(mask, horizons):
+    ''' For a boolean matrix of shape (n_rows, T), returns a boolean array of
+    shape (len(horizons), n_rows, T) whose entry [h, i, t] is True iff
+    mask[i, t:min(T, t+horizons[h])] has a True entry. Uses cumulative counts,
+    so the cost does not depend on the horizon lengths'''
+    mask = np.atleast_2d(mask)
+    n_steps = mask.shape[1]
+    counts = np.zeros((mask.shape[0], n_steps+1), dtype=np.int64)
+    np.cumsum(mask, axis=1, out=counts[:, 1:])
+    out_arr = np.empty((len(horizons),)+mask.shape, dtype=np.bool_)
+
+    for hidx, hor in enumerate(horizons):
+        win_end = np.minimum(np.arange(n_steps)+hor, n_steps)
+        out_arr[hidx] = (counts[:, win_end]-counts[:, :n_steps]) > 0
+
+    return out_arr
@@ -0,0 +1,86 @@
+"""
+Local dispatch of patient batches to a pool of worker processes
+"""
+
+import concurrent.futures
+import timeit
+
+import numpy as np
+
+# State of a worker process, set once by the pool initializer
+_worker_state = {}
+
+
+def _init_worker(load_fn, configs):
+    _worker_state["configs"] = configs
+    _worker_state["context"] = load_fn(configs)
+
+
+def _process_batch(batch_fn, batch_id):
+    configs = dict(_worker_state["configs"])
+    configs["batch_id"] = batch_id
+    t_begin = timeit.default_timer()
+    batch_fn(configs, _worker_state["context"])
+    return batch_id, timeit.default_timer()-t_begin
+
+
+class BatchFailures(Exception):
+    ''' Raised after all batches were processed if some of them failed, with
+    the exception of each failed batch and the wall time of the others'''
+
+    def __init__(self, failures, batch_times):
+        super().__init__("Batches {} failed".format(sorted(failures.keys())))
+        self.failures = failures
+        self.batch_times = batch_times
+
+
+def dispatch_batches(batches, batch_fn, load_fn, configs, n_workers=None,
+        on_done=None):
+    ''' Processes the batches in a process pool. Each worker calls load_fn once
+    on the configs to load the shared reference tables, and then calls
+    batch_fn(configs, loaded) with the batch ID set for each of its batches.
+    on_done(batch_id, wall_time) is called as soon as a batch has finished, so
+    that its result is kept even if a later batch fails. Failed batches do not
+    stop the others and are raised together as BatchFailures at the end.
+    Returns a dict with the wall time in seconds of each batch.'''
+    batch_times = {}
+    failures = {}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+            initializer=_init_worker, initargs=(load_fn, configs)) \
+            as executor:
+        futures = {executor.submit(_process_batch, batch_fn, batch_id): \
+                batch_id for batch_id in batches}
+        for future in concurrent.futures.as_completed(futures):
+            batch_id = futures[future]
+            try:
+                _, wall_time = future.result()
+            except Exception as exc:
+                print("Batch {} failed: {!r}".format(batch_id, exc))
+                failures[batch_id] = exc
+                continue
+            print("Finished batch {} in {:.1f} seconds".format(batch_id,
+                wall_time))
+            batch_times[batch_id] = wall_time
+            if on_done is not None:
+                on_done(batch_id, wall_time)
+
+    if len(failures) > 0:
+        raise BatchFailures(failures, batch_times) \
+                from failures[min(failures.keys())]
+    return batch_times
+
+
+def print_batch_times(batch_times):
+    ''' Prints the wall time of each batch and summary statistics'''
+    if len(batch_times) == 0:
+        print("No batches were processed")
+        return
+
+    for batch_id in sorted(batch_times.keys()):
+        print("Batch {}: {:.1f} seconds".format(batch_id,
+            batch_times[batch_id]))
+
+    times = np.array(list(batch_times.values()))
+    print("Batches: {}, total: {:.1f} s, mean: {:.1f} s, max: {:.1f} s".format(\
+            times.size, np.sum(times), np.mean(times), np.max(times)))
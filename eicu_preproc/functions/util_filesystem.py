@@ -16,3 +16,8 @@ def create_dir_if_not_exist(path, recursive=False):
         else:
             os.mkdir(path)
 
+def tmp_path(path):
+    ''' Path to which an output is written before it is moved to its final
+    path with os.replace, so that an interrupted run never leaves a partial
+    output at the final path'''
+    return path+".tmp"
@@ -4,32 +4,61 @@ Imputation / time gridding functions
 
 import numpy as np
 
-def impute_variable(raw_ts, raw_values, timegrid,
-        leave_nan_threshold_secs=None, grid_period=None, normal_value=None):
-    pred_values = np.zeros_like(timegrid)
-    input_ts = 0
-    online_patient_mean = 0.0
+def impute_variables(raw_ts, raw_values, timegrid,
+        leave_nan_threshold_secs=None, grid_period=None, normal_values=None):
+    ''' Imputes several variables of one patient onto the time grid at once.
+    raw_ts are the sorted time stamps of the table rows, raw_values a matrix
+    of shape (rows, variables) with NAN where a variable was not observed in a
+    row. A grid point uses all observations up to one grid period after it.
+    It takes the last observed value, or the patient mean if that value is
+    older than leave_nan_threshold_secs, or the normal value if the variable
+    was not observed yet.'''
+    raw_ts = np.asarray(raw_ts)
+    raw_values = np.asarray(raw_values, dtype=np.float64)
+    if raw_values.ndim == 1:
+        raw_values = raw_values[:, np.newaxis]
+    n_rows, n_vars = raw_values.shape
+    normal_values = np.broadcast_to(np.asarray(normal_values,
+        dtype=np.float64), (n_vars,))
 
-    for idx, ts in np.ndenumerate(timegrid):
+    if n_rows == 0:
+        return np.tile(normal_values, (timegrid.size, 1))
 
-        while input_ts < raw_ts.size and raw_ts[input_ts] <= ts+grid_period:
-            online_patient_mean = (input_ts*online_patient_mean+raw_values[\
-                    input_ts])/(input_ts+1)
-            input_ts += 1
+    observed = ~np.isnan(raw_values)
 
-        if input_ts == 0:
-            pred_values[idx[0]] = normal_value
-            continue
+    # Number of rows up to the end of each grid interval
+    grid_rows = np.searchsorted(raw_ts, timegrid+grid_period, side="right")
 
-        ext_offset = ts-raw_ts[input_ts-1]
+    obs_counts = np.zeros((n_rows+1, n_vars), dtype=np.int64)
+    np.cumsum(observed, axis=0, out=obs_counts[1:])
+    obs_sums = np.zeros((n_rows+1, n_vars))
+    np.cumsum(np.where(observed, raw_values, 0.0), axis=0, out=obs_sums[1:])
 
-        # We do not fill in values using observed values of >1 hours ago,
-        # leave conservatively at NAN
-        if ext_offset > leave_nan_threshold_secs:
-            pred_values[idx[0]] = online_patient_mean
-        else:
-            pred_values[idx[0]] = raw_values[input_ts-1]
+    # Row of the last observation of each variable among the first n rows
+    last_obs_row = np.full((n_rows+1, n_vars), -1, dtype=np.int64)
+    last_obs_row[1:] = np.where(observed, np.arange(n_rows)[:, np.newaxis],
+            -1)
+    np.maximum.accumulate(last_obs_row, axis=0, out=last_obs_row)
 
-    return pred_values
+    grid_counts = obs_counts[grid_rows]
+    grid_last_row = np.maximum(last_obs_row[grid_rows], 0)
+    last_values = raw_values[grid_last_row, np.arange(n_vars)]
+    ext_offset = timegrid[:, np.newaxis]-raw_ts[grid_last_row]
 
+    with np.errstate(divide="ignore", invalid="ignore"):
+        online_patient_mean = obs_sums[grid_rows]/grid_counts
 
+    # We do not fill in values using observed values of >1 hours ago,
+    # leave conservatively at NAN
+    pred_values = np.where(ext_offset > leave_nan_threshold_secs,
+            online_patient_mean, last_values)
+    pred_values = np.where(grid_counts == 0, normal_values, pred_values)
+    return pred_values
+
+def impute_variable(raw_ts, raw_values, timegrid,
+        leave_nan_threshold_secs=None, grid_period=None, normal_value=None):
+    ''' Imputes one variable onto the time grid, raw_values must not contain
+    NAN'''
+    return impute_variables(raw_ts, raw_values, timegrid,
+            leave_nan_threshold_secs=leave_nan_threshold_secs,
+            grid_period=grid_period, normal_values=normal_value)[:, 0]
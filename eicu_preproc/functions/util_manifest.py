@@ -0,0 +1,74 @@
+"""
+Fingerprints of the inputs of the preprocessing stages, recorded in a manifest
+so that stages and batches whose inputs did not change can be skipped
+"""
+
+import hashlib
+import json
+import os
+import os.path
+
+pe = os.path.exists
+
+
+def file_fingerprint(path, hash_max_bytes=100*2**20):
+    ''' Returns a fingerprint of a file, the hash of its content if it is not
+    larger than hash_max_bytes, otherwise its size and modification time. A
+    missing file has the fingerprint None.'''
+    if not pe(path):
+        return None
+    stat = os.stat(path)
+    if stat.st_size > hash_max_bytes:
+        return [stat.st_size, stat.st_mtime_ns]
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(2**20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def stage_fingerprint(input_paths, params, hash_max_bytes=100*2**20):
+    ''' Returns a fingerprint of the input files and the parameters of a stage
+    or batch, which changes if any of them changes'''
+    state = {"inputs": {path: file_fingerprint(path,
+        hash_max_bytes=hash_max_bytes) for path in input_paths},
+        "params": params}
+    return hashlib.sha1(json.dumps(state, sort_keys=True,
+        default=str).encode("utf-8")).hexdigest()
+
+
+class StageManifest():
+    ''' Fingerprints of the last successful run of every stage and batch,
+    stored in a JSON file that is rewritten after every recorded run'''
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.entries = {}
+        if pe(manifest_path):
+            with open(manifest_path, 'r') as fp:
+                self.entries = json.load(fp)
+
+    def is_current(self, key, fingerprint, output_paths):
+        ''' Was the stage or batch last run with these inputs, and do its
+        outputs still exist?'''
+        return self.entries.get(key) == fingerprint \
+                and all(map(pe, output_paths))
+
+    def record(self, key, fingerprint):
+        self.entries[key] = fingerprint
+        self.save()
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+        self.save()
+
+    def keys_with_prefix(self, prefix):
+        return [key for key in self.entries if key.startswith(prefix)]
+
+    def save(self):
+        # Replace the manifest at once, so that an interrupted run leaves the
+        # previous version
+        tmp_path = self.manifest_path+".tmp"
+        with open(tmp_path, 'w') as fp:
+            json.dump(self.entries, fp, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
@@ -0,0 +1,126 @@
+"""
+Per-patient time series stored as one columnar Parquet dataset instead of one
+file per patient. The rows of a patient stay are contiguous and never span two
+row groups, and an index of the row group and row range of every patient stay
+allows to read one or many patients without scanning the dataset.
+"""
+
+import os
+import os.path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+pj = os.path.join
+
+PID_COL = "patientunitstayid"
+PID_INDEX_FILE = "pid_index.parquet"
+
+
+def write_patient_file(df, out_path, row_group_patients=8,
+        compression="zstd"):
+    ''' Writes a data-frame to a Parquet file with the rows of a patient stay
+    in one row group of at most row_group_patients patients, in the order in
+    which the patients appear. Returns the index of the file, with the row
+    group and the row range inside the row group of each patient stay.'''
+    pids, first_rows, inverse = np.unique(np.array(df[PID_COL]),
+            return_index=True, return_inverse=True)
+    pid_order = np.argsort(first_rows, kind="mergesort")
+    rank = np.empty_like(pid_order)
+    rank[pid_order] = np.arange(pid_order.size)
+    df = df.iloc[np.argsort(rank[inverse.ravel()], kind="mergesort")]
+    pids = pids[pid_order]
+    counts = np.bincount(inverse.ravel(), minlength=pids.size)[pid_order]
+
+    stops = np.cumsum(counts)
+    starts = stops-counts
+    row_groups = np.arange(pids.size)//row_group_patients
+    group_starts = starts[::row_group_patients]
+    group_stops = np.append(group_starts[1:], stops[-1:] if stops.size else [])
+
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    with pq.ParquetWriter(out_path, table.schema,
+            compression=compression) as writer:
+        for group_start, group_stop in zip(group_starts, group_stops):
+            writer.write_table(table.slice(group_start, group_stop-group_start))
+
+    return pd.DataFrame({PID_COL: pids.astype(np.int64),
+        "file": os.path.basename(out_path),
+        "row_group": row_groups.astype(np.int64),
+        "start": (starts-group_starts[row_groups]).astype(np.int64),
+        "stop": (stops-group_starts[row_groups]).astype(np.int64)})
+
+
+def write_pid_index(df_indices, dataset_dir):
+    ''' Writes the combined index of all files of a dataset'''
+    df_index = pd.concat(df_indices, ignore_index=True)
+    assert df_index[PID_COL].is_unique, "Patient stay in several files"
+    df_index.to_parquet(pj(dataset_dir, PID_INDEX_FILE), index=False)
+    return df_index
+
+
+class PatientDatasetReader():
+    ''' Reads the rows of patient stays from a Parquet patient dataset. Only
+    the row groups that hold the requested patients are read, every one of
+    them once, and the open files are kept for further reads.'''
+
+    def __init__(self, dataset_dir):
+        self.dataset_dir = dataset_dir
+        df_index = pd.read_parquet(pj(dataset_dir, PID_INDEX_FILE))
+        self._locations = dict(zip(df_index[PID_COL].tolist(),
+            zip(df_index["file"].tolist(), df_index["row_group"].tolist(),
+                df_index["start"].tolist(), df_index["stop"].tolist())))
+        self._files = {}
+
+    def _open_file(self, file_name):
+        if file_name not in self._files:
+            self._files[file_name] = pq.ParquetFile(pj(self.dataset_dir,
+                file_name))
+        return self._files[file_name]
+
+    def pids(self):
+        return list(self._locations.keys())
+
+    def read_patient(self, pid, columns=None):
+        ''' Returns the rows of one patient stay, which are empty if the stay
+        is not in the dataset'''
+        return self.read_patients([pid], columns=columns)
+
+    def read_patients(self, pids, columns=None):
+        ''' Returns the rows of several patient stays, in the order of the
+        given IDs'''
+        pids = [int(pid) for pid in pids if int(pid) in self._locations]
+        group_pids = {}
+        for pid in pids:
+            file_name, row_group, _, _ = self._locations[pid]
+            group_pids.setdefault((file_name, row_group), []).append(pid)
+
+        tables = {}
+        for (file_name, row_group), pids_in_group in group_pids.items():
+            table = self._open_file(file_name).read_row_group(row_group,
+                    columns=columns, use_pandas_metadata=True)
+            for pid in pids_in_group:
+                _, _, start, stop = self._locations[pid]
+                tables[pid] = table.slice(start, stop-start)
+
+        if len(tables) == 0:
+            return self._empty_frame(columns)
+        # The rows are converted to pandas once, after the selection
+        return pa.concat_tables([tables[pid] for pid in pids]).to_pandas()
+
+    def _empty_frame(self, columns):
+        if len(self._locations) == 0:
+            return pd.DataFrame(columns=columns)
+        file_name = next(iter(self._locations.values()))[0]
+        schema = self._open_file(file_name).schema_arrow
+        table = schema.empty_table()
+        if columns is not None:
+            table = table.select(columns)
+        return table.to_pandas()
+
+    def close(self):
+        for parquet_file in self._files.values():
+            parquet_file.close()
+        self._files = {}
@@ -0,0 +1,128 @@
+"""
+Patient-partitioned eICU tables, in which the rows of each patient stay are
+stored contiguously and located via an offset index
+"""
+
+import os
+import os.path
+
+import numpy as np
+import pandas as pd
+
+import functions.util_table as mlhc_table
+
+pj = os.path.join
+
+PID_INDEX_KEY = "pid_index"
+
+
+def table_name(table_path):
+    ''' Returns the eICU table name of an HDF table path'''
+    return os.path.splitext(os.path.basename(table_path))[0]
+
+
+def partition_table(in_path, out_path, dset_id="data", columns=None,
+        complevel=5, complib="blosc:lz4", chunk_size=1000000):
+    ''' Sorts a table by patientunitstayid and writes it, together with the
+    offsets of each patient's rows, to a new HDF file. Rows of a patient keep
+    their original order and index, so a slice is equal to the result of a
+    where= query on the original table. Only the patientunitstayid column is
+    held in memory, the sorted table is written in blocks of chunk_size rows
+    read by their row coordinates. Returns the number of rows.'''
+    pid_chunks = [np.array(df_chunk[mlhc_table.PID_COL], dtype=np.int64) \
+            for df_chunk in mlhc_table.iter_table_chunks(in_path,
+                columns=[mlhc_table.PID_COL], chunk_size=chunk_size,
+                dset_id=dset_id)]
+    all_pids = np.concatenate(pid_chunks)
+    del pid_chunks
+    order = np.argsort(all_pids, kind="stable")
+    pids, starts, counts = np.unique(all_pids[order], return_index=True,
+            return_counts=True)
+    del all_pids
+    df_index = pd.DataFrame({"patientunitstayid": pids.astype(np.int64),
+        "start": starts.astype(np.int64),
+        "stop": (starts+counts).astype(np.int64)})
+
+    with pd.HDFStore(in_path, mode='r') as in_store, \
+            pd.HDFStore(out_path, mode='w', complevel=complevel,
+                    complib=complib) as out_store:
+        # String columns of later blocks may be longer than those of the
+        # first one, which fixes the widths of the output table
+        min_itemsize = [axis.itemsize for axis in \
+                in_store.get_storer(dset_id).values_axes \
+                if axis.kind == "string"]
+        min_itemsize = {"values": max(min_itemsize)} \
+                if len(min_itemsize) > 0 else None
+        for start in range(0, len(order), chunk_size):
+            coords = order[start:start+chunk_size]
+            # The rows are read in the order of the file and then put in the
+            # order of the sorted table
+            read_coords = np.sort(coords)
+            df_block = in_store.select(dset_id, where=read_coords,
+                    columns=columns)
+            df_block = df_block.iloc[np.searchsorted(read_coords, coords)]
+            out_store.append(dset_id, df_block, format="table", index=False,
+                    min_itemsize=min_itemsize)
+        out_store.create_table_index(dset_id)
+        out_store.put(PID_INDEX_KEY, df_index, format="table")
+    return len(order)
+
+
+class HDFQueryReader():
+    ''' Reads the rows of one patient from the original HDF tables via a
+    where= query on the indexed patientunitstayid column'''
+
+    def read_patient(self, table_path, pid):
+        return pd.read_hdf(table_path, mode='r',
+                where="patientunitstayid={}".format(pid))
+
+    def close(self):
+        pass
+
+
+class PartitionedTableReader():
+    ''' Reads the rows of one patient from the partitioned tables, by looking
+    up the patient's offsets and reading one contiguous slice'''
+
+    def __init__(self, partition_dir, dset_id="data"):
+        self.partition_dir = partition_dir
+        self.dset_id = dset_id
+        self._stores = {}
+        self._offsets = {}
+
+    def _open_table(self, table):
+        if table not in self._stores:
+            store = pd.HDFStore(pj(self.partition_dir, "{}.h5".format(table)),
+                    mode='r')
+            df_index = store.select(PID_INDEX_KEY)
+            self._offsets[table] = dict(zip(df_index["patientunitstayid"]\
+                    .tolist(), zip(df_index["start"].tolist(),
+                        df_index["stop"].tolist())))
+            self._stores[table] = store
+        return self._stores[table]
+
+    def patient_offsets(self, table_path, pid):
+        ''' Returns the [start, stop) row range of a patient, which is empty
+        if the patient has no rows in the table'''
+        table = table_name(table_path)
+        self._open_table(table)
+        return self._offsets[table].get(int(pid), (0, 0))
+
+    def read_patient(self, table_path, pid):
+        store = self._open_table(table_name(table_path))
+        start, stop = self.patient_offsets(table_path, pid)
+        return store.select(self.dset_id, start=start, stop=stop)
+
+    def close(self):
+        for store in self._stores.values():
+            store.close()
+        self._stores = {}
+        self._offsets = {}
+
+
+def get_patient_reader(partition_dir=None):
+    ''' Returns a reader for the partitioned tables if a partition directory is
+    given, otherwise a reader that queries the original HDF tables'''
+    if partition_dir is None:
+        return HDFQueryReader()
+    return PartitionedTableReader(partition_dir)
@@ -0,0 +1,74 @@
+"""
+Quantile utilities, exact on in-memory columns and approximate on tables that
+are streamed in chunks
+"""
+
+import numpy as np
+
+# Percentiles saved for every variable
+QUANTILES = np.arange(0.01, 1.00, 0.01)
+
+
+def column_quantiles(df, columns, quantiles=QUANTILES):
+    ''' Returns a dict mapping each column to the list of its quantiles,
+    ignoring NAN values, sorting every column only once'''
+    df_quant = df[columns].astype(np.float64).quantile(quantiles)
+    return {col: list(df_quant[col]) for col in columns}
+
+
+def grouped_quantiles(df, group_col, value_col, quantiles=QUANTILES):
+    ''' Returns a dict mapping each value of group_col, in order of first
+    appearance, to the list of quantiles of value_col over its rows, computed
+    in one groupby'''
+    quant_ser = df.groupby(group_col, sort=False)[value_col].quantile(
+            quantiles)
+    n_quant = len(quantiles)
+    keys = quant_ser.index.get_level_values(0)[::n_quant]
+    values = np.reshape(np.array(quant_ser), (-1, n_quant))
+    return {key: list(values[idx]) for idx, key in enumerate(keys)}
+
+
+class QuantileSketch():
+    ''' Mergeable summary for approximate quantiles of a column that is seen
+    in chunks. Each chunk is reduced to at most "compression" weighted points
+    at evenly spaced ranks, so that the rank error of a quantile is at most
+    the number of values divided by "compression", and the memory grows with
+    the number of chunks instead of the number of values'''
+
+    def __init__(self, compression=10000):
+        self.compression = compression
+        self.values = []
+        self.weights = []
+
+    def update(self, values):
+        ''' Adds the non-NAN values of a chunk to the sketch'''
+        values = np.sort(np.asarray(values, dtype=np.float64))
+        values = values[~np.isnan(values)]
+        n_values = values.size
+        if n_values > self.compression:
+            ranks = ((np.arange(self.compression)+0.5)*n_values\
+                    /self.compression).astype(np.int64)
+            values = values[ranks]
+        self.values.append(values)
+        self.weights.append(np.full(values.size, n_values/max(values.size, 1)))
+
+    def merge(self, other):
+        ''' Adds the summarized chunks of another sketch'''
+        self.values.extend(other.values)
+        self.weights.extend(other.weights)
+
+    def quantiles(self, quantiles=QUANTILES):
+        ''' Returns the list of approximate quantiles, with the same linear
+        interpolation as pandas when no chunk had to be reduced'''
+        values = np.concatenate(self.values) if self.values else np.zeros(0)
+        if values.size == 0:
+            return [np.nan]*len(quantiles)
+        weights = np.concatenate(self.weights)
+        order = np.argsort(values, kind="mergesort")
+        values = values[order]
+        weights = weights[order]
+        # Rank of every point, the center of the values it stands for
+        ranks = np.cumsum(weights)-weights/2.0-0.5
+        return list(np.interp(np.asarray(quantiles)*(weights.sum()-1),
+            ranks, values))
+
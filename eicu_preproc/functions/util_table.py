@@ -0,0 +1,208 @@
+"""
+Out-of-core access to the large eICU HDF tables, which are read in row chunks
+with column projection and patient filtering applied to every chunk, and
+aggregated by folding over the chunks in one pass
+"""
+
+import numpy as np
+import pandas as pd
+
+import functions.util_quantile as mlhc_quantile
+
+PID_COL = "patientunitstayid"
+
+
+def iter_table_chunks(table_path, columns=None, pids=None,
+        chunk_size=1000000, dset_id=None):
+    ''' Yields the rows of a table-format HDF table in chunks of at most
+    chunk_size rows, restricted to the given columns and to the rows of the
+    given patient stays. Only one chunk is held in memory at a time.'''
+    read_columns = columns
+    if pids is not None:
+        pids = pd.Index(pids).unique()
+        if columns is not None and PID_COL not in columns:
+            read_columns = list(columns)+[PID_COL]
+
+    with pd.HDFStore(table_path, mode='r') as store:
+        if dset_id is None:
+            dset_id = store.keys()[0]
+        n_rows = store.get_storer(dset_id).nrows
+        for start in range(0, n_rows, chunk_size):
+            df_chunk = store.select(dset_id, columns=read_columns,
+                    start=start, stop=start+chunk_size)
+            if pids is not None:
+                df_chunk = df_chunk[df_chunk[PID_COL].isin(pids)]
+                if read_columns is not columns:
+                    df_chunk = df_chunk[columns]
+            yield df_chunk
+
+
+def fold_chunks(chunks, aggregators):
+    ''' Passes every chunk to all aggregators, so that several aggregates are
+    computed in a single pass, and returns their results in a dict'''
+    for df_chunk in chunks:
+        for aggregator in aggregators.values():
+            aggregator.update(df_chunk)
+    return {name: aggregator.result() \
+            for name, aggregator in aggregators.items()}
+
+
+def read_table_columns(table_path, columns, pids=None, chunk_size=1000000,
+        dset_id=None):
+    ''' Reads columns of a table into one data-frame, keeping only the rows of
+    the given patient stays of every chunk before concatenating them'''
+    df_chunks = list(iter_table_chunks(table_path, columns=columns, pids=pids,
+        chunk_size=chunk_size, dset_id=dset_id))
+    if len(df_chunks) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(df_chunks)
+
+
+class RowCounter():
+    ''' Counts the rows'''
+
+    def __init__(self):
+        self.n_rows = 0
+
+    def update(self, df_chunk):
+        self.n_rows += df_chunk.shape[0]
+
+    def result(self):
+        return self.n_rows
+
+
+class NonNullCounter():
+    ''' Counts the non-missing entries of each column'''
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.counts = pd.Series(0, index=columns, dtype=np.int64)
+
+    def update(self, df_chunk):
+        self.counts += df_chunk[self.columns].notna().sum()
+
+    def result(self):
+        return self.counts.to_dict()
+
+
+class PatientCounts():
+    ''' Counts the non-missing entries of each column per patient stay'''
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.counts = pd.DataFrame(0, index=pd.Index([], dtype=np.int64,
+            name=PID_COL), columns=columns, dtype=np.int64)
+
+    def update(self, df_chunk):
+        counts = df_chunk[self.columns].notna().groupby(\
+                np.array(df_chunk[PID_COL], dtype=np.int64)).sum()
+        self.counts = self.counts.add(counts, fill_value=0).astype(np.int64)
+
+    def result(self):
+        return self.counts
+
+
+class PatientKeyCounts():
+    ''' Counts the rows with a non-missing key and value per patient stay and
+    key, for tables in long format such as lab'''
+
+    def __init__(self, key_col, value_col):
+        self.key_col = key_col
+        self.value_col = value_col
+        self.counts = pd.Series(0, index=pd.MultiIndex.from_arrays([\
+            np.zeros(0, dtype=np.int64), []], names=[PID_COL, key_col]),
+            dtype=np.int64)
+
+    def update(self, df_chunk):
+        df_obs = df_chunk[[PID_COL, self.key_col, self.value_col]].dropna()
+        counts = df_obs.groupby([np.array(df_obs[PID_COL], dtype=np.int64),
+            df_obs[self.key_col]]).size()
+        counts.index.names = [PID_COL, self.key_col]
+        self.counts = self.counts.add(counts, fill_value=0).astype(np.int64)
+
+    def result(self):
+        return self.counts
+
+
+class PidSet():
+    ''' Collects the distinct patient stays'''
+
+    def __init__(self):
+        self.pids = set()
+
+    def update(self, df_chunk):
+        self.pids.update(df_chunk[PID_COL].unique().tolist())
+
+    def result(self):
+        return self.pids
+
+
+class ColumnSketches():
+    ''' Approximate quantiles of each column, from mergeable per-chunk
+    sketches'''
+
+    def __init__(self, columns, compression=10000):
+        self.sketches = {col: mlhc_quantile.QuantileSketch(\
+                compression=compression) for col in columns}
+
+    def update(self, df_chunk):
+        for col, sketch in self.sketches.items():
+            sketch.update(df_chunk[col])
+
+    def result(self, quantiles=mlhc_quantile.QUANTILES):
+        return {col: sketch.quantiles(quantiles) \
+                for col, sketch in self.sketches.items()}
+
+
+class ObservationSpans():
+    ''' First and last time and largest gap between consecutive times of the
+    observations of each patient stay, over the rows where the time and the
+    value column are not missing. The summaries of the chunks are merged
+    exactly if the times of a stay in a chunk come after or before all its
+    times seen so far, which holds if the rows of each stay are contiguous.
+    Stays with interleaved times are marked as not exact and have to be
+    summarized again from all their rows at once.'''
+
+    def __init__(self, time_col, value_col):
+        self.time_col = time_col
+        self.value_col = value_col
+        self.spans = pd.DataFrame({"min": np.zeros(0), "max": np.zeros(0),
+            "gap": np.zeros(0), "exact": np.zeros(0, dtype=bool)},
+            index=pd.Index([], dtype=np.int64, name=PID_COL))
+
+    def summarize(self, df_chunk):
+        ''' Returns the spans of the stays of one chunk'''
+        df_obs = df_chunk[[PID_COL, self.time_col, self.value_col]].dropna()
+        pids = np.array(df_obs[PID_COL], dtype=np.int64)
+        times = np.array(df_obs[self.time_col], dtype=np.float64)
+        order = np.lexsort((times, pids))
+        pids = pids[order]
+        times = times[order]
+        gaps = np.diff(times, prepend=np.nan)
+        gaps[np.flatnonzero(np.diff(pids, prepend=-1) != 0)] = np.nan
+        df_obs = pd.DataFrame({PID_COL: pids, "time": times, "gap": gaps})
+        spans = df_obs.groupby(PID_COL, sort=False).agg(min=("time", "first"),
+                max=("time", "last"), gap=("gap", "max"))
+        spans["exact"] = True
+        return spans
+
+    def update(self, df_chunk):
+        spans = self.summarize(df_chunk)
+        seen = spans.index.isin(self.spans.index)
+        prev = self.spans.loc[spans.index[seen]]
+        cur = spans[seen]
+        after = np.array(cur["min"] >= prev["max"])
+        before = np.array(cur["max"] <= prev["min"])
+        # Gap between the times seen so far and the times of this chunk
+        join_gap = np.where(after, np.array(cur["min"]-prev["max"]),
+                np.array(prev["min"]-cur["max"]))
+        merged = pd.DataFrame({"min": np.fmin(prev["min"], cur["min"]),
+            "max": np.fmax(prev["max"], cur["max"]),
+            "gap": np.fmax(np.fmax(prev["gap"], cur["gap"]), join_gap),
+            "exact": np.array(prev["exact"]) & (after | before)},
+            index=prev.index)
+        self.spans = pd.concat([self.spans.drop(index=merged.index), merged,
+            spans[~seen]])
+
+    def result(self):
+        return self.spans
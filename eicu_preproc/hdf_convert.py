@@ -6,64 +6,157 @@ import os
 import argparse
 import csv
 import os.path
+import concurrent.futures
+import timeit
+
 import pandas as pd
 import numpy as np
-import glob as glob
-import ipdb
-import gc
 
 pe = os.path.exists
 pj = os.path.join
 HOME = os.path.expanduser("~")
 
 TABLES=["admissionDrug", "admissionDx", "allergy", "apacheApsVar",
-        "apachePatientResult", "apachePredVar", "carePlanCareProvider", 
+        "apachePatientResult", "apachePredVar", "carePlanCareProvider",
         "carePlanEOL", "carePlanGeneral" , "carePlanGoal",
-        "carePlanInfectiousDisease", "customLab", "diagnosis", "hospital", 
+        "carePlanInfectiousDisease", "customLab", "diagnosis", "hospital",
         "infusionDrug", "intakeOutput", "lab", "medication", "microLab",
-        "note", "nurseAssessment", "nurseCare", 
+        "note", "nurseAssessment", "nurseCare",
         "pastHistory", "patient", "physicalExam", "respiratoryCare",
         "respiratoryCharting", "treatment", "vitalAperiodic", "vitalPeriodic"]
-# TODO Removing nurseCharting.csv for the momemtn because it's too big
+
+# Columns with mixed numerical and text values, which are kept as text
+TABLE_DTYPES={"lab": {"labresulttext": object},
+        "infusionDrug": {"drugrate": object},
+        "respiratoryCare": {"airwayposition": object,
+            "airwaysize": object,
+            "apneaparms": object,
+            "setapneafio2": object,
+            "setapneainsptime": object,
+            "setapneainterval": object,
+            "setapneaippeephigh": object,
+            "setapneapeakflow": object,
+            "setapneatv": object},
+        "respiratoryCharting": {"respchartvalue": object},
+        "nurseCharting": {"nursingchartvalue": object}}
+
+
+def read_csv_chunks(table_path, dtype_dict, chunk_size):
+    return pd.read_csv(table_path, quoting=csv.QUOTE_ALL, dtype=dtype_dict,
+            chunksize=chunk_size)
+
+
+def infer_csv_schema(table_path, dtype_dict, chunk_size):
+    ''' Streams a CSV table to find a type for every column that holds for
+    all of its chunks, and the maximum length of every text column. Integer
+    columns with missing values become floating point, and columns that are
+    not numerical in some chunk become text.'''
+    kinds = {}
+    str_lengths = {}
+    # Columns with parsed values in some chunk
+    parsed_cols = set()
+    for df_chunk in read_csv_chunks(table_path, dtype_dict, chunk_size):
+        for col in df_chunk.columns:
+            dtype = df_chunk[col].dtype
+            if pd.api.types.is_bool_dtype(dtype):
+                kind = "bool"
+            elif pd.api.types.is_integer_dtype(dtype):
+                kind = "int"
+            elif pd.api.types.is_float_dtype(dtype):
+                kind = "float"
+            else:
+                kind = "str"
+                max_len = df_chunk[col].dropna().astype(str).str.len().max()
+                if not np.isnan(max_len):
+                    str_lengths[col] = max(str_lengths.get(col, 1),
+                            int(max_len))
+            if kind != "str" and df_chunk[col].notna().any():
+                parsed_cols.add(col)
+
+            prev_kind = kinds.get(col, kind)
+            if {prev_kind, kind} == {"int", "float"}:
+                kind = "float"
+            elif prev_kind != kind:
+                kind = "str"
+            kinds[col] = kind
+
+    # Values that were parsed as numbers have to be measured as text as well
+    mixed_cols = [col for col in parsed_cols if kinds[col] == "str"]
+    if len(mixed_cols) > 0:
+        for df_chunk in read_csv_chunks(table_path, {col: object \
+                for col in mixed_cols}, chunk_size):
+            for col in mixed_cols:
+                max_len = df_chunk[col].dropna().str.len().max()
+                if not np.isnan(max_len):
+                    str_lengths[col] = max(str_lengths.get(col, 1),
+                            int(max_len))
+
+    type_map = {"bool": np.bool_, "int": np.int64, "float": np.float64,
+            "str": object}
+    return {col: type_map[kind] for col, kind in kinds.items()}, str_lengths
+
+
+def convert_table(table, configs):
+    ''' Converts one CSV table in row chunks, appending them to a table-format
+    HDF file with patientunitstayid as an indexed data column. Returns the
+    table name, its number of rows and the wall time in seconds.'''
+    t_begin = timeit.default_timer()
+    table_path=os.path.join(configs["source_data_dir"],
+            "{}.csv".format(table))
+    out_path=os.path.join(configs["dest_dir"],"{}.h5".format(table))
+    dtype_dict, str_lengths = infer_csv_schema(table_path,
+            TABLE_DTYPES.get(table), configs["chunk_size"])
+    data_columns = ["patientunitstayid"] if "patientunitstayid" in dtype_dict \
+            else None
+
+    n_rows = 0
+    with pd.HDFStore(out_path, mode='w', complevel=configs["hdf_comp_level"],
+            complib=configs["hdf_comp_alg"]) as store:
+        for df_chunk in read_csv_chunks(table_path, dtype_dict,
+                configs["chunk_size"]):
+            # The index of the table continues over the chunks
+            store.append(configs["dset_key"], df_chunk, format="table",
+                    data_columns=data_columns, min_itemsize=str_lengths,
+                    index=False)
+            n_rows += df_chunk.shape[0]
+        if data_columns is not None and n_rows > 0:
+            store.create_table_index(configs["dset_key"],
+                    columns=data_columns, optlevel=6, kind="medium")
+
+    wall_time = timeit.default_timer()-t_begin
+    print("Table {}: {} rows in {:.1f} seconds, {:.0f} rows/sec".format(table,
+        n_rows, wall_time, n_rows/max(wall_time, 1e-9)))
+    return table, n_rows, wall_time
+
 
 def hdf_convert(configs):
-    global TABLES
+    tables = list(TABLES)
     if configs["use_nurseCharting"]:
-        TABLES += ["nurseCharting"]
+        tables += ["nurseCharting"]
     else:
-        print("WARNING: Table nurseCharting.csv not being converted due to " \
-                "memory restrictions")
-    
-    for table in TABLES:
-
-        print("Processing table {}".format(table))
-        table_path=os.path.join(configs["source_data_dir"],
-                "{}.csv".format(table))
-
-        if table=="lab":
-            dtype_dict={"labresulttext": object}
-        elif table=="infusionDrug":
-            dtype_dict={"drugrate": object}
-        elif table=="respiratoryCare":
-            dtype_dict={"airwayposition": object, 
-                        "airwaysize": object,
-                        "apneaparms": object, 
-                        "setapneafio2": object,
-                        "setapneainsptime": object,
-                        "setapneainterval": object,
-                        "setapneaippeephigh": object,
-                        "setapneapeakflow": object,
-                        "setapneatv": object}
-        elif table=="respiratoryCharting":
-            dtype_dict={"respchartvalue": object}
-        else:
-            dtype_dict=None
-
-        df=pd.read_csv(table_path,quoting=csv.QUOTE_ALL,dtype=dtype_dict)
-        df.to_hdf(os.path.join(configs["dest_dir"],"{}.h5".format(table)),
-                key=configs["dset_key"],mode='w',format="table",
-                data_columns=["patientunitstayid"],complevel=configs[\
-                        "hdf_comp_level"],complib=configs["hdf_comp_alg"])
+        print("WARNING: Table nurseCharting.csv not being converted, pass " \
+                "--use-nurseCharting to include it")
+
+    table_stats = {}
+    if configs["n_workers"] == 1:
+        for table in tables:
+            print("Processing table {}".format(table))
+            _, n_rows, wall_time = convert_table(table, configs)
+            table_stats[table] = (n_rows, wall_time)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(\
+                max_workers=configs["n_workers"]) as executor:
+            futures = [executor.submit(convert_table, table, configs) \
+                    for table in tables]
+            for future in concurrent.futures.as_completed(futures):
+                table, n_rows, wall_time = future.result()
+                table_stats[table] = (n_rows, wall_time)
+
+    for table in tables:
+        n_rows, wall_time = table_stats[table]
+        print("{}: {} rows, {:.1f} s, {:.0f} rows/sec".format(table, n_rows,
+            wall_time, n_rows/max(wall_time, 1e-9)))
+
 
 if __name__=="__main__":
 
@@ -76,24 +169,30 @@ if __name__=="__main__":
             help="HDF compression level to use")
     parser.add_argument("--hdf_comp_alg", default="blosc:lz4",
             help="HDF compression algorithm to use")
+    parser.add_argument("--chunk_size", default=1000000, type=int,
+            help="Number of CSV rows converted at a time")
+    parser.add_argument("--n_workers", default=None, type=int,
+            help="Number of tables converted in parallel processes, by " \
+                    "default the number of CPUs")
 
     # Input paths
     parser.add_argument("--source_data_dir",
             default=pj(HOME, "Datasets/EHRs/eICU/csv"),
-            help="Source data directory with CSV tables") 
+            help="Source data directory with CSV tables")
 
     # Output paths
-    parser.add_argument("--dest_dir", 
+    parser.add_argument("--dest_dir",
             default=pj(HOME, "Datasets/EHRs/eICU/hdf"),
             help="Destination directory where the HDF tables should be saved " \
                     "into")
 
     parser.add_argument("--nc", "--use-nurseCharting",
             dest="use_nurseCharting", action="store_true",
-            help="This file crashes a 64GB RAM machine")
+            help="Also convert nurseCharting.csv, the largest table, which " \
+                    "is streamed in chunks like the others")
 
     args=parser.parse_args()
     configs=vars(args)
 
     hdf_convert(configs)
-    
+
@@ -10,13 +10,55 @@ import os
 import sys
 
 import functions.util_filesystem as mlhc_fs
+import functions.util_dispatch as mlhc_dispatch
+import label_data_one_batch as eicu_label
 
 pe = os.path.exists
 pj = os.path.join
 HOME = os.path.expanduser("~")
 
 
-def label_all_patients(configs):
+def label_all_patients_pool(configs, batch_args):
+    ''' Runs the batches in a local process pool, creating the endpoint
+    extractor once per worker'''
+    batch_configs = vars(eicu_label.get_parser().parse_args(batch_args))
+    batch_configs["pid_batch_file"] = configs["patient_batch_path"]
+
+    with open(configs["patient_batch_path"],'rb') as fp:
+        obj=pickle.load(fp)
+        batch_to_lst=obj["batch_to_lst"]
+        batches=list(sorted(batch_to_lst.keys()))
+
+    # The batch script moves its output to batch_N.h5 only once the batch is
+    # complete, so that batches interrupted by a crash are processed again.
+    # A batch without patients has no output and is always complete.
+    if not configs["overwrite"]:
+        n_batches = len(batches)
+        batches = [batch_idx for batch_idx in batches \
+                if len(batch_to_lst[batch_idx]) > 0 and not pe(pj(\
+                    batch_configs["output_dynamic_endpoint_dir"],
+                    "batch_{}.h5".format(batch_idx)))]
+        print("Skipping {} completed batches".format(\
+                n_batches-len(batches)))
+
+    if configs["dry_run"]:
+        print("Batches to process: {}".format(batches))
+        return
+
+    batch_times = mlhc_dispatch.dispatch_batches(batches,
+            eicu_label.label_data_one_batch, eicu_label.load_dynamic_extractor,
+            batch_configs, n_workers=configs["n_workers"])
+    mlhc_dispatch.print_batch_times(batch_times)
+
+
+def label_all_patients(configs, batch_args=None):
+    if batch_args is None:
+        batch_args = []
+
+    if configs["executor"] == "pool":
+        label_all_patients_pool(configs, batch_args)
+        return
+
     job_index=0
     mem_in_mbytes=configs["mem_in_mbytes"]
     n_cpu_cores=1
@@ -37,7 +79,8 @@ def label_all_patients(configs):
         mlhc_fs.delete_if_exist(log_result_file)
         
         cmd_line = " ".join(["python3", compute_script_path,
-           "--run_mode INTERACTIVE", "--batch_id {}".format(batch_idx)])
+           "--run_mode INTERACTIVE", "--batch_id {}".format(batch_idx)] \
+                   + batch_args)
 
 #        cmd_line=" ".join(["bsub", "-R", "rusage[mem={}]".format(mem_in_mbytes), "-n", "{}".format(n_cpu_cores), "-r", "-W", "{}:00".format(n_compute_hours), 
 #                           "-J","{}".format(job_name), "-o", log_result_file, "python3", compute_script_path, "--run_mode CLUSTER", "--batch_id {}".format(batch_idx)])
@@ -78,8 +121,18 @@ if __name__=="__main__":
     parser.add_argument("--nhours", type=int,
             default=4,
             help="Number of hours to request")
+    parser.add_argument("--executor", default="shell",
+            choices=["shell", "pool"],
+            help="Dispatch each batch as a shell command, or run the " \
+                    "batches in a local process pool")
+    parser.add_argument("--n_workers", type=int, default=None,
+            help="Number of worker processes in the pool, defaults to the " \
+                    "number of CPUs")
+    parser.add_argument("--overwrite", action="store_true", default=False,
+            help="In the pool, also process batches whose outputs exist")
 
-    args=parser.parse_args()
+    # All other arguments are passed on to the batch script
+    args, batch_args=parser.parse_known_args()
     configs=vars(args)
     
-    label_all_patients(configs)
+    label_all_patients(configs, batch_args)
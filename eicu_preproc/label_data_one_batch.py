@@ -10,13 +10,20 @@ import sys
 import pandas as pd
 
 import classes.dynamic_endpoints as eicu_dynamic_tf
+import functions.util_filesystem as mlhc_fs
+import functions.util_partition as eicu_partition
 
 pe = os.path.exists
 pj = os.path.join
 HOME = os.path.expanduser("~")
 
 
-def label_data_one_batch(configs):
+def load_dynamic_extractor(configs):
+    ''' Creates the endpoint extractor, which is shared by all patients'''
+    return eicu_dynamic_tf.DynamicEndpointExtractor()
+
+
+def label_data_one_batch(configs, dynamic_extractor=None):
     first_write = True
     batch_id = configs["batch_id"]
 
@@ -26,6 +33,24 @@ def label_data_one_batch(configs):
         batches = list(sorted(batch_to_lst.keys()))
         batch_idxs = batch_to_lst[batch_id]        
 
+    # The patients are appended to a temporary file, which is moved to the
+    # output path once the batch is complete
+    out_path = pj(configs["output_dynamic_endpoint_dir"],
+            "batch_{}.h5".format(batch_id))
+    out_tmp_path = mlhc_fs.tmp_path(out_path)
+
+    # A batch without patients has no output, that of an earlier version of
+    # the batch is removed so that it is not picked up downstream
+    if len(batch_idxs) == 0:
+        print("Batch {} has no patients".format(batch_id))
+        mlhc_fs.delete_if_exist(out_path)
+        return
+
+    reader = eicu_partition.get_patient_reader(configs["partition_dir"])
+
+    if dynamic_extractor is None:
+        dynamic_extractor = load_dynamic_extractor(configs)
+
     print("Dispatched batch {} with {} patients".format(batch_id,
         len(batch_idxs)))
 
@@ -35,9 +60,7 @@ def label_data_one_batch(configs):
             print("Progress in batch {}: {}/{}".format(batch_id, pidx+1,
                 len(batch_idxs)))
 
-        dynamic_extractor = eicu_dynamic_tf.DynamicEndpointExtractor()
-        df_pat = pd.read_hdf(configs["input_patient_table"], mode='r',
-                where="patientunitstayid={}".format(pid))
+        df_pat = reader.read_patient(configs["input_patient_table"], pid)
         df_imputed = pd.read_hdf(os.path.join(configs["imputed_data_dir"],
             "batch_{}.h5".format(batch_id)), mode='r',
             where="patientunitstayid={}".format(pid))
@@ -45,25 +68,26 @@ def label_data_one_batch(configs):
                 pid=pid)
 
         if first_write:
-            df_dynamic_endpoints.to_hdf(pj(\
-                    configs["output_dynamic_endpoint_dir"],
-                    "batch_{}.h5".format(batch_id)), configs["output_dset_id"],
-                    append=False, data_columns=["patientunitstayid"], mode='w',
+            df_dynamic_endpoints.to_hdf(out_tmp_path,
+                    configs["output_dset_id"], append=False,
+                    data_columns=["patientunitstayid"], mode='w',
                     format="table", complevel=configs["hdf_comp_level"],
                     complib=configs["hdf_comp_alg"])
         else:
-            df_dynamic_endpoints.to_hdf(pj(\
-                    configs["output_dynamic_endpoint_dir"],
-                    "batch_{}.h5".format(batch_id)), configs["output_dset_id"],
-                    append=True, data_columns=["patientunitstayid"], mode='a',
+            df_dynamic_endpoints.to_hdf(out_tmp_path,
+                    configs["output_dset_id"], append=True,
+                    data_columns=["patientunitstayid"], mode='a',
                     format="table", complevel=configs["hdf_comp_level"],
                     complib=configs["hdf_comp_alg"])
 
         first_write = False
 
+    reader.close()
+    if not first_write:
+        os.replace(out_tmp_path, out_path)
 
-if __name__ == "__main__":
 
+def get_parser():
     parser = argparse.ArgumentParser()
 
     # Input paths
@@ -73,6 +97,9 @@ if __name__ == "__main__":
     parser.add_argument("--input_patient_table",
             default=pj(HOME, "Datasets/EHRs/eICU/hdf/patient.h5"),
             help="Input patient table path") 
+    parser.add_argument("--partition_dir", default=None,
+            help="Directory of the patient-partitioned tables, if given " \
+                    "these are used instead of where= queries")
     parser.add_argument("--pid_batch_file",
             default=pj(HOME, "Datasets/EHRs/eICU/patient_batches.pickle"),
             help="Specify the map from PIDs to batches") 
@@ -103,6 +130,11 @@ if __name__ == "__main__":
             default="INTERACTIVE",
             help="Running mode, interactive or on cluster?")    
 
+    return parser
+
+
+if __name__ == "__main__":
+    parser = get_parser()
     args = parser.parse_args()
     configs = vars(args)
 
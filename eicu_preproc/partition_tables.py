@@ -0,0 +1,65 @@
+"""
+Partitions the eICU HDF tables by patient stay, so that the per-patient scripts
+can read the rows of a patient with one offset lookup instead of a where= query
+"""
+
+import argparse
+import os
+import timeit
+
+import functions.util_filesystem as mlhc_fs
+import functions.util_partition as eicu_partition
+
+pe = os.path.exists
+pj = os.path.join
+HOME = os.path.expanduser("~")
+
+
+def partition_tables(configs):
+    mlhc_fs.create_dir_if_not_exist(configs["partition_dir"], recursive=True)
+
+    for table in configs["tables"]:
+        print("Partitioning table {}".format(table))
+        t_begin = timeit.default_timer()
+        n_rows = eicu_partition.partition_table(pj(configs["hdf_dir"],
+            "{}.h5".format(table)), pj(configs["partition_dir"],
+                "{}.h5".format(table)), dset_id=configs["dset_id"],
+            complevel=configs["hdf_comp_level"],
+            complib=configs["hdf_comp_alg"],
+            chunk_size=configs["chunk_size"])
+        t_end = timeit.default_timer()
+        print("Partitioned {} rows in {:.1f} seconds".format(n_rows,
+            t_end-t_begin))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # Input paths
+    parser.add_argument("--hdf_dir", default=pj(HOME, "Datasets/eicu-2.0/hdf"),
+            help="Directory where HDF input files are located")
+
+    # Output paths
+    parser.add_argument("--partition_dir",
+            default=pj(HOME, "Datasets/eicu-2.0/hdf_partitioned"),
+            help="Directory where the partitioned tables should be saved")
+
+    # Parameters
+    parser.add_argument("--tables", nargs="+",
+            default=["patient", "admissionDx", "apacheApsVar",
+                "apachePatientResult", "apachePredVar", "lab",
+                "vitalPeriodic", "vitalAperiodic"],
+            help="Tables to partition")
+    parser.add_argument("--dset_id", default="data",
+            help="HDF data-set ID")
+    parser.add_argument("--hdf_comp_level", type=int, default=5,
+            help="HDF compression level to use")
+    parser.add_argument("--hdf_comp_alg", default="blosc:lz4",
+            help="HDF compression algorithm to use")
+    parser.add_argument("--chunk_size", type=int, default=1000000,
+            help="Number of rows read and written at a time")
+
+    args = parser.parse_args()
+    configs = vars(args)
+
+    partition_tables(configs)
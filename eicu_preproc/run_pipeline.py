@@ -0,0 +1,346 @@
+"""
+Resumable runner of the eICU preprocessing pipeline. The input fingerprints
+of every stage, and of every patient batch of the batch stages, are recorded
+in a manifest, and stages or batches whose inputs did not change since their
+last successful run are skipped.
+"""
+
+import argparse
+import glob
+import os
+import os.path
+import pickle
+import shlex
+import subprocess
+import sys
+
+import functions.util_dispatch as mlhc_dispatch
+import functions.util_manifest as mlhc_manifest
+import timegrid_one_batch as eicu_timegrid
+import label_data_one_batch as eicu_label
+import save_model_inputs as eicu_save
+
+pe = os.path.exists
+pj = os.path.join
+HOME = os.path.expanduser("~")
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STAGES = ["save_all_pids", "filter_patients", "filter_variables",
+        "compute_quantiles", "compute_patient_batches", "timegrid",
+        "label", "save_model_inputs"]
+
+STATIC_TABLES = ["patient", "admissionDx", "apacheApsVar",
+        "apachePatientResult", "apachePredVar"]
+
+
+def get_paths(configs):
+    ''' Locations of the tables and of all intermediate files'''
+    data_dir = configs["data_dir"]
+    hdf_dir = configs["hdf_dir"] if configs["hdf_dir"] is not None \
+            else pj(data_dir, "hdf")
+    paths = {table: pj(hdf_dir, "{}.h5".format(table)) for table in \
+            STATIC_TABLES+["lab", "vitalPeriodic", "vitalAperiodic"]}
+    paths.update({"hdf_dir": hdf_dir,
+        "all_pids": pj(data_dir, "all_pid_stays.txt"),
+        "included_pids": pj(data_dir, "included_pid_stays.txt"),
+        "per_vars": pj(data_dir, "included_per_variables.txt"),
+        "aper_vars": pj(data_dir, "included_aper_variables.txt"),
+        "lab_vars": pj(data_dir, "included_lab_variables.txt"),
+        "plots_dir": pj(data_dir, "plots"),
+        "quantiles": pj(data_dir, "var_quantiles.json"),
+        "patient_batches": pj(data_dir, "patient_batches.pickle"),
+        "time_grid_dir": pj(data_dir, "time_grid"),
+        "labels_dir": pj(data_dir, "labels"),
+        "log_dir": pj(data_dir, "logs")})
+    return paths
+
+
+def partition_inputs(configs):
+    ''' The partitioned tables are inputs of the per-patient stages if they are
+    used'''
+    if configs["partition_dir"] is None:
+        return [], []
+    return sorted(glob.glob(pj(configs["partition_dir"], "*.h5"))), \
+            ["--partition_dir", configs["partition_dir"]]
+
+
+def get_script_stages(configs, paths):
+    ''' Stages that run a preprocessing script once, with their arguments,
+    input files and output files'''
+    part_inputs, part_args = partition_inputs(configs)
+    return {
+        "save_all_pids": {"script": "save_all_pids.py",
+            "args": ["--patient_table_path", paths["patient"],
+                "--vital_aper_path", paths["vitalAperiodic"],
+                "--vital_per_path", paths["vitalPeriodic"],
+                "--pid_stay_list", paths["all_pids"]],
+            "inputs": [paths["patient"], paths["vitalAperiodic"],
+                paths["vitalPeriodic"]],
+            "outputs": [paths["all_pids"]]},
+        "filter_patients": {"script": "filter_patients.py",
+            "args": ["--all_pid_stay_path", paths["all_pids"],
+                "--vital_per_table_path", paths["vitalPeriodic"],
+                "--output_path", paths["included_pids"]]+part_args,
+            "inputs": [paths["all_pids"], paths["vitalPeriodic"]]\
+                    +part_inputs,
+            "outputs": [paths["included_pids"]]},
+        "filter_variables": {"script": "filter_variables.py",
+            "args": ["--included_pid_path", paths["included_pids"],
+                "--hdf_dir", paths["hdf_dir"],
+                "--output_selected_per_vars", paths["per_vars"],
+                "--output_selected_aper_vars", paths["aper_vars"],
+                "--output_selected_lab_vars", paths["lab_vars"],
+                "--plots-dir", paths["plots_dir"]]+part_args,
+            "inputs": [paths["included_pids"], paths["vitalPeriodic"],
+                paths["vitalAperiodic"], paths["lab"], paths["patient"]]\
+                        +part_inputs,
+            "outputs": [paths["per_vars"], paths["aper_vars"],
+                paths["lab_vars"]]},
+        "compute_quantiles": {"script": "compute_quantiles.py",
+            "args": ["--list_per_variables", paths["per_vars"],
+                "--list_aper_variables", paths["aper_vars"],
+                "--included_pid_path", paths["included_pids"],
+                "--lab_table_path", paths["lab"],
+                "--vital_per_path", paths["vitalPeriodic"],
+                "--vital_aper_path", paths["vitalAperiodic"],
+                "--quantile_path", paths["quantiles"]],
+            "inputs": [paths["per_vars"], paths["aper_vars"],
+                paths["included_pids"], paths["lab"], paths["vitalPeriodic"],
+                paths["vitalAperiodic"]],
+            "outputs": [paths["quantiles"]]},
+        "compute_patient_batches": {"script": "compute_patient_batches.py",
+            "args": ["--included_pid_path", paths["included_pids"],
+                "--output_path", paths["patient_batches"]],
+            "inputs": [paths["included_pids"]],
+            "outputs": [paths["patient_batches"]]},
+        "save_model_inputs": {"script": "save_model_inputs.py",
+            "args": ["--time_grid_dir", paths["time_grid_dir"],
+                "--labels_dir", paths["labels_dir"],
+                "--output_dir", configs["data_dir"]],
+            # The batch files are added once the batches are known
+            "inputs": [pj(paths["time_grid_dir"], "normalization_values.h5")],
+            # The data-set is added once the normalization is known
+            "outputs": []}}
+
+
+def get_batch_stages(configs, paths):
+    ''' Stages that run a function per patient batch, with the arguments of
+    the batch script, the shared input files, and the input and output files
+    of a batch'''
+    part_inputs, part_args = partition_inputs(configs)
+    batch_file = lambda out_dir: lambda batch_idx: [pj(out_dir,
+        "batch_{}.h5".format(batch_idx))]
+    return {
+        "timegrid": {"parser": eicu_timegrid.get_parser(),
+            "batch_fn": eicu_timegrid.timegrid_one_batch,
+            "load_fn": eicu_timegrid.load_grid_model,
+            "args": ["--input_patient_table", paths["patient"],
+                "--input_admission_table", paths["admissionDx"],
+                "--input_apache_aps_var_table", paths["apacheApsVar"],
+                "--input_apache_patient_result_table",
+                paths["apachePatientResult"],
+                "--input_apache_pred_var_table", paths["apachePredVar"],
+                "--input_lab_table", paths["lab"],
+                "--input_vital_periodic_table", paths["vitalPeriodic"],
+                "--input_vital_aperiodic_table", paths["vitalAperiodic"],
+                "--selected_pid_list", paths["included_pids"],
+                "--pid_batch_file", paths["patient_batches"],
+                "--selected_lab_vars", paths["lab_vars"],
+                "--selected_per_vars", paths["per_vars"],
+                "--selected_aper_vars", paths["aper_vars"],
+                "--quantile_dict", paths["quantiles"],
+                "--output_dynamic_dir", paths["time_grid_dir"],
+                "--log_dir", paths["log_dir"]]+part_args,
+            "flags": {"create_dynamic": True, "create_static": False,
+                "create_async": False, "save_pts_separately": False},
+            "inputs": [paths[table] for table in STATIC_TABLES+["lab",
+                "vitalPeriodic", "vitalAperiodic"]]+[paths["lab_vars"],
+                    paths["per_vars"], paths["aper_vars"], paths["quantiles"]]\
+                            +part_inputs,
+            "batch_inputs": lambda batch_idx: [],
+            "batch_outputs": batch_file(paths["time_grid_dir"]),
+            "output_dirs": [paths["time_grid_dir"], paths["log_dir"]]},
+        "label": {"parser": eicu_label.get_parser(),
+            "batch_fn": eicu_label.label_data_one_batch,
+            "load_fn": eicu_label.load_dynamic_extractor,
+            "args": ["--imputed_data_dir", paths["time_grid_dir"],
+                "--input_patient_table", paths["patient"],
+                "--pid_batch_file", paths["patient_batches"],
+                "--output_dynamic_endpoint_dir", paths["labels_dir"],
+                "--log_dir", paths["log_dir"]]+part_args,
+            "flags": {},
+            "inputs": [paths["patient"]]+part_inputs,
+            # A batch is labelled again if its time grid changed
+            "batch_inputs": batch_file(paths["time_grid_dir"]),
+            "batch_outputs": batch_file(paths["labels_dir"]),
+            "output_dirs": [paths["labels_dir"], paths["log_dir"]]}}
+
+
+def run_script_stage(name, stage, manifest, configs):
+    ''' Runs a script stage unless its inputs and arguments are unchanged
+    since its last successful run'''
+    args = stage["args"]+configs["stage_args"].get(name, [])
+    fingerprint = mlhc_manifest.stage_fingerprint(stage["inputs"],
+            {"script": stage["script"], "args": args},
+            hash_max_bytes=configs["hash_max_mb"]*2**20)
+    if name not in configs["force"] and manifest.is_current(name, fingerprint,
+            stage["outputs"]):
+        print("Stage {}: inputs unchanged, skipping".format(name))
+        return
+    print("Stage {}: running {}".format(name, stage["script"]))
+    cmd = [sys.executable, pj(SCRIPT_DIR, stage["script"])]+args
+    if configs["dry_run"]:
+        print("Generated cmd line: [{}]".format(" ".join(map(shlex.quote,
+            cmd))))
+        return
+    subprocess.check_call(cmd, cwd=SCRIPT_DIR)
+    manifest.record(name, fingerprint)
+
+
+def run_batch_stage(name, stage, manifest, configs, batch_to_lst):
+    ''' Runs the batches of a batch stage whose patients, inputs or arguments
+    changed since their last successful run, in a local process pool'''
+    args = stage["args"]+configs["stage_args"].get(name, [])
+    batch_configs = vars(stage["parser"].parse_args(args))
+    batch_configs.update(stage["flags"])
+    hash_max_bytes = configs["hash_max_mb"]*2**20
+
+    # The shared inputs are fingerprinted once and combined with the patients
+    # and the own inputs of every batch
+    shared_fingerprint = mlhc_manifest.stage_fingerprint(stage["inputs"],
+            {"args": args, "flags": stage["flags"]},
+            hash_max_bytes=hash_max_bytes)
+    fingerprints = {}
+    batches = []
+    for batch_idx in sorted(batch_to_lst.keys()):
+        key = "{}/batch_{}".format(name, batch_idx)
+        fingerprints[batch_idx] = mlhc_manifest.stage_fingerprint(\
+                stage["batch_inputs"](batch_idx), {"shared": shared_fingerprint,
+                    "pids": list(map(int, batch_to_lst[batch_idx]))},
+                hash_max_bytes=hash_max_bytes)
+        # A batch without patients writes no outputs, it is done once it was
+        # run with its fingerprint
+        batch_outputs = stage["batch_outputs"](batch_idx) \
+                if len(batch_to_lst[batch_idx]) > 0 else []
+        if name in configs["force"] or not manifest.is_current(key,
+                fingerprints[batch_idx], batch_outputs):
+            batches.append(batch_idx)
+
+    # Outputs of batches that no longer exist would be picked up downstream
+    stale_keys = [key for key in manifest.keys_with_prefix(name+"/batch_") \
+            if int(key.split("_")[-1]) not in batch_to_lst]
+
+    print("Stage {}: {} of {} batches changed, {} stale batches".format(name,
+        len(batches), len(batch_to_lst), len(stale_keys)))
+    if configs["dry_run"]:
+        print("Batches to process: {}".format(batches))
+        return
+
+    for key in stale_keys:
+        for out_path in stage["batch_outputs"](int(key.split("_")[-1])):
+            if pe(out_path):
+                os.remove(out_path)
+        manifest.remove(key)
+
+    if len(batches) == 0:
+        return
+    for out_dir in stage["output_dirs"]:
+        os.makedirs(out_dir, exist_ok=True)
+
+    # Every batch is recorded as soon as it finished, so that a failure of
+    # another batch does not cause it to be run again
+    def record_batch(batch_idx, wall_time):
+        manifest.record("{}/batch_{}".format(name, batch_idx),
+                fingerprints[batch_idx])
+
+    batch_times = mlhc_dispatch.dispatch_batches(batches, stage["batch_fn"],
+            stage["load_fn"], batch_configs, n_workers=configs["n_workers"],
+            on_done=record_batch)
+    mlhc_dispatch.print_batch_times(batch_times)
+
+
+def run_pipeline(configs):
+    paths = get_paths(configs)
+    script_stages = get_script_stages(configs, paths)
+    batch_stages = get_batch_stages(configs, paths)
+    os.makedirs(configs["data_dir"], exist_ok=True)
+    os.makedirs(paths["plots_dir"], exist_ok=True)
+    manifest = mlhc_manifest.StageManifest(configs["manifest_path"] \
+            if configs["manifest_path"] is not None \
+            else pj(configs["data_dir"], "pipeline_manifest.json"))
+
+    for name in STAGES:
+        if name not in configs["stages"]:
+            continue
+        if name in batch_stages:
+            if configs["dry_run"] and not pe(paths["patient_batches"]):
+                print("Stage {}: patient batches not computed yet".format(name))
+                continue
+            with open(paths["patient_batches"], 'rb') as fp:
+                batch_to_lst = pickle.load(fp)["batch_to_lst"]
+            run_batch_stage(name, batch_stages[name], manifest, configs,
+                    batch_to_lst)
+            continue
+
+        stage = script_stages[name]
+        if name == "save_model_inputs":
+            stage["inputs"] += sorted(glob.glob(pj(paths["time_grid_dir"],
+                "batch_*.h5")))+sorted(glob.glob(pj(paths["labels_dir"],
+                    "batch_*.h5")))
+            # The name of the data-set depends on the arguments of the stage
+            # and on whether the normalization values exist, as in the script
+            save_cfg = vars(eicu_save.get_parser().parse_args(stage["args"]+\
+                    configs["stage_args"].get(name, [])))
+            stage["outputs"] = [eicu_save.get_dataset_path(save_cfg,
+                pe(pj(save_cfg["time_grid_dir"], "normalization_values.h5")))]
+        run_script_stage(name, stage, manifest, configs)
+
+
+def parse_stage_args(stage_args):
+    ''' Parses STAGE="--arg value ..." pairs into a dict of argument lists'''
+    stage_arg_dict = {}
+    for stage_arg in stage_args:
+        name, args = stage_arg.split("=", 1)
+        assert name in STAGES, "Unknown stage {}".format(name)
+        stage_arg_dict[name] = shlex.split(args)
+    return stage_arg_dict
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # Input paths
+    parser.add_argument("--data_dir", default=pj(HOME, "Datasets/eicu-2.0"),
+            help="Directory of all intermediate and output files")
+    parser.add_argument("--hdf_dir", default=None,
+            help="Directory of the HDF tables, by default hdf in data_dir")
+    parser.add_argument("--partition_dir", default=None,
+            help="Directory of the patient-partitioned tables, if given " \
+                    "these are used instead of where= queries")
+
+    # Output paths
+    parser.add_argument("--manifest_path", default=None,
+            help="Manifest of the input fingerprints, by default " \
+                    "pipeline_manifest.json in data_dir")
+
+    # Parameters
+    parser.add_argument("--stages", nargs="+", default=STAGES,
+            choices=STAGES, help="Stages to run, in pipeline order")
+    parser.add_argument("--force", nargs="+", default=[], choices=STAGES,
+            help="Stages that are run even if their inputs are unchanged")
+    parser.add_argument("--stage_args", nargs="+", default=[],
+            help="Extra arguments of a stage as STAGE=\"--arg value\", " \
+                    "which are part of its fingerprint")
+    parser.add_argument("--hash_max_mb", type=int, default=100,
+            help="Input files up to this size are fingerprinted by their " \
+                    "content, larger ones by their size and modification time")
+    parser.add_argument("--n_workers", type=int, default=None,
+            help="Number of worker processes of the batch stages, defaults " \
+                    "to the number of CPUs")
+    parser.add_argument("--dry_run", action="store_true", default=False,
+            help="Only print the stages and batches that would be run")
+
+    configs = vars(parser.parse_args())
+    configs["stage_args"] = parse_stage_args(configs["stage_args"])
+
+    run_pipeline(configs)
@@ -7,6 +7,7 @@ import pandas as pd
 import os
 
 import functions.util_io as mlhc_io
+import functions.util_table as mlhc_table
 
 pe = os.path.exists
 pj = os.path.join
@@ -22,21 +23,22 @@ def save_all_pids(configs):
     mlhc_io.write_list_to_file(configs["pid_stay_list"], stay_ids)
 
     print("Async Vital Signs")
-    df_async = pd.read_hdf(configs["vital_aper_path"],
-            configs["generic_dset_id"], mode='r')
+    async_chunks = mlhc_table.iter_table_chunks(configs["vital_aper_path"],
+            columns=configs["ASYNC_VITALS"], chunk_size=configs["chunk_size"],
+            dset_id=configs["generic_dset_id"])
+    async_counts = mlhc_table.fold_chunks(async_chunks, {"entries":
+        mlhc_table.NonNullCounter(configs["ASYNC_VITALS"])})["entries"]
     for vs in configs["ASYNC_VITALS"]:
-        orig = df_async[vs]
-        finite = orig.dropna()
-        print("{}: Number of entries: {}".format(vs, finite.size))
+        print("{}: Number of entries: {}".format(vs, async_counts[vs]))
 
     print("Sync Vital Signs")
-    df_sync = pd.read_hdf(configs["vital_per_path"],
-            configs["generic_dset_id"], mode='r')
-
+    sync_chunks = mlhc_table.iter_table_chunks(configs["vital_per_path"],
+            columns=configs["SYNC_VITALS"], chunk_size=configs["chunk_size"],
+            dset_id=configs["generic_dset_id"])
+    sync_counts = mlhc_table.fold_chunks(sync_chunks, {"entries":
+        mlhc_table.NonNullCounter(configs["SYNC_VITALS"])})["entries"]
     for vs in configs["SYNC_VITALS"]:
-        orig = df_sync[vs]
-        finite = orig.dropna()
-        print("{}: Number of entries: {}".format(vs, finite.size))
+        print("{}: Number of entries: {}".format(vs, sync_counts[vs]))
 
 
 if __name__ == "__main__":
@@ -62,6 +64,8 @@ if __name__ == "__main__":
     # Parameters
     parser.add_argument("--generic_dset_id", default="data",
             help="HDF data-set ID")
+    parser.add_argument("--chunk_size", type=int, default=1000000,
+            help="Number of rows of the vital sign tables read at a time")
 
     args = parser.parse_args()
     configs = vars(args)
@@ -3,7 +3,6 @@ Pre-processing functions for the T-DPSOM model, save data-set locally.
 """
 
 import argparse
-import parmap
 import numpy as np
 import os
 from glob import glob
@@ -15,50 +14,89 @@ pj = os.path.join
 HOME = os.path.expanduser("~")
 
 
-def get_normalized_data(data, patientid, mins, scales):
-    if mins==None or scales==None:
-        return ( data[data['patientunitstayid'] == patientid] ).drop(\
-                ["patientunitstayid", "ts"], axis=1).fillna(0).values
-    return ((data[data['patientunitstayid'] == patientid] - mins) /
-            scales).drop(["patientunitstayid", "ts"], axis=1).fillna(0).values
+ENDPOINT_COLUMNS = ['full_score_1', 'full_score_6', 'full_score_12',
+        'full_score_24', 'hospital_discharge_expired_1',
+        'hospital_discharge_expired_6', 'hospital_discharge_expired_12',
+        'hospital_discharge_expired_24', 'unit_discharge_expired_1',
+        'unit_discharge_expired_6', 'unit_discharge_expired_12',
+        'unit_discharge_expired_24']
 
 
-def get_patient_n(patient, data_frame, data_frame_endpoint, max_n_step,
-        mins_dynamic, scales_dynamic):
-    time_series_all = []
-    time_series_endpoint_all = []
-    patient_data = get_normalized_data(data_frame, patient, mins_dynamic,
-            scales_dynamic)
-    patient_endpoint = data_frame_endpoint[\
-            data_frame_endpoint['patientunitstayid'] == patient].drop(\
-            ["patientunitstayid", "ts"], axis=1)
-    patient_endpoint = patient_endpoint[['full_score_1', 'full_score_6',
-        'full_score_12', 'full_score_24',
-        'hospital_discharge_expired_1', 'hospital_discharge_expired_6',
-        'hospital_discharge_expired_12', 'hospital_discharge_expired_24',
-        'unit_discharge_expired_1', 'unit_discharge_expired_6',
-        'unit_discharge_expired_12', 'unit_discharge_expired_24']]\
-                .fillna(0).values
+def get_normalized_data(data, mins, scales):
+    ''' Normalizes all rows of a batch at once, returns the feature matrix
+    without the patient and time columns'''
+    if mins is not None and scales is not None:
+        data = (data - mins) / scales
+    return data.drop(["patientunitstayid", "ts"], axis=1).fillna(0).values
 
-    if max_n_step > 0:
-        time_series = patient_data[ :max_n_step ]
-        time_series_endpoint = patient_endpoint[ :max_n_step ]
-    else:
-        max_n_step = -max_n_step
-        time_series = patient_data[len(patient_data) - max_n_step: \
-                len(patient_data)]
-        time_series_endpoint = patient_endpoint[len(patient_data)-max_n_step: \
-                len(patient_data)]
-    time_series_all.append(time_series)
-    time_series_endpoint_all.append(time_series_endpoint)
 
-    return np.array(time_series_all), np.array(time_series_endpoint_all)
+def patient_row_ranges(pids):
+    ''' Sorts the rows of a batch by patient, keeping their order within each
+    patient. Returns the sorting permutation and a dict mapping every patient
+    to the [start, stop) range of its rows in the sorted order'''
+    order = np.argsort(pids, kind="mergesort")
+    sorted_pids, starts, counts = np.unique(pids[order], return_index=True,
+            return_counts=True)
+    return order, dict(zip(sorted_pids.tolist(), zip(starts.tolist(),
+        (starts+counts).tolist())))
 
 
-def parmap_batch_generator(data_total, endpoints_total, mins_dynamic,
-        scales_dynamic, max_n_step):
+def time_step_slice(n_steps, max_n_step):
+    ''' Time steps of a patient with n_steps rows that are kept, the first
+    max_n_step if positive, otherwise the last -max_n_step'''
+    if max_n_step > 0:
+        return slice(None, max_n_step)
+    return slice(n_steps + max_n_step, n_steps)
+
+
+def get_batch_data(data_frame, data_frame_endpoint, max_n_step, mins_dynamic,
+        scales_dynamic):
+    ''' Returns the time series and endpoints of all patients of a batch, in
+    order of their first row, as arrays of shape (patients, steps, features)
+    and (patients, steps, endpoints)'''
+    patients = data_frame.patientunitstayid.unique()
+    data_pids = np.array(data_frame["patientunitstayid"])
+    data_order, data_ranges = patient_row_ranges(data_pids)
+    endpoint_pids = np.array(data_frame_endpoint["patientunitstayid"])
+    endpoint_order, endpoint_ranges = patient_row_ranges(endpoint_pids)
+
+    patient_data = get_normalized_data(data_frame, mins_dynamic,
+            scales_dynamic)[data_order]
+    patient_endpoint = data_frame_endpoint[ENDPOINT_COLUMNS].fillna(0)\
+            .values[endpoint_order]
+
     time_series_all = []
     time_series_endpoint_all = []
+    for patient in patients.tolist():
+        start, stop = data_ranges[patient]
+        steps = time_step_slice(stop - start, max_n_step)
+        time_series_all.append(patient_data[start:stop][steps])
+        # The endpoints are aligned to the time series of the patient
+        start, stop = endpoint_ranges.get(patient, (0, 0))
+        time_series_endpoint_all.append(patient_endpoint[start:stop][steps])
+
+    return np.stack(time_series_all), np.stack(time_series_endpoint_all)
+
+
+def append_to_dataset(hf, name, values):
+    ''' Appends values along the first axis of a resizable data-set, which is
+    created on the first call'''
+    if name not in hf:
+        hf.create_dataset(name, data=values,
+                maxshape=(None,)+values.shape[1:],
+                chunks=(1,)+values.shape[1:])
+        return
+    dset = hf[name]
+    n_rows = dset.shape[0]
+    dset.resize(n_rows + values.shape[0], axis=0)
+    dset[n_rows:] = values
+
+
+def write_batches(hf, data_total, endpoints_total, mins_dynamic,
+        scales_dynamic, max_n_step):
+    ''' Writes the time series and endpoints of the patients of every batch to
+    the x and y data-sets of an open HDF5 file, one batch at a time'''
+    n_patients = 0
     for p in range(len(data_total)):
         print(p)
         path = data_total[p]
@@ -67,35 +105,42 @@ def parmap_batch_generator(data_total, endpoints_total, mins_dynamic,
         data_frame_endpoint = pd.read_hdf(path_endpoint).fillna(0)
         assert not data_frame.isnull().values.any(), "No NaNs allowed"
         assert not data_frame_endpoint.isnull().values.any(), "No NaNs allowed"
-        patients = data_frame.patientunitstayid.unique()
+        if data_frame.shape[0] == 0:
+            continue
 
-        temp = parmap.map(get_patient_n, patients, data_frame,
-                data_frame_endpoint, max_n_step, mins_dynamic,
-                scales_dynamic)
+        data, labels = get_batch_data(data_frame, data_frame_endpoint,
+                max_n_step, mins_dynamic, scales_dynamic)
+        append_to_dataset(hf, 'x', data)
+        append_to_dataset(hf, 'y', labels)
+        n_patients += data.shape[0]
 
-        data = []
-        labels = []
-        for a in range(len(temp)):
-            for b in range(len(temp[a][1])):
-                labels.append(temp[a][1][b])
-                data.append(temp[a][0][b])
-        data = np.array(data)
-        labels = np.array(labels)
-        time_series_all.extend(data)
-        time_series_endpoint_all.extend(labels)
+    return n_patients
 
-    return time_series_all, time_series_endpoint_all
+
+def get_dataset_path(cfg, has_normalization):
+    ''' Path of the data-set, whose name depends on the time steps that are
+    kept and on whether the data is normalized'''
+    max_n_step = cfg["max_n_step"]
+    stub = "eICU_data"
+    if max_n_step<0:
+        stub += "_b"
+    else:
+        stub += "_e"
+    stub += "%d" % np.abs(max_n_step)
+    if not has_normalization:
+        stub += "_nonorm"
+    return pj(cfg["output_dir"], stub+".csv")
 
 
 def main(cfg):
-    # path of the preprocessed data
-    data_total = glob( pj(HOME, "Datasets/EHRs/eICU/time_grid/batch_*.h5") )
+    # path of the preprocessed data, sorted like the labels so that the
+    # batches are paired
+    data_total = sorted(glob( pj(cfg["time_grid_dir"], "batch_*.h5") ))
 
     # path of the labels of the preprocessed data
-    endpoints_total = glob( pj(HOME, "Datasets/EHRs/eICU/labels/batch_*.h5") )
+    endpoints_total = sorted(glob( pj(cfg["labels_dir"], "batch_*.h5") ))
 
-    normalization_path = pj(HOME, "Datasets/EHRs/eICU/time_grid/" \
-            "normalization_values.h5")
+    normalization_path = pj(cfg["time_grid_dir"], "normalization_values.h5")
     if pe(normalization_path):
         # path of the labels of the mins
         mins_dynamic = pd.read_hdf(normalization_path , "mins_dynamic")
@@ -110,32 +155,32 @@ def main(cfg):
 
     # *************************************************************************
 
-    # Create numpy arrays with the last max_n_step time-steps of each
-    # time-series.
+    # Write the last max_n_step time-steps of each time-series, batch by batch
     max_n_step = cfg["max_n_step"]
-    data, labels = parmap_batch_generator(data_total, endpoints_total,
-            mins_dynamic, scales_dynamic, max_n_step=max_n_step)
-    l = np.array(labels)
-    d = np.array(data)
-    stub = "eICU_data"
-    if max_n_step<0:
-        stub += "_b"
-    else:
-        stub += "_e"
-    stub += "%d" % np.abs(max_n_step)
-    if not has_normalization:
-        stub += "_nonorm"
-    output_path = pj(HOME, "Datasets/EHRs/eICU", stub+".csv")
-    hf = h5py.File(output_path, 'w')
-    hf.create_dataset('x', data=d)
-    hf.create_dataset('y', data=l)
-    hf.close()
+    output_path = get_dataset_path(cfg, has_normalization)
+    with h5py.File(output_path, 'w') as hf:
+        n_patients = write_batches(hf, data_total, endpoints_total,
+                mins_dynamic, scales_dynamic, max_n_step=max_n_step)
+    print("Wrote {} time series".format(n_patients))
     print("Wrote data to %s" % output_path)
 
-if __name__ == "__main__":
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-n", "--max-n-step", type=int, default=-72,
             help="If negative, the last -n time steps are used.  If positive, "\
                     "the first n time steps are used.")
+    parser.add_argument("--time_grid_dir",
+            default=pj(HOME, "Datasets/EHRs/eICU/time_grid"),
+            help="Directory of the time grid batches")
+    parser.add_argument("--labels_dir",
+            default=pj(HOME, "Datasets/EHRs/eICU/labels"),
+            help="Directory of the label batches")
+    parser.add_argument("--output_dir", default=pj(HOME, "Datasets/EHRs/eICU"),
+            help="Directory where the data-set is saved")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = get_parser()
     cfg = vars( parser.parse_args() )
     main(cfg)
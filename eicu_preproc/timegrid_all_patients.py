@@ -9,15 +9,84 @@ import os
 import sys
 
 import functions.util_filesystem as mlhc_fs
+import functions.util_dispatch as mlhc_dispatch
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+import timegrid_one_batch as eicu_timegrid
+
 pe = os.path.exists
 pj = os.path.join
 HOME = os.path.expanduser("~")
 
 
-def timegrid_all_patients(configs):
+def load_grid_model(configs):
+    if configs["create_dynamic"] or configs["create_async"]:
+        return eicu_timegrid.load_grid_model(configs)
+    return None
+
+
+def batch_outputs_exist(batch_configs, batch_idx, pids):
+    ''' Have all the outputs of a batch already been written? The batch
+    script moves its outputs to their paths only once they are complete, a
+    batch without patients has no outputs and is always complete'''
+    if len(pids) == 0:
+        return True
+    if batch_configs["save_pts_separately"]:
+        out_paths = [pj(batch_configs["output_async_dir"], "{}.h5".format(pid))
+                for pid in pids] if batch_configs["create_async"] else []
+    else:
+        out_paths = [pj(batch_configs[out_dir], "batch_{}.h5".format(batch_idx))
+                for create_key, out_dir in [("create_dynamic",
+                    "output_dynamic_dir"), ("create_async", "output_async_dir"),
+                    ("create_static", "output_static_dir")] \
+                if batch_configs[create_key]]
+    return len(out_paths) > 0 and all(map(pe, out_paths))
+
+
+def timegrid_all_patients_pool(configs, batch_args):
+    ''' Runs the batches in a local process pool, loading the reference
+    tables once per worker'''
+    batch_configs = vars(eicu_timegrid.get_parser().parse_args(batch_args))
+    for p in ["create_static", "create_dynamic", "create_async",
+            "save_pts_separately"]:
+        batch_configs[p] = configs[p]
+    batch_configs["pid_batch_file"] = configs["patient_batch_path"]
+
+    with open(configs["patient_batch_path"],'rb') as fp:
+        obj=pickle.load(fp)
+        batch_to_lst=obj["batch_to_lst"]
+        batches=list(sorted(batch_to_lst.keys()))
+
+    if configs["just_one_batch"]:
+        batches = batches[:1]
+
+    if not configs["overwrite"]:
+        n_batches = len(batches)
+        batches = [batch_idx for batch_idx in batches \
+                if not batch_outputs_exist(batch_configs, batch_idx,
+                    batch_to_lst[batch_idx])]
+        print("Skipping {} completed batches".format(\
+                n_batches-len(batches)))
+
+    if configs["dry_run"]:
+        print("Batches to process: {}".format(batches))
+        return
+
+    batch_times = mlhc_dispatch.dispatch_batches(batches,
+            eicu_timegrid.timegrid_one_batch, load_grid_model, batch_configs,
+            n_workers=configs["n_workers"])
+    mlhc_dispatch.print_batch_times(batch_times)
+
+
+def timegrid_all_patients(configs, batch_args=None):
+    if batch_args is None:
+        batch_args = []
+
+    if configs["executor"] == "pool":
+        timegrid_all_patients_pool(configs, batch_args)
+        return
+
     job_index=0
     subprocess.call(["source activate default_py36"],shell=True)
     mem_in_mbytes=configs["mem_in_mbytes"]
@@ -46,7 +115,7 @@ def timegrid_all_patients(configs):
 
         cmd_line=" ".join(["python3", configs["compute_script_path"],
             "--run_mode INTERACTIVE", "--batch_id {}".format(batch_idx)] \
-                    + create_pars)
+                    + create_pars + batch_args)
 
         assert(" rm " not in cmd_line)
         job_index+=1
@@ -94,9 +163,19 @@ if __name__=="__main__":
     parser.add_argument("--save_pts_separately", action="store_true",
             help="If selected, each patient's data will be saved to a " \
                     "separate file")
-
-    args=parser.parse_args()
+    parser.add_argument("--executor", default="shell",
+            choices=["shell", "pool"],
+            help="Dispatch each batch as a shell command, or run the " \
+                    "batches in a local process pool")
+    parser.add_argument("--n_workers", type=int, default=None,
+            help="Number of worker processes in the pool, defaults to the " \
+                    "number of CPUs")
+    parser.add_argument("--overwrite", action="store_true", default=False,
+            help="In the pool, also process batches whose outputs exist")
+
+    # All other arguments are passed on to the batch script
+    args, batch_args=parser.parse_known_args()
     configs=vars(args)
     
-    timegrid_all_patients(configs)
+    timegrid_all_patients(configs, batch_args)
     
@@ -13,12 +13,11 @@ import pickle
 import sys
 import json
 
-import pandas as pd
-
 import matplotlib as mpl
 mpl.use("PDF")
 
-sys.path.append("/home/matt/Repos/mattphillipsphd/dpsom/eicu_preproc/classes")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "classes"))
 import imputer as eicu_tf_impute
 import static_extractor as eicu_static_tf
 # Ridiculous but apparently necessary since this is called as a subprocess!
@@ -27,13 +26,39 @@ import static_extractor as eicu_static_tf
 #import classes.static_extractor as eicu_static_tf
 
 import functions.util_io as mlhc_io
+import functions.util_filesystem as mlhc_fs
+import functions.util_partition as eicu_partition
 
 pe = os.path.exists
 pj = os.path.join
 HOME = os.path.expanduser("~")
 
 
-def timegrid_one_batch(configs):
+def load_grid_model(configs):
+    ''' Creates the time gridder with the selected lab variables and the
+    variable quantiles, which are shared by all patients'''
+    lab_vars = []
+
+    with open(configs["selected_lab_vars"], 'r') as fp:
+        csv_fp = csv.reader(fp, delimiter='\t')
+        next(csv_fp)
+        for lab_name in csv_fp:
+            lab_vars.append(lab_name[0].strip())
+
+    grid_model = eicu_tf_impute.Timegridder(sel_vs_vars=\
+            mlhc_io.read_list_from_file(configs["selected_per_vars"]),
+            sel_avs_vars=mlhc_io.read_list_from_file(\
+                configs["selected_aper_vars"]))
+    grid_model.set_selected_lab_vars(lab_vars)
+
+    with open(configs["quantile_dict"], mode='r') as quantile_fp:
+        var_quantile_dict = json.load(quantile_fp)
+    grid_model.set_quantile_dict(var_quantile_dict)
+
+    return grid_model
+
+
+def timegrid_one_batch(configs, grid_model=None):
     batch_id=configs["batch_id"]    
 
     with open(configs["pid_batch_file"], 'rb') as fp:
@@ -46,53 +71,62 @@ def timegrid_one_batch(configs):
     create_static = configs["create_static"]
     create_dynamic = configs["create_dynamic"]
     create_async = configs["create_async"]
+
+    # The outputs of the batch are written to temporary files, which are moved
+    # to the output paths once the batch is complete
+    out_paths = {out_dir: os.path.join(configs[out_dir],
+        "batch_{}.h5".format(batch_id)) for out_dir in ["output_static_dir",
+            "output_dynamic_dir", "output_async_dir"]}
+    written_paths = []
+
+    # A batch without patients has no outputs, those of an earlier version of
+    # the batch are removed so that they are not picked up downstream
+    if len(batch_idxs) == 0:
+        print("Batch {} has no patients".format(batch_id))
+        if not configs["save_pts_separately"]:
+            for create, out_dir in [(create_static, "output_static_dir"),
+                    (create_dynamic, "output_dynamic_dir"),
+                    (create_async, "output_async_dir")]:
+                if create:
+                    mlhc_fs.delete_if_exist(out_paths[out_dir])
+        return
+
+    reader = eicu_partition.get_patient_reader(configs["partition_dir"])
+
+    if (create_dynamic or create_async) and grid_model is None:
+        grid_model = load_grid_model(configs)
+
     print("Dispatched batch {} with {} patients".format(batch_id,
         len(batch_idxs)))
 
+    # The static variables of the batch are extracted at once, from the
+    # tables joined on the patient stays of the batch
+    if create_static and not configs["save_pts_separately"]:
+        static_extractor = eicu_static_tf.StaticExtractor()
+        df_static = static_extractor.transform_all(\
+                *static_extractor.read_tables([configs["input_patient_table"],
+                    configs["input_apache_aps_var_table"],
+                    configs["input_apache_patient_result_table"],
+                    configs["input_apache_pred_var_table"]], batch_idxs),
+                pids=batch_idxs)
+        df_static.to_hdf(mlhc_fs.tmp_path(out_paths["output_static_dir"]),
+            configs["output_dset_id"], data_columns=["patientunitstayid"],
+            mode='w', format="table", complevel=configs["hdf_comp_level"],
+            complib=configs["hdf_comp_alg"])
+        written_paths.append(out_paths["output_static_dir"])
+
     for pidx, pid in enumerate(batch_idxs):
 
         if (pidx+1) % 10 == 0:
             print("Progress in batch {}: {}/{}".format(batch_id, pidx+1,
                 len(batch_idxs)))
 
-        if create_static:
-            static_extractor = eicu_static_tf.StaticExtractor()
-            df_pat = pd.read_hdf(configs["input_patient_table"], mode='r',
-                    where="patientunitstayid={}".format(pid))
-            df_adm = pd.read_hdf(configs["input_admission_table"], mode='r',
-                    where="patientunitstayid={}".format(pid))
-            df_aav = pd.read_hdf(configs["input_apache_aps_var_table"],
-                    mode='r', where="patientunitstayid={}".format(pid))
-            df_apr = pd.read_hdf(configs["input_apache_patient_result_table"],
-                    mode='r', where="patientunitstayid={}".format(pid))
-            df_apv = pd.read_hdf(configs["input_apache_pred_var_table"],
-                    mode='r', where="patientunitstayid={}".format(pid))
-            df_static = static_extractor.transform(df_pat, df_adm, df_aav,
-                    df_apr, df_apv, pid=pid)
-
         if create_dynamic or create_async:
-            lab_vars = []
-
-            with open(configs["selected_lab_vars"], 'r') as fp:
-                csv_fp = csv.reader(fp, delimiter='\t')
-                next(csv_fp)
-                for lab_name in csv_fp:
-                    lab_vars.append(lab_name[0].strip())
-
-            grid_model = eicu_tf_impute.Timegridder()
-            grid_model.set_selected_lab_vars(lab_vars)
-
-            quantile_fp = open(configs["quantile_dict"], mode='r')
-            var_quantile_dict = json.load(quantile_fp)
-            grid_model.set_quantile_dict(var_quantile_dict)
-            quantile_fp.close()    
-
-            df_lab = pd.read_hdf(configs["input_lab_table"], mode='r',
-                    where="patientunitstayid={}".format(pid))
-            df_vs = pd.read_hdf(configs["input_vital_periodic_table"],
-                    mode='r', where="patientunitstayid={}".format(pid))
-            df_avs = pd.read_hdf(configs["input_vital_aperiodic_table"],
-                    mode='r', where="patientunitstayid={}".format(pid))
+            df_lab = reader.read_patient(configs["input_lab_table"], pid)
+            df_vs = reader.read_patient(configs["input_vital_periodic_table"],
+                    pid)
+            df_avs = reader.read_patient(\
+                    configs["input_vital_aperiodic_table"], pid)
             if create_dynamic:
                 df_out = grid_model.transform(df_lab, df_vs, df_avs, pid=pid)
             if create_async:
@@ -102,44 +136,45 @@ def timegrid_one_batch(configs):
 
         if configs["save_pts_separately"]:
             if create_async:
-                df_async.to_hdf(os.path.join(configs["output_async_dir"],
-                    "{}.h5".format(pid)), configs["output_dset_id"],
-                    append=False, data_columns=["ts"],
-                    mode='w', format="table",
+                pat_path = os.path.join(configs["output_async_dir"],
+                    "{}.h5".format(pid))
+                df_async.to_hdf(mlhc_fs.tmp_path(pat_path),
+                    configs["output_dset_id"], append=False,
+                    data_columns=["ts"], mode='w', format="table",
                     complevel=configs["hdf_comp_level"],
                     complib=configs["hdf_comp_alg"])
+                os.replace(mlhc_fs.tmp_path(pat_path), pat_path)
         else:
             append = not first_write
             mode = 'w' if first_write else 'a'
             if create_dynamic:
-                df_out.to_hdf(os.path.join(configs["output_dynamic_dir"],
-                    "batch_{}.h5".format(batch_id)), configs["output_dset_id"],
+                df_out.to_hdf(mlhc_fs.tmp_path(\
+                    out_paths["output_dynamic_dir"]), configs["output_dset_id"],
                     append=append, data_columns=["patientunitstayid"],
                     mode=mode, format="table",
                     complevel=configs["hdf_comp_level"],
                     complib=configs["hdf_comp_alg"])
 
             if create_async:
-                df_async.to_hdf(os.path.join(configs["output_async_dir"],
-                    "batch_{}.h5".format(batch_id)), configs["output_dset_id"],
-                    append=append, data_columns=["patientunitstayid"],
-                    mode=mode, format="table",
-                    complevel=configs["hdf_comp_level"],
-                    complib=configs["hdf_comp_alg"])
-
-            if create_static:
-                df_static.to_hdf(os.path.join(configs["output_static_dir"],
-                    "batch_{}.h5".format(batch_id)), configs["output_dset_id"],
+                df_async.to_hdf(mlhc_fs.tmp_path(\
+                    out_paths["output_async_dir"]), configs["output_dset_id"],
                     append=append, data_columns=["patientunitstayid"],
                     mode=mode, format="table",
                     complevel=configs["hdf_comp_level"],
                     complib=configs["hdf_comp_alg"])
 
+            if first_write:
+                written_paths += [out_paths[out_dir] for create, out_dir \
+                        in [(create_dynamic, "output_dynamic_dir"),
+                            (create_async, "output_async_dir")] if create]
             first_write = False
 
+    reader.close()
+    for out_path in written_paths:
+        os.replace(mlhc_fs.tmp_path(out_path), out_path)
 
 
-if __name__ == "__main__":
+def get_parser():
     parser = argparse.ArgumentParser()
 
     # Location of the input tables
@@ -167,6 +202,9 @@ if __name__ == "__main__":
     parser.add_argument("--input_vital_aperiodic_table",
         default=pj(HOME, "Datasets/eicu-2.0/hdf/vitalAperiodic.h5"),
             help="Location of the vital aperiodic table") 
+    parser.add_argument("--partition_dir", default=None,
+            help="Directory of the patient-partitioned tables, if given " \
+                    "these are used instead of where= queries")
 
     # Location of some meta-files
     parser.add_argument("--selected_pid_list",
@@ -178,6 +216,13 @@ if __name__ == "__main__":
     parser.add_argument('--selected_lab_vars',
             default=pj(HOME, "Datasets/eicu-2.0/included_lab_variables.txt"),
             help="Specify the file with the list of lab variables to use") 
+    parser.add_argument("--selected_per_vars",
+            default=pj(HOME, "Datasets/eicu-2.0/included_per_variables.txt"),
+            help="Specify the file with the list of periodic variables to use")
+    parser.add_argument("--selected_aper_vars",
+            default=pj(HOME, "Datasets/eicu-2.0/included_aper_variables.txt"),
+            help="Specify the file with the list of aperiodic variables to "\
+                    "use")
     parser.add_argument("--quantile_dict",
             default=pj(HOME, "Datasets/eicu-2.0/var_quantiles.json"),
             help="Precomputed data quantiles in the eICU data-set that can be"\
@@ -235,6 +280,11 @@ if __name__ == "__main__":
             default=False,
             help="Debugging mode")
 
+    return parser
+
+
+if __name__ == "__main__":
+    parser = get_parser()
     args = parser.parse_args()
     configs = vars(args)
 
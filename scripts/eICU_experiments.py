@@ -3,6 +3,7 @@
 
 import random
 import argparse
+import itertools
 import ipdb
 import os
 import os.path
@@ -22,7 +23,6 @@ except:
 import numpy as np
 import numpy.random as nprand
 import h5py
-from sklearn.model_selection import train_test_split
 import matplotlib.pyplot as plt
 import tensorflow_probability as tfp
 import sklearn
@@ -40,6 +40,13 @@ import lightgbm as lgbm
 
 from contextlib import contextmanager
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dpsom"))
+
+from eicu_data import get_data_split
+from cluster_metrics import cluster_scores, cluster_label_stats
+from som_distance import squared_distances_np
+from utils import extract_outputs
+
 @contextmanager
 def suppress_stdout():
     with open(os.devnull, "w") as devnull:
@@ -51,19 +58,10 @@ def suppress_stdout():
             sys.stdout = old_stdout
 
 def get_data(test=True):
-    ''' Get the precomputed data from the file-system'''
-    hf = h5py.File(configs["eicu_data"], 'r')
-    data_total = np.array(hf.get('x'))
-    endpoints_total = np.array(hf.get('y'))
-    hf.close()
-    data_train, data_val, y_train, endpoints_total_val = train_test_split(data_total[:int(len(data_total) * 0.85)],
-                                                                          endpoints_total[:int(len(data_total) * 0.85)],
-                                                                          test_size=0.20,
-                                                                          random_state=42)
-    if test:
-        data_val = data_total[int(len(data_total) * 0.85):]
-        endpoints_total_val = endpoints_total[int(len(data_total) * 0.85):]
-    return data_train, data_val, y_train, endpoints_total_val
+    ''' Get the precomputed data from the file-system, the training set is read
+        from disk when it is accessed, the val/test set is loaded into memory'''
+    data_train, data_val, y_train, endpoints_total_val = get_data_split(configs["eicu_data"], not test)
+    return data_train, np.asarray(data_val), y_train, np.asarray(endpoints_total_val)
 
 
 def batch_generator(data_train, data_val, endpoints_total_val, batch_size, mode="train"):
@@ -82,12 +80,8 @@ def batch_generator(data_train, data_val, endpoints_total_val, batch_size, mode=
 
 def z_dist_flat(z_e, embeddings, som_dim, latent_dim):
     """Computes the distances between the encodings and the embeddings."""
-    emb = np.reshape(embeddings, (som_dim[0]*som_dim[1], -1))
-    z = np.reshape(z_e, (z_e.shape[0], 1, latent_dim))
-    z = np.tile(z, [1,som_dim[0]*som_dim[1], 1])
-    z_dist = np.square(z-emb)
-    z_dist_red = np.sum(z_dist, axis=-1)
-    return z_dist_red
+    return squared_distances_np(np.reshape(z_e, (-1, latent_dim)),
+                                np.reshape(embeddings, (som_dim[0], som_dim[1], latent_dim)))
 
         
 def execute(configs):
@@ -104,9 +98,10 @@ def execute(configs):
     # Fit a HMM model
 
     if configs["train_hmm"]:
-        tss=[data_train[i,:,:] for i in range(data_train.shape[0])]
-        random.shuffle(tss)
-        tss=tss[:configs["hmm_train_subset"]]
+        pat_idxs=list(range(data_train.shape[0]))
+        random.shuffle(pat_idxs)
+        pat_idxs=pat_idxs[:configs["hmm_train_subset"]]
+        tss=list(data_train[np.array(pat_idxs)])
         X_flat=np.concatenate(tss,axis=0)
         hmm_model=hmm.GaussianHMM(configs["hmm_n_states"],covariance_type="diag", 
                               random_state=configs["random_state"],verbose=True)
@@ -116,12 +111,12 @@ def execute(configs):
         print("Seconds to fit HMM: {:.3f}".format(t_end-t_begin))
 
     len_data_val = len(data_val)
-    data_train_flat=np.reshape(data_train, (data_train.shape[0]*data_train.shape[1],data_train.shape[2]))
     data_val_flat=np.reshape(data_val, (data_val.shape[0]*data_val.shape[1],data_val.shape[2]))
 
     print("Fitting K-means...")
 
     if configs["train_kmeans"]:
+        data_train_flat=np.reshape(data_train, (data_train.shape[0]*data_train.shape[1],data_train.shape[2]))
         kmeans_model=skcluster.MiniBatchKMeans(n_clusters=configs["km_nclusters"],random_state=configs["random_state"])
         kmeans_model.fit(data_train_flat)
         cval_km=kmeans_model.predict(data_val_flat)
@@ -219,34 +214,30 @@ def execute(configs):
 
         val_gen = batch_generator(data_train, data_val, endpoints_total_val, batch_size, mode="val")
         num_batches=len_data_val//batch_size
-        test_k_all=[]
-        test_qq_all=[]
-        test_z_e_all=[]
-        test_z_q_all=[]
-        labels_sanity=[]
-
-        for i in range(num_batches):
-            batch_data,batch_labels,ii=next(val_gen)
-            batch_labels_san=np.reshape(batch_labels, (-1, batch_labels.shape[-1]))[:,3]
-            batch_k_all=sess.run(k,feed_dict={x: batch_data})
-            batch_k_all=batch_k_all.reshape((-1,72))
-            batch_qq_all=sess.run(q, feed_dict={x:batch_data})
-            batch_qq_all=batch_qq_all.reshape((-1,72,configs["som_dim"]*configs["som_dim"]))
-            batch_z_e_all=sess.run(z_e, feed_dict={x:batch_data})
-            batch_z_e_all=batch_z_e_all.reshape((-1,72,latent_dim))
-            batch_z_q_all=sess.run(z_q, feed_dict={x:batch_data})
-            batch_z_q_all=batch_z_q_all.reshape((-1,72,latent_dim))
-            test_k_all.extend(batch_k_all)
-            test_qq_all.extend(batch_qq_all)
-            test_z_e_all.extend(batch_z_e_all)
-            test_z_q_all.extend(batch_z_q_all)
-            labels_sanity.extend(batch_labels_san)
-            
-        k_all=np.array(test_k_all)
-        qq_all=np.array(test_qq_all)
-        z_e_all=np.array(test_z_e_all)
-        z_q_all=np.array(test_z_q_all)
-        labels_sanity=np.array(labels_sanity).astype(np.int)
+
+        # All outputs of a batch are computed in one run, from the same sample of the embeddings
+        fetches={"k": k, "q": q, "z_e": z_e, "z_q": z_q}
+
+        def run_batch(batch_data, batch_labels):
+            outputs=sess.run(fetches, feed_dict={x: batch_data})
+            outputs["labels_sanity"]=np.reshape(batch_labels, (-1, batch_labels.shape[-1]))[:,3]
+            return outputs
+
+        batches=((batch_data, batch_labels, np.arange(i*batch_size, (i+1)*batch_size))
+                 for batch_data, batch_labels, i in itertools.islice(val_gen, num_batches))
+
+        if configs["embeddings_path"] is not None:
+            with h5py.File(configs["embeddings_path"], "w") as hf:
+                outputs=extract_outputs(run_batch, batches, num_batches*batch_size, h5_group=hf)
+                outputs={name: dset[()] for name, dset in outputs.items()}
+        else:
+            outputs=extract_outputs(run_batch, batches, num_batches*batch_size)
+
+        k_all=outputs["k"].reshape((-1,72))
+        qq_all=outputs["q"].reshape((-1,72,configs["som_dim"]*configs["som_dim"]))
+        z_e_all=outputs["z_e"].reshape((-1,72,latent_dim))
+        z_q_all=outputs["z_q"].reshape((-1,72,latent_dim))
+        labels_sanity=outputs["labels_sanity"].astype(np.int)
         prefix=labels_24.flatten()[:108000]
         assert((labels_sanity==prefix).all()) 
 
@@ -296,10 +287,11 @@ def execute(configs):
                 tasknum=labels_cat[task][:108000]
 
                 if configs["only_nmi"]:
+                    nmi_score=cluster_scores(repnum.flatten(), tasknum.flatten(), scores=["NMI"])["NMI"]
                     with open("../results/mh_results_rseed_{}.tsv".format(configs["random_state"]),'a') as fp:
                         csv_fp=csv.writer(fp,delimiter='\t')
-                        csv_fp.writerow([rep,task,str(metrics.normalized_mutual_info_score(tasknum.flatten(), repnum.flatten()))])
-                        print("Repr: {}, Task: {}, NMI: {:.3f}".format(rep,task,metrics.normalized_mutual_info_score(tasknum.flatten(), repnum.flatten())))
+                        csv_fp.writerow([rep,task,str(nmi_score)])
+                        print("Repr: {}, Task: {}, NMI: {:.3f}".format(rep,task,nmi_score))
                     continue
 
                 trainX=repnum[:int(repnum.shape[0]*0.6),:]
@@ -402,13 +394,7 @@ def execute(configs):
     # Heatmap with respect to current APACHE score
     
     print("Labels shape: {}".format(labels_1.shape))
-    labels = np.reshape(labels_1,(-1))
-    ones = np.ones((len(np.reshape(k_all, (-1)))))
-    clust_matr1 = np.zeros(som_dim[0]*som_dim[1])
-    
-    for i in range(som_dim[0]*som_dim[1]):
-        s1 = np.sum(labels[np.where(np.reshape(k_all, (-1))==i)]) / np.sum(ones[np.where(np.reshape(k_all, (-1))==i)])
-        clust_matr1[i] = s1
+    _, clust_matr1, _ = cluster_label_stats(k_all, labels_1, som_dim[0]*som_dim[1])
         
     clust_matr1 = np.reshape(clust_matr1, (som_dim[0],som_dim[1]))
     ax = sns.heatmap(clust_matr1, cmap="YlGnBu", vmax=7)
@@ -417,13 +403,7 @@ def execute(configs):
     plt.clf()
 
     # ICU mortality risk in the next 24 hours:
-    labels = np.reshape(u_disc_24,(-1))
-    ones = np.ones((len(np.reshape(k_all, (-1)))))
-    clust_matr1 = np.zeros(som_dim[0]*som_dim[1])
-    
-    for i in range(som_dim[0]*som_dim[1]):
-        s1 = np.sum(labels[np.where(np.reshape(k_all, (-1))==i)]) / np.sum(ones[np.where(np.reshape(k_all, (-1))==i)])
-        clust_matr1[i] = s1
+    _, clust_matr1, _ = cluster_label_stats(k_all, u_disc_24, som_dim[0]*som_dim[1])
         
     clust_matr1 = np.reshape(clust_matr1, (som_dim[0],som_dim[1]))
     ax = sns.heatmap(clust_matr1, cmap="YlGnBu")
@@ -451,13 +431,7 @@ def execute(configs):
         labels = u_disc_24
         it = 0
         fig, ax = plt.subplots(5, 4, figsize=(50,43)) 
-        ones = np.ones((len(np.reshape(k_all, (-1)))))
-        clust_matr1 = np.zeros(64)
-        clust_matr2 = np.zeros(64)
-
-        for i in range(64):
-            s1 = np.sum(labels[np.where(np.reshape(k_all, (-1)) == i)]) / np.sum(ones[np.where(np.reshape(k_all, (-1))==i)])
-            clust_matr1[i] = s1
+        _, clust_matr1, _ = cluster_label_stats(k_all, labels, 64)
 
         clust_matr1 = np.reshape(clust_matr1, (8,8))
 
@@ -540,7 +514,7 @@ def execute(configs):
                 csv_fp.writerow(["task","NMI"])
 
         for task in ["l1","l6","l12","l24"]:
-            nmi_score=metrics.normalized_mutual_info_score(labels_cat[task].flatten(),pred_k_hmm)
+            nmi_score=cluster_scores(pred_k_hmm, labels_cat[task].flatten(), scores=["NMI"])["NMI"]
             if not configs["debug_mode"]:
                 with open("../results/mh_hmm_NMI_results_{}.tsv".format(configs["random_state"]),'a') as fp:
                     csv_fp=csv.writer(fp,delimiter='\t')
@@ -567,66 +541,27 @@ def execute(configs):
             graph = tf.get_default_graph()
             k = graph.get_tensor_by_name("k/k:0")
             z_e = graph.get_tensor_by_name("z_e_sample/z_e:0")
-            next_z_e = graph.get_tensor_by_name("prediction/next_z_e:0")
             x = graph.get_tensor_by_name("inputs/x:0")
             is_training = graph.get_tensor_by_name("is_training/is_training:0")
-            graph = tf.get_default_graph()
-            init_1 = graph.get_tensor_by_name("prediction/next_state/init_state:0")
-            z_e_p = graph.get_tensor_by_name("prediction/next_state/input_lstm:0")
-            state1 = graph.get_tensor_by_name("prediction/next_state/next_state:0")
-            q = graph.get_tensor_by_name("q/distribution/q:0")
-            embeddings = graph.get_tensor_by_name("embeddings/embeddings:0")
             z_p= graph.get_tensor_by_name("reconstruction_e/decoder/z_e:0")
             reconstruction = graph.get_tensor_by_name("reconstruction_e/x_hat:0")
+            horizon = graph.get_tensor_by_name("forecast/horizon:0")
+            z_e_forecast = graph.get_tensor_by_name("forecast/z_e_forecast:0")
+            k_forecast = graph.get_tensor_by_name("forecast/k_forecast:0")
+            x_forecast = graph.get_tensor_by_name("forecast/x_forecast:0")
 
             print("Evaluation...")
-            training_dic = {is_training: True, z_e_p: np.zeros((max_n_step * len(data_val), latent_dim)),
-                            init_1: np.zeros((2, batch_size, 10))}
-
-            z_e_all = sess.run(z_e, feed_dict={x: data_val})
+            t = 72-num_pred
+            z_e_all, k_all = sess.run([z_e, k], feed_dict={x: data_val})
             z_e_all = z_e_all.reshape((-1, 72, latent_dim))
-            k_all = sess.run(k, feed_dict={x: data_val})
             k_all = k_all.reshape((-1, 72))
-            qq = sess.run(q, feed_dict={x: data_val})
-            x_rec = sess.run(reconstruction, feed_dict={x: data_val, is_training: True, z_p: np.zeros((max_n_step * len(data_val), latent_dim))})
-            t = 72-num_pred
-            embeddings = sess.run(embeddings, feed_dict={x: data_val[:, :t, :]})
-            embeddings = np.reshape(embeddings,(-1,latent_dim))
-            k_eval=[]
-            batch_data= data_val[:, :t, :]
-            z_e_o = z_e_all[:, :t, :]
-            k_o = k_all[:, :t]
-            f_dic = {x: batch_data}
-            f_dic.update(training_dic)
-            next_z_e_o = sess.run(next_z_e, feed_dict=f_dic)
-            next_z_e_o = next_z_e_o[:, -1, :]
-            state1_o = sess.run(state1, feed_dict=f_dic)
-            k_next = np.argmin(z_dist_flat(next_z_e_o, embeddings, som_dim,latent_dim), axis=-1)
-            k_o = np.concatenate([k_o, np.expand_dims(k_next,1)], axis=1)
-            z_e_o = np.concatenate([z_e_o, np.expand_dims(next_z_e_o, 1)], axis=1)
-            f_dic = {x: np.zeros((len(data_val),1, 98)), is_training: False, z_e_p: np.zeros((1 * len(data_val), latent_dim)),
-                     z_p: next_z_e_o, init_1: np.zeros((2, batch_size, 10))}
-            x_pred_hat = np.reshape(sess.run(reconstruction, feed_dict=f_dic), (-1, 1, 98))
-
-            for i in range(num_pred-1):
-                print(i)
-                inp = data_val[:, (t + i), :]
-                f_dic = {x: np.reshape(inp, (inp.shape[0],1,inp.shape[1]))}
-                val_dic = {is_training: False, z_e_p: next_z_e_o, init_1: state1_o, z_p: np.zeros((max_n_step * len(data_val), latent_dim))}
-                f_dic.update(val_dic)
-                next_z_e_o = sess.run(next_z_e, feed_dict=f_dic)
-                state1_o = sess.run(state1, feed_dict=f_dic)
-                k_next = np.argmin(z_dist_flat(next_z_e_o, embeddings, som_dim, latent_dim), axis=-1)
-                k_o = np.concatenate([k_o, np.expand_dims(k_next,1)], axis=1)
-                z_e_o = np.concatenate([z_e_o, next_z_e_o], axis=1)
-                next_z_e_o = np.reshape(next_z_e_o, (-1, latent_dim))
-                f_dic = {x: np.zeros((len(data_val),1, 98)), is_training: False, z_e_p: np.zeros((max_n_step * len(data_val), latent_dim)),
-                     z_p: next_z_e_o, init_1: np.zeros((2, batch_size, 10))}
-                final_x = sess.run(reconstruction, feed_dict=f_dic)
-                x_pred_hat = np.concatenate([x_pred_hat, np.reshape(final_x, (-1, 1, 98))], axis = 1)
-
-            f_dic = {x: np.zeros((len(data_val),1, 98)), is_training: False, z_e_p: np.zeros((max_n_step * len(data_val), latent_dim)),
-                     z_p: z_e_all[:, t-1, :], init_1: np.zeros((2, batch_size, 10))}
+
+            # The LSTM prior is rolled forward from the first t time steps in one run
+            z_e_pred, k_pred_o, x_pred_hat = sess.run([z_e_forecast, k_forecast, x_forecast],
+                                                      feed_dict={x: data_val[:, :t, :], horizon: num_pred})
+            k_o = np.concatenate([k_all[:, :t], k_pred_o], axis=1)
+
+            f_dic = {x: np.zeros((len(data_val),1, 98)), is_training: False, z_p: z_e_all[:, t-1, :]}
             final_x = sess.run(reconstruction, feed_dict=f_dic)
 
         print("Proposed model MSE: {:.3f}".format(sklearn.metrics.mean_squared_error(np.reshape(x_pred_hat, (-1, 98)), np.reshape(data_val[:, -6:], (-1, 98)))))
@@ -653,6 +588,8 @@ def execute(configs):
 
         print("Same state baseline MSE: {:.3f}".format(sklearn.metrics.mean_squared_error(np.reshape(x_same, (-1, 98)), np.reshape(data_val[:, -6:], (-1, 98)))))
 
+    data_train.close()
+
 def parse_cmd_args():
 
     parser=argparse.ArgumentParser()
@@ -690,6 +627,8 @@ def parse_cmd_args():
     
     # Output paths
     parser.add_argument("--plot_path", default="../data/plots", help="Plotting base path")
+    parser.add_argument("--embeddings_path", default=None,
+                        help="HDF5 file to which the SOM nodes, soft assignments and embeddings are written")
 
     configs=vars(parser.parse_args())
     return configs